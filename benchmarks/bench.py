@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmarks of webappman against stand-ins for drush, HTTP and MySQL.
+
+A fake drush with tunable bootstrap latency and output size is put first in
+  PATH, library archives are served by a local HTTP server and MySQL is a
+  fake DB-API connection with a tunable round trip time. Nothing outside a
+  temporary directory is touched.
+
+Run from the repository root:
+
+    python benchmarks/bench.py -o before.json
+    # change something
+    python benchmarks/bench.py -o after.json --compare before.json
+"""
+
+from os.path import abspath, dirname, join as path_join
+from shutil import rmtree
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess as sp
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from webappman import drupal
+from webappman.cache import ArtifactCache
+
+FAKE_DRUSH = '''#!/bin/sh
+# Stand-in for drush: sleeps for the bootstrap latency, prints output
+sleep "${WAM_BENCH_DRUSH_LATENCY:-0}"
+head -c "${WAM_BENCH_DRUSH_OUTPUT:-0}" /dev/zero | tr '\\000' x
+exit 0
+'''
+
+
+class FakeCursor(object):
+    """Cursor of FakeConnection. Every execute() costs one round trip."""
+    def __init__(self, connection):
+        self._connection = connection
+        self.rowcount = 0
+
+    def execute(self, query, args=None):
+        time.sleep(self._connection.rtt)
+        self._connection.statements += 1
+
+        if query.startswith('INSERT'):
+            self.rowcount = len(args) // 2
+
+    def fetchone(self):
+        return (0,)
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """MySQLdb connection stand-in with a fixed round trip time per
+         statement and commit."""
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.statements = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        time.sleep(self.rtt)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Environment(object):
+    """Temporary directory holding the fake drush, the served archives and
+         the Drupal trees."""
+    path = None
+    base_uri = None
+    _server = None
+    _old_path = None
+
+    def __init__(self, latency, output_size):
+        self.path = tempfile.mkdtemp(prefix='wam-bench-')
+        bin_dir = path_join(self.path, 'bin')
+        os.makedirs(bin_dir)
+
+        drush = path_join(bin_dir, 'drush')
+        with open(drush, 'w') as f:
+            f.write(FAKE_DRUSH)
+        os.chmod(drush, 0o755)
+
+        self._old_path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + self._old_path
+        os.environ['WAM_BENCH_DRUSH_LATENCY'] = str(latency)
+        os.environ['WAM_BENCH_DRUSH_OUTPUT'] = str(output_size)
+
+    def serve_archives(self, file_count, file_size):
+        """Builds a tar.gz and a zip library archive and serves them over
+             HTTP on a free local port."""
+        www = path_join(self.path, 'www')
+        os.makedirs(www)
+        data = b'x' * file_size
+
+        with tarfile.open(path_join(www, 'lib.tar.gz'), 'w:gz') as tar:
+            for i in range(file_count):
+                info = tarfile.TarInfo('lib/js/file%d.js' % (i))
+                info.size = file_size
+                tar.addfile(info, io.BytesIO(data))
+
+        with zipfile.ZipFile(path_join(www, 'lib.zip'), 'w',
+                             zipfile.ZIP_DEFLATED) as archive:
+            for i in range(file_count):
+                archive.writestr('lib/js/file%d.js' % (i), data)
+
+        class Handler(QuietHandler):
+            def translate_path(self, path):
+                return path_join(www, path.lstrip('/'))
+
+        self._server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.base_uri = 'http://127.0.0.1:%d/' % (self._server.server_port)
+
+    def drupal_root(self, name, site_count):
+        """Returns a Drupal root with site_count site directories."""
+        root = path_join(self.path, name)
+
+        for i in range(site_count):
+            os.makedirs(path_join(root, 'sites', 'site%04d.example.com' % (i)))
+
+        os.makedirs(path_join(root, 'sites', 'all'))
+
+        return root
+
+    def close(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+        os.environ['PATH'] = self._old_path
+        rmtree(self.path)
+
+
+def measure(func, repeat, setup=None):
+    """Calls func repeat times and returns the wall clock seconds of each
+         call. setup, if given, runs untimed before each call."""
+    times = []
+
+    for _ in range(repeat):
+        if setup:
+            setup()
+
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    return times
+
+
+def summarize(name, params, times):
+    ordered = sorted(times)
+
+    return {
+        'name': name,
+        'params': params,
+        'times': times,
+        'min': ordered[0],
+        'median': ordered[len(ordered) // 2],
+        'mean': sum(times) / len(times),
+    }
+
+
+def bench_command(env, args, devnull):
+    results = []
+
+    for site_count in args.sites:
+        root = env.drupal_root('fan-out-%d' % (site_count), site_count)
+
+        for workers in args.workers:
+            drush = drupal.Drush(root, stdout=devnull, max_workers=workers)
+            params = {'sites': site_count, 'workers': workers}
+
+            results.append(summarize('command', params, measure(
+                lambda: drush.command('status'), args.repeat)))
+
+        drush = drupal.Drush(root, stdout=devnull)
+        times = measure(lambda: drush.command_output('status'), args.repeat)
+        results.append(summarize('command_output', {'sites': site_count},
+                                 times))
+
+    return results
+
+
+def bench_vset(env, args, devnull):
+    results = []
+    root = env.drupal_root('vset', 0)
+    drush = drupal.Drush(root, stdout=devnull)
+
+    for count in args.variables:
+        variables = dict(('bench_var_%d' % (i), 'value %d' % (i))
+                         for i in range(count))
+        params = {'variables': count}
+
+        def vset_each():
+            for (name, value) in variables.items():
+                drush.vset(name, value)
+
+        if count <= args.max_vset:
+            results.append(summarize('vset', params,
+                                     measure(vset_each, args.repeat)))
+
+        connection = FakeConnection(args.mysql_rtt)
+        results.append(summarize('vset_many', params, measure(
+            lambda: drush.vset_many(variables, connection), args.repeat)))
+
+    return results
+
+
+def settings_data(site_count, conf_size):
+    data = {}
+
+    for i in range(site_count):
+        name = 'default' if i == 0 else 'site%04d.example.com' % (i)
+        data[name] = {
+            'databases': {
+                'default': {
+                    'default': {
+                        'database': 'db%d' % (i),
+                        'username': 'user',
+                        'password': 'secret',
+                        'host': 'localhost',
+                        'driver': 'mysql',
+                    },
+                },
+            },
+            'conf': dict(('bench_conf_%d' % (j), 'value %d' % (j))
+                         for j in range(conf_size)),
+            'ini_set': {
+                'session.gc_probability': 1,
+                'session.gc_divisor': 100,
+            },
+            'drupal_hash_salt': 'salt %d' % (i),
+        }
+
+    return data
+
+
+def bench_settings(env, args, devnull):
+    results = []
+
+    for site_count in args.settings_sites:
+        data = settings_data(site_count, args.conf_size)
+        params = {'sites': site_count, 'conf_size': args.conf_size}
+        root = path_join(env.path, 'settings-%d' % (site_count))
+
+        results.append(summarize('generate_settings_files', params, measure(
+            lambda: drupal.generate_settings_files(data), args.repeat)))
+        results.append(summarize(
+            'generate_settings_files_shared', params, measure(
+                lambda: drupal.generate_settings_files(data, shared=True),
+                args.repeat)))
+
+        def clean():
+            if os.path.isdir(root):
+                rmtree(root)
+
+        def write():
+            for _ in drupal.write_settings_files(data, root):
+                pass
+
+        results.append(summarize('write_settings_files', params,
+                                 measure(write, args.repeat, setup=clean)))
+        results.append(summarize('write_settings_files_unchanged', params,
+                                 measure(write, args.repeat)))
+
+    return results
+
+
+def bench_install_lib(env, args, devnull):
+    results = []
+    params = {'files': args.archive_files, 'file_size': args.archive_file_size}
+    old = (drupal.CKEDITOR_URI, drupal.FANCYBOX_URI, drupal.artifact_cache)
+    drupal.CKEDITOR_URI = env.base_uri + 'lib.tar.gz'
+    drupal.FANCYBOX_URI = env.base_uri + 'lib.zip'
+    root = env.drupal_root('libraries', 0)
+    drush = drupal.Drush(root, stdout=devnull)
+
+    try:
+        for (library, format) in (('ckeditor', 'tar'), ('fancybox', 'zip')):
+            lib_params = dict(params, format=format)
+
+            drupal.artifact_cache = None
+            results.append(summarize('install_lib', lib_params, measure(
+                lambda: drush.install_lib(library), args.repeat)))
+
+            drupal.artifact_cache = ArtifactCache(path_join(env.path,
+                                                            'cache'))
+            drush.install_lib(library)
+            times = measure(lambda: drush.install_lib(library), args.repeat)
+            results.append(summarize('install_lib_cached', lib_params,
+                                     times))
+    finally:
+        (drupal.CKEDITOR_URI, drupal.FANCYBOX_URI,
+         drupal.artifact_cache) = old
+
+    return results
+
+
+BENCHMARKS = (
+    ('command', bench_command),
+    ('vset', bench_vset),
+    ('settings', bench_settings),
+    ('install_lib', bench_install_lib),
+)
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return sp.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=dirname(abspath(__file__)),
+                                   stderr=devnull).decode('ascii').strip()
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return (result['name'], json.dumps(result['params'], sort_keys=True))
+
+
+def print_results(results, baseline=None):
+    old = {}
+    if baseline:
+        old = dict((result_key(x), x) for x in baseline['results'])
+
+    for result in results:
+        params = ' '.join('%s=%s' % x
+                          for x in sorted(result['params'].items()))
+        line = '%-32s %-40s %9.4fs' % (result['name'], params,
+                                       result['median'])
+        previous = old.get(result_key(result))
+
+        if previous and previous['median']:
+            line += '  %6.2fx' % (result['median'] / previous['median'])
+
+        print(line)
+
+
+def int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark webappman')
+
+    parser.add_argument('-o', '--output', help='Write results as JSON here')
+    parser.add_argument('--compare', help='Print the ratio of each median to '
+                        'the one in this earlier JSON result file')
+    parser.add_argument('--only', action='append',
+                        choices=[x[0] for x in BENCHMARKS],
+                        help='Run only this benchmark (repeatable)')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--drush-latency', type=float, default=0.05,
+                        help='Seconds each fake drush call takes')
+    parser.add_argument('--drush-output', type=int, default=256,
+                        help='Bytes each fake drush call prints')
+    parser.add_argument('--sites', type=int_list, default=[1, 10, 100],
+                        help='Site counts for command fan-out, e.g. '
+                        '1,10,100,1000')
+    parser.add_argument('--workers', type=int_list, default=[1, 8],
+                        help='max_workers values for command fan-out')
+    parser.add_argument('--variables', type=int_list, default=[10, 100, 1000])
+    parser.add_argument('--max-vset', type=int, default=100,
+                        help='Skip vset (one drush call per variable) above '
+                        'this many variables')
+    parser.add_argument('--mysql-rtt', type=float, default=0.0005,
+                        help='Seconds per fake MySQL round trip')
+    parser.add_argument('--settings-sites', type=int_list,
+                        default=[10, 100, 1000])
+    parser.add_argument('--conf-size', type=int, default=50,
+                        help='$conf entries per generated settings.php')
+    parser.add_argument('--archive-files', type=int, default=500)
+    parser.add_argument('--archive-file-size', type=int, default=4096)
+
+    args = parser.parse_args()
+    env = Environment(args.drush_latency, args.drush_output)
+    results = []
+
+    try:
+        env.serve_archives(args.archive_files, args.archive_file_size)
+
+        with open(os.devnull, 'w') as devnull:
+            for (name, func) in BENCHMARKS:
+                if args.only and name not in args.only:
+                    continue
+
+                results.extend(func(env, args, devnull))
+    finally:
+        env.close()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'arguments': vars(args),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
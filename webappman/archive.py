@@ -0,0 +1,200 @@
+#coding: utf-8
+"""In-process extraction of tar and zip archives"""
+
+from os.path import dirname, isdir, join as path_join, realpath
+from shutil import copyfileobj
+import os
+import tarfile
+import tempfile
+import zipfile
+
+from webappman.instrument import operation
+
+# Zip archives need a seekable file; up to this many bytes of a
+#   non-seekable stream are buffered in memory before spilling to disk
+ZIP_SPOOL_SIZE = 64 * 1024 * 1024
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _is_within(path, directory):
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def _target_path(dest, name, strip_components=0):
+    """Returns where member name is extracted to in dest, or None if
+         stripping leading components leaves nothing. Raises ArchiveError for
+         absolute names and names containing .. components."""
+    name = name.replace('\\', '/')
+    parts = [x for x in name.split('/') if x not in ('', '.')]
+
+    if name.startswith('/') or '..' in parts:
+        raise ArchiveError('Refusing to extract unsafe path %s' % (name))
+
+    parts = parts[strip_components:]
+
+    if not parts:
+        return None
+
+    return path_join(dest, *parts)
+
+
+def _check_parent(dest, target):
+    """Guards against writing through a symbolic link that points outside of
+         dest."""
+    if not _is_within(realpath(dirname(target)), realpath(dest)):
+        raise ArchiveError('Refusing to extract %s outside of %s' %
+                           (target, dest))
+
+
+def _makedirs(path):
+    if not isdir(path):
+        os.makedirs(path)
+
+
+def _write_file(src, target, mode=None):
+    if os.path.lexists(target):
+        os.remove(target)
+
+    with open(target, 'wb') as f:
+        copyfileobj(src, f, _CHUNK_SIZE)
+
+    if mode:
+        os.chmod(target, mode & 0o777)
+
+
+def extract_tar(fileobj, dest, strip_components=0, preserve_mtime=False):
+    """Extracts a (possibly compressed) tar archive from a file object. The
+         archive is read as a stream, so fileobj can be an HTTP response.
+
+    Arguments:
+    fileobj -- binary file object to read from
+    dest    -- str, directory to extract to. Created if it does not exist.
+
+    Keyword Arguments:
+    strip_components -- int, number of leading path components to remove
+                        from member names, like tar --strip-components
+    preserve_mtime   -- bool, give regular files the modification time
+                        recorded in the archive
+
+    Returns a list of the extracted paths. Raises ArchiveError for members
+      that would be written outside of dest.
+    """
+    ret = []
+    _makedirs(dest)
+
+    with operation('extract', format='tar', dest=dest) as record, \
+            tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        record['bytes'] = 0
+
+        for member in tar:
+            target = _target_path(dest, member.name, strip_components)
+
+            if target is None:
+                continue
+
+            _check_parent(dest, target)
+
+            if member.isdir():
+                _makedirs(target)
+            elif member.isfile():
+                _makedirs(dirname(target))
+                _write_file(tar.extractfile(member), target, member.mode)
+                record['bytes'] += member.size
+
+                if preserve_mtime:
+                    os.utime(target, (member.mtime, member.mtime))
+            elif member.issym():
+                link = member.linkname
+                if os.path.isabs(link) or not _is_within(
+                        realpath(path_join(dirname(target), link)),
+                        realpath(dest)):
+                    raise ArchiveError('Refusing to extract symbolic link %s '
+                                       'pointing outside of %s' %
+                                       (member.name, dest))
+                _makedirs(dirname(target))
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.symlink(link, target)
+            elif member.islnk():
+                source = _target_path(dest, member.linkname,
+                                      strip_components)
+                if source is None:
+                    raise ArchiveError('Cannot extract hard link %s' %
+                                       (member.name))
+                _makedirs(dirname(target))
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.link(source, target)
+            else:
+                # Devices and FIFOs have no place in a web application
+                continue
+
+            ret.append(target)
+
+        record['files'] = len(ret)
+
+    return ret
+
+
+def extract_zip(fileobj, dest, strip_components=0):
+    """Extracts a zip archive from a file object. zip archives keep their
+         index at the end, so a non-seekable stream (like an HTTP response) is
+         spooled into memory first, spilling to an anonymous temporary file
+         past ZIP_SPOOL_SIZE bytes. See extract_tar() for the arguments.
+    """
+    seekable = False
+    try:
+        seekable = fileobj.seekable()
+    except AttributeError:
+        pass
+
+    if not seekable:
+        spool = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE)
+        copyfileobj(fileobj, spool, _CHUNK_SIZE)
+        spool.seek(0)
+        fileobj = spool
+
+    ret = []
+    _makedirs(dest)
+
+    with operation('extract', format='zip', dest=dest) as record, \
+            zipfile.ZipFile(fileobj) as archive:
+        record['bytes'] = 0
+
+        for info in archive.infolist():
+            target = _target_path(dest, info.filename, strip_components)
+
+            if target is None:
+                continue
+
+            _check_parent(dest, target)
+
+            if info.filename.endswith('/'):
+                _makedirs(target)
+            else:
+                _makedirs(dirname(target))
+                with archive.open(info) as src:
+                    _write_file(src, target, info.external_attr >> 16)
+                record['bytes'] += info.file_size
+
+            ret.append(target)
+
+        record['files'] = len(ret)
+
+    return ret
+
+
+def extract(fileobj, dest, format, strip_components=0):
+    """Extracts an archive of the given format, ``'tar'`` or ``'zip'``. See
+         extract_tar()."""
+    if format == 'tar':
+        return extract_tar(fileobj, dest, strip_components=strip_components)
+    elif format == 'zip':
+        return extract_zip(fileobj, dest, strip_components=strip_components)
+
+    raise ArchiveError('Unknown archive format %s' % (format))
@@ -0,0 +1,450 @@
+#coding: utf-8
+"""Incremental, sharded synchronisation of asset directories"""
+
+from multiprocessing.pool import ThreadPool
+from os.path import expanduser, isdir, join as path_join, relpath
+import codecs
+import hashlib
+import json
+import os
+import re
+import subprocess as sp
+import tempfile
+import threading
+import time
+try:
+    from os import replace as replace_file
+except ImportError:
+    from os import rename as replace_file
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
+from webappman.archive import extract_tar
+from webappman.instrument import operation
+
+DEFAULT_MANIFEST_DIR = path_join(expanduser('~'), '.cache', 'webappman',
+                                 'manifests')
+
+# File names that are not valid UTF-8 round trip through surrogate escapes.
+#   Python 2 has no such error handler, but its names are byte strings.
+try:
+    codecs.lookup_error('surrogateescape')
+    _FS_ERRORS = 'surrogateescape'
+except LookupError:
+    _FS_ERRORS = None
+
+
+class AssetSyncError(Exception):
+    pass
+
+
+def _fs_decode(data):
+    if _FS_ERRORS is None:
+        return data
+
+    return data.decode('utf-8', _FS_ERRORS)
+
+
+def _fs_encode(name):
+    if isinstance(name, bytes):
+        return name
+
+    return name.encode('utf-8', _FS_ERRORS or 'strict')
+
+
+class ShardResult(object):
+    """Outcome of synchronising one shard of files. method is ``'rsync'`` or
+         ``'tar'``."""
+    index = None
+    files = 0
+    bytes = 0
+    elapsed = None
+    error = None
+    method = 'rsync'
+
+    def __init__(self, index, files, bytes, elapsed, error=None,
+                 method='rsync'):
+        self.index = index
+        self.files = files
+        self.bytes = bytes
+        self.elapsed = elapsed
+        self.error = error
+        self.method = method
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<ShardResult %d files=%d bytes=%d ok=%s>' % (
+            self.index, self.files, self.bytes, self.ok)
+
+
+def split_remote(path):
+    """Splits an rsync/SSH style path into (host, path). host is None for a
+         local path."""
+    match = re.match(r'^([^/:]+):(.*)$', path)
+
+    if not match:
+        return (None, path)
+
+    return (match.group(1), match.group(2) or '.')
+
+
+def _file_hash(path):
+    h = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def list_tree(source):
+    """Lists the regular files under source, a local path or host:path.
+         Remote trees are listed with a single ssh + GNU find call.
+
+    Returns a dict of relative path to (size, mtime) with mtime in whole
+      seconds.
+    """
+    (host, path) = split_remote(source)
+    ret = {}
+
+    if host:
+        printf_format = shell_quote('%P\\t%s\\t%T@\\n')
+        command = 'find %s -type f -printf %s' % (shell_quote(path),
+                                                  printf_format)
+        output = sp.check_output(['ssh', host, command])
+
+        for line in _fs_decode(output).splitlines():
+            (name, size, mtime) = line.rsplit('\t', 2)
+            ret[name] = (int(size), int(float(mtime)))
+
+        return ret
+
+    for (dir_path, _, file_names) in os.walk(path):
+        for name in file_names:
+            full_path = path_join(dir_path, name)
+
+            try:
+                st = os.lstat(full_path)
+            except OSError:
+                continue
+
+            if os.path.islink(full_path):
+                continue
+
+            ret[relpath(full_path, path)] = (st.st_size, int(st.st_mtime))
+
+    return ret
+
+
+def manifest_path(source, dest, manifest_dir=DEFAULT_MANIFEST_DIR):
+    """Returns the default manifest file for a source and destination
+         pair."""
+    key = hashlib.sha1(('%s\0%s' % (source, os.path.realpath(dest)))
+                       .encode('utf-8')).hexdigest()
+
+    return path_join(manifest_dir, key + '.json')
+
+
+def load_manifest(path):
+    """Returns the manifest at path: relative path to [size, mtime, hash or
+         None]. A missing or unreadable manifest is empty."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    directory = os.path.dirname(path)
+
+    if not isdir(directory):
+        os.makedirs(directory)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.manifest-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f)
+
+    replace_file(tmp_path, path)
+
+
+def verify_manifest(manifest, dest):
+    """Returns the entries of manifest that dest still has with the same
+         size and mtime. Files deleted or changed at dest (or all of them,
+         when dest was removed) are transferred again."""
+    if not isdir(dest):
+        return {}
+
+    existing = list_tree(dest)
+
+    return dict((name, entry) for (name, entry) in manifest.items()
+                if existing.get(name) == (entry[0], entry[1]))
+
+
+def changed_entries(listing, manifest, source_path=None):
+    """Compares a listing from list_tree() with a manifest. Returns (changed,
+         new manifest), changed being a list of (path, size).
+
+    With source_path (a local source), files whose size is unchanged but
+      whose mtime differs are compared by content hash, and hashes are kept
+      in the new manifest.
+    """
+    changed = []
+    new_manifest = {}
+
+    for (name, (size, mtime)) in listing.items():
+        old = manifest.get(name)
+        digest = old[2] if old and len(old) > 2 else None
+
+        if old and old[0] == size and old[1] == mtime:
+            new_manifest[name] = [size, mtime, digest]
+            continue
+
+        if source_path and old and old[0] == size and digest:
+            new_digest = _file_hash(path_join(source_path, name))
+            if new_digest == digest:
+                new_manifest[name] = [size, mtime, digest]
+                continue
+            digest = new_digest
+        elif source_path:
+            digest = _file_hash(path_join(source_path, name))
+        else:
+            digest = None
+
+        changed.append((name, size))
+        new_manifest[name] = [size, mtime, digest]
+
+    return (changed, new_manifest)
+
+
+def make_shards(entries, count):
+    """Splits (path, size) entries into at most count lists of similar total
+         size."""
+    shards = [[] for _ in range(min(count, len(entries)))]
+    totals = [0] * len(shards)
+
+    for (name, size) in sorted(entries, key=lambda x: -x[1]):
+        i = totals.index(min(totals))
+        shards[i].append((name, size))
+        totals[i] += size
+
+    return shards
+
+
+def _rsync_files(source, dest, names):
+    fd, list_path = tempfile.mkstemp(prefix='wam-files-')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'\0'.join(_fs_encode(x) for x in names))
+
+        source = source if source.endswith('/') else source + '/'
+        sp.check_call(['rsync', '-a', '--from0',
+                       '--files-from=%s' % (list_path), source, dest])
+    finally:
+        os.remove(list_path)
+
+
+def _tar_files(source, dest, names):
+    """Copies names from source (local or host:path) to dest as one tar
+         stream, avoiding a round trip and several system calls per file."""
+    (host, path) = split_remote(source)
+
+    if host:
+        command_line = ['ssh', host, 'tar -C %s -cf - --null -T -' %
+                        (shell_quote(path))]
+    else:
+        command_line = ['tar', '-C', path, '-cf', '-', '--null', '-T', '-']
+
+    proc = sp.Popen(command_line, stdin=sp.PIPE, stdout=sp.PIPE)
+
+    def feed():
+        # In a thread: tar starts writing before it has read the whole list
+        try:
+            for name in names:
+                proc.stdin.write(_fs_encode(name) + b'\0')
+        except (IOError, OSError):
+            pass
+        finally:
+            proc.stdin.close()
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+
+    try:
+        extract_tar(proc.stdout, dest, preserve_mtime=True)
+    finally:
+        proc.stdout.close()
+        feeder.join()
+        returncode = proc.wait()
+
+    if returncode != 0:
+        raise AssetSyncError('%s exited with status %d' % (command_line[0],
+                                                           returncode))
+
+
+def make_batches(entries, max_bytes, max_files):
+    """Splits (path, size) entries into consecutive lists of at most
+         max_files entries and (unless a single entry is larger) max_bytes
+         bytes. Entries are sorted by path so a batch tends to cover few
+         directories."""
+    batches = []
+    batch = []
+    total = 0
+
+    for (name, size) in sorted(entries):
+        if batch and (len(batch) >= max_files or total + size > max_bytes):
+            batches.append(batch)
+            batch = []
+            total = 0
+
+        batch.append((name, size))
+        total += size
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def _run_groups(source, dest, groups, workers):
+    """Transfers (method, entries) groups with a pool of workers threads.
+         Returns a ShardResult per group."""
+    def transfer(args):
+        (index, (method, entries)) = args
+        size = sum(x[1] for x in entries)
+        start = time.time()
+        error = None
+
+        try:
+            with operation('sync', source=source, shard=index,
+                           method=method, files=len(entries), bytes=size):
+                if method == 'tar':
+                    _tar_files(source, dest, [x[0] for x in entries])
+                else:
+                    _rsync_files(source, dest, [x[0] for x in entries])
+        except Exception as e:
+            error = e
+
+        return ShardResult(index, len(entries), size, time.time() - start,
+                           error, method=method)
+
+    if not groups:
+        return []
+
+    pool = ThreadPool(max(1, min(workers, len(groups))))
+    try:
+        return pool.map(transfer, list(enumerate(groups)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _finish_sync(manifest_file, manifest, new_manifest, groups, results):
+    for result in results:
+        if result.ok:
+            continue
+
+        # Keep the old state so these files are transferred again next time
+        for (name, _) in groups[result.index][1]:
+            if name in manifest:
+                new_manifest[name] = manifest[name]
+            else:
+                del new_manifest[name]
+
+    save_manifest(manifest_file, new_manifest)
+
+    failed = [x for x in results if not x.ok]
+    if failed:
+        error = AssetSyncError('%d of %d shards failed: %s' % (
+            len(failed), len(results), '; '.join(str(x.error)
+                                                 for x in failed)))
+        error.results = results
+        raise error
+
+    return results
+
+
+def _changed(source, dest, manifest_file, full, checksum):
+    if manifest_file is None:
+        manifest_file = manifest_path(source, dest)
+
+    (host, source_path) = split_remote(source)
+    manifest = {} if full else verify_manifest(load_manifest(manifest_file),
+                                               dest)
+    listing = list_tree(source)
+    (changed, new_manifest) = changed_entries(
+        listing, manifest,
+        source_path=source_path if checksum and not host else None)
+
+    if not isdir(dest):
+        os.makedirs(dest)
+
+    return (manifest_file, manifest, changed, new_manifest)
+
+
+def sync_tree(source, dest, workers=4, manifest_file=None, full=False,
+              checksum=False):
+    """Synchronises the files under source (a local path or host:path) into
+         dest, transferring only files that are new or changed since the last
+         sync according to a persisted manifest, checked against what dest
+         holds. The changed files are split into shards of similar size
+         that are transferred by parallel rsync processes. Nothing is
+         deleted from dest.
+
+    Arguments:
+    source -- str, local path or SSH style host:path
+    dest   -- str, local destination directory
+
+    Keyword Arguments:
+    workers       -- int, number of shards transferred at once
+    manifest_file -- str, manifest to use. Defaults to one per source and
+                     dest in DEFAULT_MANIFEST_DIR.
+    full          -- bool, ignore the manifest and hand every file to rsync
+                     (which still skips identical files)
+    checksum      -- bool, for local sources, compare content hashes of
+                     files whose mtime changed but size did not
+
+    Returns a list of ShardResult. Raises AssetSyncError after all shards
+      finished if any failed; files of failed shards are retried on the next
+      run.
+    """
+    (manifest_file, manifest, changed, new_manifest) = _changed(
+        source, dest, manifest_file, full, checksum)
+    groups = [('rsync', x) for x in make_shards(changed, workers)]
+    results = _run_groups(source, dest, groups, workers)
+
+    return _finish_sync(manifest_file, manifest, new_manifest, groups,
+                        results)
+
+
+def sync_tree_bundled(source, dest, workers=4, small_file_size=256 * 1024,
+                      batch_bytes=64 * 1024 * 1024, batch_files=20000,
+                      manifest_file=None, full=False, checksum=False):
+    """Like sync_tree(), for trees of many small files such as image
+         thumbnails. Changed files smaller than small_file_size are packed
+         into tar streams of up to batch_files files and batch_bytes bytes,
+         read from a tar process at the source (over ssh for host:path) and
+         unpacked in-process at dest, so each batch costs one round trip.
+         Larger files are transferred by rsync, sharded as in sync_tree().
+
+    Needs tar at the source. See sync_tree() for the other arguments and
+      the return value.
+    """
+    (manifest_file, manifest, changed, new_manifest) = _changed(
+        source, dest, manifest_file, full, checksum)
+    small = [x for x in changed if x[1] < small_file_size]
+    large = [x for x in changed if x[1] >= small_file_size]
+    groups = [('tar', x) for x in make_batches(small, batch_bytes,
+                                                batch_files)]
+    groups += [('rsync', x) for x in make_shards(large, workers)]
+    results = _run_groups(source, dest, groups, workers)
+
+    return _finish_sync(manifest_file, manifest, new_manifest, groups,
+                        results)
@@ -0,0 +1,154 @@
+#coding: utf-8
+"""asyncio interface to Drush. Requires Python 3.5 or newer."""
+
+from shlex import split as shell_split
+import asyncio
+import os
+import signal
+import time
+
+from webappman.drupal import (Drush, DrushError, DrushMultiSiteError,
+                              SiteResult)
+from webappman.instrument import operation
+
+
+class AsyncDrush(Drush):
+    """Drush whose command methods are coroutines. Sites are run
+         concurrently, at most max_workers at a time, with
+         asyncio.create_subprocess_exec so the event loop is never blocked.
+
+    Cancelling a coroutine kills the drush processes it started.
+
+    drush = AsyncDrush('/var/www/site', max_workers=8)
+    await drush.cc()
+    output = await drush.command_output('status')
+    """
+
+    def __init__(self, path, verbose=False, stdout=None, max_workers=4,
+                 sites=None, shard=None, query_ttl=60):
+        """
+
+        Arguments:
+        path -- Path to target Drupal installation.
+
+        Keyword Arguments:
+        verbose     -- If verbose mode should be used with the drush command.
+        stdout      -- Where standard output should be written to. None for
+                        current terminal.
+        max_workers -- int, number of drush processes that may run at the
+                        same time.
+        sites       -- Sites that commands run against. See
+                        Drush.select_sites().
+        shard       -- This node's share of the sites. See
+                        Drush.select_sites().
+        query_ttl   -- float, see Drush.__init__(). The query methods are
+                        inherited and block.
+        """
+        Drush.__init__(self, path, verbose=verbose, stdout=stdout,
+                       max_workers=max_workers, sites=sites, shard=shard,
+                       query_ttl=query_ttl)
+
+    async def _exec(self, command_line, semaphore, site=None):
+        """Runs a command line and returns (returncode, elapsed, stdout,
+             stderr) with the output as bytes."""
+        async with semaphore:
+            with operation('drush', site=site,
+                           command=' '.join(command_line)) as record:
+                ret = await self._exec_process(command_line)
+                record['exit_code'] = ret[0]
+
+            return ret
+
+    async def _exec_process(self, command_line):
+        start = time.time()
+        proc = await asyncio.create_subprocess_exec(
+            *command_line,
+            cwd=self._path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True)
+
+        try:
+            stdout, stderr = await proc.communicate()
+        except asyncio.CancelledError:
+            # drush is usually a wrapper script around php, so the whole
+            #   process group has to go
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            await proc.wait()
+            raise
+
+        return (proc.returncode, time.time() - start, stdout, stderr)
+
+    async def _fan_out(self, string_as_is, once, max_workers):
+        """Runs a command against the default site and every URI. Returns a
+             list of (uri, command_line, returncode, elapsed, stdout,
+             stderr)."""
+        split = shell_split(string_as_is)
+        semaphore = asyncio.Semaphore(max_workers or self._max_workers)
+
+        async def run(uri):
+            command_line = self._command_line(split, uri)
+            ret = await self._exec(command_line, semaphore,
+                                   site=uri or 'default')
+            return (uri, command_line) + ret
+
+        return await asyncio.gather(*[run(uri)
+                                      for uri in self._site_uris(once)])
+
+    async def command(self, string_as_is, ignore_errors=False, once=False,
+                      max_workers=None):
+        """Like Drush.command() in parallel mode: returns a list of SiteResult
+             and raises DrushMultiSiteError when any site fails, unless
+             ignore_errors is True."""
+        self.invalidate_queries()
+        results = []
+
+        for (uri, command_line, returncode, elapsed, stdout, stderr) in \
+                await self._fan_out(string_as_is, once, max_workers):
+            result = SiteResult(uri or 'default', command_line, returncode,
+                                elapsed,
+                                stdout.decode('utf-8', 'replace'),
+                                stderr.decode('utf-8', 'replace'))
+            self._write_site_output(result)
+            results.append(result)
+
+        if not ignore_errors and not all(x.ok for x in results):
+            raise DrushMultiSiteError(results)
+
+        return results
+
+    async def command_output(self, string_as_is, once=False,
+                             max_workers=None):
+        """Like Drush.command_output(): [(site_name, stripped_data)]"""
+        return [(uri or 'default', stdout.strip())
+                for (uri, _, _, _, stdout, _)
+                in await self._fan_out(string_as_is, once, max_workers)]
+
+    def batch(self, ignore_errors=False, once=False):
+        # The coroutines run commands right away, so a batch would stay
+        #   empty
+        raise DrushError('Batch mode is not supported by AsyncDrush')
+
+    def deferred(self, ignore_errors=False):
+        raise DrushError('Deferred mode is not supported by AsyncDrush')
+
+    async def rr(self):
+        return await self.command('rr')
+
+    async def cc(self, which='all'):
+        return await self.command('cc %s' % (which))
+
+    async def vset(self, variable_name, value):
+        return await self.command(self._vset_command(variable_name, value))
+
+    async def updb(self):
+        return await self.command('updb -y')
+
+    async def en(self, module_name):
+        return await self.command('en -y %s' % (module_name))
+
+    async def dis(self, module_name):
+        return await self.command('dis -y %s' % (module_name))
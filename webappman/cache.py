@@ -0,0 +1,365 @@
+#coding: utf-8
+"""Content-addressed local cache for downloaded artifacts"""
+
+from contextlib import contextmanager
+from os.path import expanduser, isdir, join as path_join
+from shutil import copyfileobj
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from webappman.instrument import operation
+
+DEFAULT_CACHE_DIR = path_join(expanduser('~'), '.cache', 'webappman',
+                              'artifacts')
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024  # 1 GiB
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class ArtifactCacheError(Exception):
+    pass
+
+
+class ChecksumError(ArtifactCacheError):
+    pass
+
+
+def _stream_sha256(f):
+    h = hashlib.sha256()
+
+    for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+        h.update(chunk)
+
+    return h.hexdigest()
+
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return _stream_sha256(f)
+
+
+class ArtifactCache(object):
+    """Cache of downloads keyed by URI. Files are stored once per SHA-256
+         digest, so two URIs serving the same content share a file. The
+         least recently used entries are evicted once the cache grows past
+         max_size.
+
+    The cache is safe to share between threads and between processes on the
+      same host.
+
+    cache = ArtifactCache(max_size=512 * 1024 * 1024)
+    cache.fetch('http://example.com/lib.zip', 'lib.zip')
+    """
+    _path = None
+    _max_size = None
+    _offline = False
+    _lock = None
+    _uri_locks = None
+    _verified = None
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE,
+                 offline=False):
+        """
+
+        Keyword Arguments:
+        path     -- str, cache directory. Created when first used.
+        max_size -- int, size cap in bytes. None for no limit.
+        offline  -- bool, never download; only serve from the cache and raise
+                    ArtifactCacheError on a miss.
+        """
+        self._path = path
+        self._max_size = max_size
+        self._offline = offline
+        self._lock = threading.Lock()
+        self._uri_locks = {}
+        self._verified = {}
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def offline(self):
+        return self._offline
+
+    def _blob_path(self, digest):
+        return path_join(self._path, 'objects', digest[:2], digest)
+
+    def _index_path(self):
+        return path_join(self._path, 'index.json')
+
+    def _makedirs(self, path):
+        if not isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise e
+
+    @contextmanager
+    def _flocked(self, path):
+        with open(path, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def _locked(self):
+        """Holds both the thread lock and an exclusive lock on the cache
+             directory for other processes."""
+        self._makedirs(self._path)
+
+        with self._lock:
+            with self._flocked(path_join(self._path, 'lock')):
+                yield
+
+    @contextmanager
+    def _uri_locked(self, uri):
+        """Serialises fetching one URI across threads and processes, so
+             concurrent misses download it once. Other URIs are not
+             blocked."""
+        locks_dir = path_join(self._path, 'locks')
+        self._makedirs(locks_dir)
+
+        with self._lock:
+            lock = self._uri_locks.setdefault(uri, threading.Lock())
+
+        name = hashlib.sha1(uri.encode('utf-8')).hexdigest()
+
+        with lock:
+            with self._flocked(path_join(locks_dir, name)):
+                yield
+
+    def _read_index(self):
+        try:
+            with open(self._index_path()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        fd, tmp_path = tempfile.mkstemp(dir=self._path, prefix='.index-')
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+
+        os.rename(tmp_path, self._index_path())
+
+    def _evict(self, index, keep=None):
+        """Removes least recently used entries from index (in place) and
+             their files until the cache fits max_size. The entry for URI
+             keep is never evicted."""
+        if self._max_size is None:
+            return
+
+        sizes = {}
+        for entry in index.values():
+            sizes[entry['sha256']] = entry['size']
+
+        total = sum(sizes.values())
+        by_age = sorted(index.items(), key=lambda x: x[1]['last_used'])
+
+        for (uri, entry) in by_age:
+            if total <= self._max_size:
+                break
+
+            if uri == keep:
+                continue
+
+            del index[uri]
+            digest = entry['sha256']
+
+            if any(x['sha256'] == digest for x in index.values()):
+                continue
+
+            total -= sizes[digest]
+            try:
+                os.remove(self._blob_path(digest))
+            except OSError:
+                pass
+
+    def _download(self, uri):
+        """Streams uri into a temporary file in the cache directory. Returns
+             (temporary path, SHA-256 digest, size)."""
+        fd, tmp_path = tempfile.mkstemp(dir=self._path, prefix='.dl-')
+        h = hashlib.sha256()
+        size = 0
+
+        try:
+            with operation('download', uri=uri) as record:
+                response = urlopen(uri)
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in iter(lambda: response.read(_CHUNK_SIZE),
+                                      b''):
+                        h.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+                response.close()
+                record['bytes'] = size
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        return (tmp_path, h.hexdigest(), size)
+
+    def _blob_key(self, f):
+        """Identifies the version of an open blob checked by _verify()"""
+        st = os.fstat(f.fileno())
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _verify(self, blob, f, digest):
+        """Checks the open blob f against digest. A blob is hashed once per
+             process unless it is replaced or modified, not on every hit."""
+        key = self._blob_key(f)
+
+        with self._lock:
+            if self._verified.get(blob) == key:
+                return True
+
+        valid = _stream_sha256(f) == digest
+        f.seek(0)
+
+        if valid:
+            with self._lock:
+                self._verified[blob] = key
+
+        return valid
+
+    def _open_cached(self, uri, sha256=None):
+        """Returns an open file object for a valid cached copy of uri, or
+             None. The index is replaced atomically and an open blob stays
+             readable if it is evicted, so the lock is only taken to update
+             the index."""
+        entry = self._read_index().get(uri)
+
+        if not entry or (sha256 and entry['sha256'] != sha256):
+            return None
+
+        digest = entry['sha256']
+        blob = self._blob_path(digest)
+
+        try:
+            f = open(blob, 'rb')
+        except IOError:
+            return None
+
+        try:
+            valid = self._verify(blob, f, digest)
+        except Exception:
+            f.close()
+            raise
+
+        with self._locked():
+            index = self._read_index()
+            entry = index.get(uri)
+
+            if entry and entry['sha256'] == digest:
+                if valid:
+                    entry['last_used'] = time.time()
+                else:
+                    del index[uri]
+                self._write_index(index)
+
+        if not valid:
+            f.close()
+            return None
+
+        return f
+
+    def open(self, uri, sha256=None):
+        """Returns a binary file object with the contents of uri, downloading
+             it first on a cache miss.
+
+        Arguments:
+        uri -- str, URI to download
+
+        Keyword Arguments:
+        sha256 -- str, expected hex digest. A download that does not match
+                  raises ChecksumError and is not cached.
+
+        When several threads or processes miss the same URI at once, one
+          downloads it and the others wait and read the cached copy.
+        """
+        f = self._open_cached(uri, sha256=sha256)
+
+        if f:
+            return f
+
+        with self._uri_locked(uri):
+            return self._open_miss(uri, sha256)
+
+    def _open_miss(self, uri, sha256):
+        # Another thread or process may have downloaded it while this one
+        #   waited for the URI lock
+        f = self._open_cached(uri, sha256=sha256)
+
+        if f:
+            return f
+
+        if self._offline:
+            raise ArtifactCacheError('%s is not cached and the cache is in '
+                                     'offline mode' % (uri))
+
+        (tmp_path, digest, size) = self._download(uri)
+
+        if sha256 and digest != sha256:
+            os.remove(tmp_path)
+            raise ChecksumError('Checksum mismatch for %s: expected %s, got '
+                                '%s' % (uri, sha256, digest))
+
+        with self._locked():
+            blob = self._blob_path(digest)
+
+            if not isdir(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob))
+
+            os.rename(tmp_path, blob)
+
+            index = self._read_index()
+            index[uri] = {
+                'sha256': digest,
+                'size': size,
+                'last_used': time.time(),
+            }
+            self._evict(index, keep=uri)
+            self._write_index(index)
+
+            # Open while locked so another process cannot evict it first.
+            #   It was hashed while downloading.
+            f = open(blob, 'rb')
+
+        with self._lock:
+            self._verified[blob] = self._blob_key(f)
+
+        return f
+
+    def fetch(self, uri, target, sha256=None):
+        """Writes the contents of uri to the target path. See open()."""
+        with self.open(uri, sha256=sha256) as src:
+            with open(target, 'wb') as dst:
+                copyfileobj(src, dst, _CHUNK_SIZE)
+
+    def clear(self):
+        """Removes every entry from the cache."""
+        with self._locked():
+            index = self._read_index()
+
+            for entry in index.values():
+                try:
+                    os.remove(self._blob_path(entry['sha256']))
+                except OSError:
+                    pass
+
+            self._write_index({})
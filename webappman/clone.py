@@ -0,0 +1,193 @@
+#coding: utf-8
+"""Cloning of directory trees by reflink, hard link or copy"""
+
+from os.path import isdir, join as path_join, relpath
+from shutil import copy2 as copy_file, rmtree as rmdir_force
+import errno
+import os
+import stat
+import subprocess as sp
+import tempfile
+try:
+    from os import replace as replace_file
+except ImportError:
+    from os import rename as replace_file
+
+CLONE_MODES = ('auto', 'reflink', 'hardlink', 'copy')
+
+
+class CloneError(Exception):
+    pass
+
+
+def _is_under(rel_path, prefixes):
+    for prefix in prefixes:
+        if rel_path == prefix or rel_path.startswith(prefix + os.sep):
+            return True
+
+    return False
+
+
+def _clear_dir(path):
+    for name in os.listdir(path):
+        entry = path_join(path, name)
+
+        if isdir(entry) and not os.path.islink(entry):
+            rmdir_force(entry)
+        else:
+            os.remove(entry)
+
+
+def _reflink_tree(src, dst):
+    # GNU cp fails instead of falling back to a full copy with
+    #   --reflink=always when the file system cannot share extents. src/.
+    #   copies the contents into the existing dst, not into dst/<src>.
+    with open(os.devnull, 'w') as devnull:
+        sp.check_call(['cp', '-a', '--reflink=always',
+                       path_join(src, '.'), dst], stderr=devnull)
+
+
+def _link_tree(src, dst, link, copy_paths=()):
+    dir_modes = []
+
+    for (dir_path, dir_names, file_names) in os.walk(src):
+        rel_dir = relpath(dir_path, src)
+        if rel_dir == '.':
+            target_dir = dst
+        else:
+            target_dir = path_join(dst, rel_dir)
+            os.makedirs(target_dir)
+        dir_modes.append((target_dir,
+                          stat.S_IMODE(os.stat(dir_path).st_mode)))
+
+        for name in dir_names + file_names:
+            source = path_join(dir_path, name)
+            target = path_join(target_dir, name)
+
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+            elif name in file_names:
+                rel_path = relpath(source, src)
+
+                if _is_under(rel_path, copy_paths):
+                    copy_file(source, target)
+                else:
+                    link(source, target)
+
+    # Applied last so read-only directories can still be filled
+    for (target_dir, mode) in reversed(dir_modes):
+        os.chmod(target_dir, mode)
+
+
+def clone_tree(src, dst, mode='auto', copy_paths=()):
+    """Makes dst a clone of the directory src. dst is created if missing;
+         if it exists it must be an empty directory. After a failure dst is
+         left as it was found: removed if it was created, emptied
+         otherwise.
+
+    Modes:
+    reflink  -- copy-on-write clone (btrfs, XFS with reflink); files share
+                disk blocks until one side writes to them
+    hardlink -- files are hard links to the files in src, sharing both disk
+                blocks and page cache. Writing to a file in place changes it
+                in src too, so use unshare() before patching a file.
+    copy     -- plain copy
+    auto     -- the first of the above that works for src and dst
+
+    Keyword Arguments:
+    mode       -- str, one of CLONE_MODES
+    copy_paths -- list of paths relative to src that are always copied when
+                  hard linking (for example 'sites', which gets written to)
+
+    Returns the mode that was used.
+    """
+    if mode not in CLONE_MODES:
+        raise CloneError('Unknown clone mode %s' % (mode))
+
+    created = not os.path.lexists(dst)
+
+    if created:
+        os.makedirs(dst)
+    elif not isdir(dst) or os.listdir(dst):
+        raise CloneError('%s exists and is not an empty directory' % (dst))
+
+    def reset():
+        # Only what this call put there goes
+        if created:
+            rmdir_force(dst)
+            os.makedirs(dst)
+        else:
+            _clear_dir(dst)
+
+    try:
+        if mode in ('auto', 'reflink'):
+            try:
+                _reflink_tree(src, dst)
+                return 'reflink'
+            except (OSError, sp.CalledProcessError) as e:
+                reset()
+                if mode == 'reflink':
+                    raise CloneError('Reflink clone of %s failed: %s' %
+                                     (src, e))
+
+        if mode in ('auto', 'hardlink'):
+            try:
+                _link_tree(src, dst, os.link, copy_paths=copy_paths)
+                return 'hardlink'
+            except OSError as e:
+                reset()
+                if mode == 'hardlink' or e.errno not in (errno.EXDEV,
+                                                         errno.EPERM,
+                                                         errno.EMLINK):
+                    raise e
+
+        _link_tree(src, dst, copy_file)
+        return 'copy'
+    except Exception:
+        if created:
+            rmdir_force(dst)
+        else:
+            _clear_dir(dst)
+        raise
+
+
+def unshare(path):
+    """Breaks the hard link of a file cloned with clone_tree() by replacing it
+         with a private, writable copy. Call this before modifying a file in
+         place. Files replaced by rename (new file, then os.replace()) do not
+         need it.
+
+    Returns True if the file was shared.
+    """
+    if os.lstat(path).st_nlink < 2:
+        return False
+
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix='.%s-' % (os.path.basename(path)))
+    os.close(fd)
+
+    try:
+        copy_file(path, tmp_path)
+        os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode) | stat.S_IWUSR)
+        replace_file(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    return True
+
+
+def make_read_only(path):
+    """Removes write permission from every file under path, so files hard
+         linked from it cannot be changed in place by accident (by users
+         other than root)."""
+    mask = ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+    for (dir_path, _, file_names) in os.walk(path):
+        for name in file_names:
+            file_path = path_join(dir_path, name)
+
+            if not os.path.islink(file_path):
+                os.chmod(file_path,
+                         stat.S_IMODE(os.stat(file_path).st_mode) & mask)
@@ -0,0 +1,432 @@
+#coding: utf-8
+"""Parallel per-table snapshots of a MySQL database, for cloning a Drupal
+     site's database next to its docroot without going through drush
+     sql-dump"""
+
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
+from os.path import getsize, join as path_join
+import gzip
+import json
+import os
+import time
+try:
+    from os import replace as replace_file
+except ImportError:
+    from os import rename as replace_file
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+try:
+    from MySQLdb.cursors import SSCursor
+except ImportError:
+    SSCursor = None
+
+from webappman.instrument import operation
+
+MANIFEST_FILE = 'snapshot.json'
+
+# Tables whose rows are not worth copying to another environment. Their
+#   structure is still kept so the restored site works.
+DEFAULT_STRUCTURE_ONLY = (
+    'cache',
+    'cache_*',
+    'sessions',
+    'watchdog',
+)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class TableResult(object):
+    """What happened to one table during snapshot() or restore()"""
+    table = None
+    rows = 0
+    bytes = 0
+    data = True
+    duration = None
+
+    def __init__(self, table, rows=0, bytes=0, data=True, duration=None):
+        self.table = table
+        self.rows = rows
+        self.bytes = bytes
+        self.data = data
+        self.duration = duration
+
+    def __repr__(self):
+        return '<TableResult %s %d rows>' % (self.table, self.rows)
+
+
+def _quote_name(name):
+    return '`%s`' % (name.replace('`', '``'))
+
+
+def _matches(name, patterns, prefix):
+    if prefix and name.startswith(prefix):
+        name = name[len(prefix):]
+
+    return any(fnmatch(name, x) for x in patterns)
+
+
+def _literal(connection, value):
+    ret = connection.literal(value)
+
+    if not isinstance(ret, bytes):
+        ret = ret.encode('utf-8')
+
+    return ret
+
+
+def _run_tables(connections, func, tables):
+    """Calls func(connection, table) for every table, each worker thread
+         holding one of connections at a time. Raises SnapshotError with
+         the exceptions in its ``errors`` attribute as (table, exception)
+         after every table was tried."""
+    idle = Queue()
+    for connection in connections:
+        idle.put(connection)
+
+    def apply(table):
+        connection = idle.get()
+
+        try:
+            return (table, func(connection, table), None)
+        except Exception as e:
+            return (table, None, e)
+        finally:
+            idle.put(connection)
+
+    pool = ThreadPool(len(connections))
+    try:
+        results = pool.map(apply, tables, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    errors = [(table, e) for (table, _, e) in results if e is not None]
+
+    if errors:
+        error = SnapshotError('Failed on table(s) %s' % (', '.join(
+            str(table) for (table, _) in errors)))
+        error.errors = errors
+        raise error
+
+    return [result for (_, result, _) in results]
+
+
+def _list_tables(connection):
+    """Returns (name, data length) of the base tables of the current
+         database, largest first so the big tables do not end up last."""
+    c = connection.cursor()
+
+    try:
+        c.execute('SELECT TABLE_NAME, DATA_LENGTH FROM '
+                  'information_schema.TABLES WHERE TABLE_SCHEMA = '
+                  'DATABASE() AND TABLE_TYPE = \'BASE TABLE\'')
+        rows = c.fetchall()
+    finally:
+        c.close()
+
+    return sorted(((name, int(size or 0)) for (name, size) in rows),
+                  key=lambda x: (-x[1], x[0]))
+
+
+def _close_all(connections):
+    for connection in connections:
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+def _dump_table(connection, table, path, data, chunk_rows,
+                statement_bytes, compresslevel, cursor_class):
+    c = connection.cursor()
+    try:
+        c.execute('SHOW CREATE TABLE %s' % (_quote_name(table)))
+        schema = c.fetchone()[1]
+    finally:
+        c.close()
+
+    if not data:
+        return (schema, TableResult(table, data=False))
+
+    rows = 0
+    tmp_path = '%s.tmp' % (path)
+    head = ('INSERT INTO %s VALUES ' % (_quote_name(table))).encode('utf-8')
+    c = connection.cursor(cursor_class) if cursor_class else \
+        connection.cursor()
+
+    with operation('mysql', statement='snapshot', table=table) as record:
+        try:
+            with gzip.open(tmp_path, 'wb', compresslevel) as f:
+                c.execute('SELECT * FROM %s' % (_quote_name(table)))
+                values = []
+                size = 0
+
+                while True:
+                    chunk = c.fetchmany(chunk_rows)
+                    if not chunk:
+                        break
+
+                    for row in chunk:
+                        value = b'(' + b','.join(
+                            _literal(connection, x) for x in row) + b')'
+                        values.append(value)
+                        size += len(value) + 1
+
+                        if size >= statement_bytes:
+                            f.write(head + b','.join(values) + b';\n')
+                            values = []
+                            size = 0
+
+                    rows += len(chunk)
+
+                if values:
+                    f.write(head + b','.join(values) + b';\n')
+
+            replace_file(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            c.close()
+
+        record['rows'] = rows
+        record['bytes'] = getsize(path)
+
+    return (schema, TableResult(table, rows=rows, bytes=record['bytes']))
+
+
+def snapshot(connect, directory, workers=4, skip_tables=(),
+             structure_only=DEFAULT_STRUCTURE_ONLY, prefix='',
+             consistent=False, chunk_rows=1000,
+             statement_bytes=1024 * 1024, compresslevel=6,
+             cursor_class=SSCursor):
+    """Dumps every base table of a database into directory, several tables
+         at a time. Each table's rows go to <table>.sql.gz as multi-row
+         INSERT statements, one per line; table definitions and row counts
+         go to snapshot.json, which is written last. Rows are streamed from
+         the server (with cursor_class, an unbuffered cursor by default)
+         chunk_rows at a time, so large tables are never held in memory.
+
+    import functools, MySQLdb
+    connect = functools.partial(MySQLdb.connect, db='example_com',
+                                charset='utf8')
+    snapshot(connect, '/var/backups/example.com/2014-01-10')
+
+    Arguments:
+    connect   -- callable returning a new MySQLdb connection to the database
+                 to dump. It is called once per worker.
+    directory -- str, where to write the snapshot. Created if missing.
+
+    Keyword Arguments:
+    workers         -- int, number of tables dumped at once
+    skip_tables     -- fnmatch patterns of tables left out entirely
+    structure_only  -- fnmatch patterns of tables whose rows are left out
+                       (they are restored empty)
+    prefix          -- str, Drupal table prefix. It is removed from table
+                       names before matching the patterns.
+    consistent      -- bool, take the snapshot of every table at the same
+                       point in time: all workers start a consistent
+                       snapshot transaction while FLUSH TABLES WITH READ
+                       LOCK is held briefly. Needs the RELOAD privilege and
+                       only works for InnoDB tables.
+    chunk_rows      -- int, number of rows fetched at a time
+    statement_bytes -- int, approximate size of each INSERT. Keep it well
+                       under max_allowed_packet of the server restored to.
+    compresslevel   -- int, gzip compression level
+    cursor_class    -- MySQLdb cursor class used to read rows, or None for
+                       the connection's default cursor
+
+    Returns a list of TableResult. If any table fails, SnapshotError is
+      raised after all tables are done, with the exceptions in its
+      ``errors`` attribute as (table, exception), and no snapshot.json is
+      written.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    coordinator = connect()
+    connections = []
+
+    try:
+        tables = [(name, size) for (name, size) in _list_tables(coordinator)
+                  if not _matches(name, skip_tables, prefix)]
+        charset = getattr(coordinator, 'character_set_name', None)
+        charset = charset() if charset else None
+
+        if consistent:
+            c = coordinator.cursor()
+            c.execute('FLUSH TABLES WITH READ LOCK')
+
+        for _ in range(max(1, min(workers, len(tables)))):
+            connections.append(connect())
+
+        if consistent:
+            for connection in connections:
+                worker_cursor = connection.cursor()
+                worker_cursor.execute('SET SESSION TRANSACTION ISOLATION '
+                                      'LEVEL REPEATABLE READ')
+                worker_cursor.execute('START TRANSACTION WITH CONSISTENT '
+                                      'SNAPSHOT')
+                worker_cursor.close()
+
+            c.execute('UNLOCK TABLES')
+            c.close()
+    except Exception:
+        _close_all(connections)
+        raise
+    finally:
+        _close_all([coordinator])
+
+    names = [name for (name, _) in tables]
+
+    def dump(connection, table):
+        start = time.time()
+        data = not _matches(table, structure_only, prefix)
+        (schema, result) = _dump_table(
+            connection, table, path_join(directory, '%s.sql.gz' % (table)),
+            data, chunk_rows, statement_bytes, compresslevel, cursor_class)
+        result.duration = time.time() - start
+
+        return (schema, result)
+
+    try:
+        dumped = _run_tables(connections, dump, names)
+    finally:
+        _close_all(connections)
+
+    manifest = {
+        'created': time.time(),
+        'charset': charset,
+        'tables': [{
+            'name': result.table,
+            'schema': schema,
+            'data': result.data,
+            'rows': result.rows,
+            'file': '%s.sql.gz' % (result.table) if result.data else None,
+        } for (schema, result) in dumped],
+    }
+    manifest_path = path_join(directory, MANIFEST_FILE)
+
+    with open('%s.tmp' % (manifest_path), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    replace_file('%s.tmp' % (manifest_path), manifest_path)
+
+    return [result for (_, result) in dumped]
+
+
+def read_manifest(directory):
+    """Returns the parsed snapshot.json of a snapshot directory."""
+    path = path_join(directory, MANIFEST_FILE)
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        raise SnapshotError('%s is not a complete snapshot' % (directory))
+
+
+def _load_table(connection, entry, directory, drop, commit_every):
+    table = entry['name']
+    rows = 0
+    c = connection.cursor()
+
+    with operation('mysql', statement='restore', table=table) as record:
+        try:
+            # Keep explicit zeroes in AUTO_INCREMENT columns (Drupal's
+            #   anonymous user is uid 0)
+            c.execute('SET SESSION sql_mode = \'NO_AUTO_VALUE_ON_ZERO\'')
+            c.execute('SET FOREIGN_KEY_CHECKS = 0')
+            c.execute('SET UNIQUE_CHECKS = 0')
+
+            if drop:
+                c.execute('DROP TABLE IF EXISTS %s' % (_quote_name(table)))
+            c.execute(entry['schema'])
+
+            if entry.get('file'):
+                path = path_join(directory, entry['file'])
+                statements = 0
+
+                with gzip.open(path, 'rb') as f:
+                    for line in f:
+                        c.execute(line.rstrip(b'\n').rstrip(b';'))
+                        statements += 1
+
+                        if statements % commit_every == 0:
+                            connection.commit()
+
+                record['bytes'] = getsize(path)
+
+            connection.commit()
+            rows = entry.get('rows', 0)
+            record['rows'] = rows
+        finally:
+            c.close()
+
+    return TableResult(table, rows=rows, bytes=record.get('bytes', 0),
+                       data=entry.get('data', True))
+
+
+def restore(connect, directory, workers=4, tables=None, drop=True,
+            commit_every=20):
+    """Loads a snapshot written by snapshot() into the database connect
+         connects to, several tables at a time. Foreign key and unique
+         checks are disabled while loading.
+
+    Arguments:
+    connect   -- callable returning a new MySQLdb connection to the target
+                 database. It is called once per worker. Use the same
+                 character set the snapshot was taken with.
+    directory -- str, snapshot directory
+
+    Keyword Arguments:
+    workers      -- int, number of tables loaded at once
+    tables       -- list of table names to restore, or None for all
+    drop         -- bool, drop existing tables before creating them
+    commit_every -- int, number of INSERT statements per transaction
+
+    Returns a list of TableResult. If any table fails, SnapshotError is
+      raised after all tables are done, with the exceptions in its
+      ``errors`` attribute as (table, exception).
+    """
+    manifest = read_manifest(directory)
+    entries = manifest['tables']
+
+    if tables is not None:
+        unknown = set(tables) - set(x['name'] for x in entries)
+        if unknown:
+            raise SnapshotError('Not in the snapshot: %s' % (', '.join(
+                sorted(unknown))))
+        entries = [x for x in entries if x['name'] in tables]
+
+    if not entries:
+        return []
+
+    by_name = dict((x['name'], x) for x in entries)
+    connections = []
+
+    try:
+        for _ in range(min(workers, len(entries))):
+            connections.append(connect())
+
+        charset = getattr(connections[0], 'character_set_name', None)
+        charset = charset() if charset else None
+
+        if manifest.get('charset') and charset and \
+                charset != manifest['charset']:
+            raise SnapshotError(
+                'The snapshot was taken with character set %s but the '
+                'connection uses %s' % (manifest['charset'], charset))
+
+        return _run_tables(connections, lambda connection, table: _load_table(
+            connection, by_name[table], directory, drop, commit_every),
+            [x['name'] for x in entries])
+    finally:
+        _close_all(connections)
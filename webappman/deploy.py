@@ -0,0 +1,377 @@
+#coding: utf-8
+"""Declarative Drupal deployments run as a graph of dependent tasks"""
+
+from multiprocessing.pool import ThreadPool
+from os.path import isdir
+from shutil import rmtree as rmdir_force
+import json
+import os
+import threading
+import time
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from webappman.drupal import (Drush, iter_settings_files,
+                              write_rendered_settings_files)
+from webappman.release import Releases
+
+
+class DeployError(Exception):
+    pass
+
+
+class Task(object):
+    """A unit of work in a TaskGraph. start and end are Unix times, set once
+         the task ran."""
+    name = None
+    func = None
+    deps = None
+    start = None
+    end = None
+    result = None
+    error = None
+    skipped = False
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return None
+
+        return self.end - self.start
+
+    def __repr__(self):
+        return '<Task %s>' % (self.name)
+
+
+class TaskGraph(object):
+    """Tasks with dependencies, run in parallel as soon as everything they
+         depend on finished.
+
+    graph = TaskGraph()
+    graph.add('core', drush.init_dir)
+    graph.add('views', lambda: drush.dl('views'), deps=['core'])
+    graph.run(max_workers=4)
+    graph.critical_path()  # [Task core, Task views]
+    """
+    tasks = None
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, func, deps=()):
+        """Adds a task. func is called without arguments and its return value
+             is kept as the task's result.
+
+        Arguments:
+        name -- str, unique task name
+        func -- callable
+
+        Keyword Arguments:
+        deps -- names of tasks that must finish first. They may be added
+                later.
+        """
+        if name in self.tasks:
+            raise DeployError('Duplicate task %s' % (name))
+
+        task = self.tasks[name] = Task(name, func, deps)
+
+        return task
+
+    def order(self):
+        """Returns the tasks in an order that respects dependencies. Raises
+             DeployError for unknown dependencies and cycles."""
+        ret = []
+        state = {}
+
+        def visit(task, path):
+            if state.get(task.name) == 'done':
+                return
+            if state.get(task.name) == 'visiting':
+                raise DeployError('Dependency cycle: %s' %
+                                  (' -> '.join(path + [task.name])))
+
+            state[task.name] = 'visiting'
+
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise DeployError('Task %s depends on unknown task %s' %
+                                      (task.name, dep))
+                visit(self.tasks[dep], path + [task.name])
+
+            state[task.name] = 'done'
+            ret.append(task)
+
+        for name in sorted(self.tasks):
+            visit(self.tasks[name], [])
+
+        return ret
+
+    def run(self, max_workers=4, progress=None):
+        """Runs every task, at most max_workers at a time. After a failure no
+             new tasks are started; tasks already running finish, tasks that
+             did not run are marked skipped and a DeployError listing the
+             failures is raised.
+
+        Keyword Arguments:
+        max_workers -- int, concurrency cap
+        progress    -- callable, called with each task when it starts and
+                       again when it ends
+        """
+        pending = self.order()
+        done = set()
+        failed = []
+        running = [0]
+        condition = threading.Condition()
+
+        def execute(task):
+            task.start = time.time()
+            if progress:
+                progress(task)
+
+            try:
+                task.result = task.func()
+            except Exception as e:
+                task.error = e
+            finally:
+                task.end = time.time()
+
+            if progress:
+                progress(task)
+
+            with condition:
+                running[0] -= 1
+                if task.error is None:
+                    done.add(task.name)
+                else:
+                    failed.append(task)
+                condition.notify()
+
+        pool = ThreadPool(max_workers)
+
+        try:
+            with condition:
+                while pending and not failed:
+                    ready = [x for x in pending
+                             if all(dep in done for dep in x.deps)]
+
+                    for task in ready[:max_workers - running[0]]:
+                        pending.remove(task)
+                        running[0] += 1
+                        pool.apply_async(execute, (task,))
+
+                    condition.wait()
+
+                while running[0]:
+                    condition.wait()
+        finally:
+            pool.close()
+            pool.join()
+
+        for task in pending:
+            task.skipped = True
+
+        if failed:
+            error = DeployError('%d task(s) failed: %s' % (
+                len(failed), '; '.join('%s (%s)' % (x.name, x.error)
+                                       for x in failed)))
+            error.failures = failed
+            raise error
+
+    def critical_path(self):
+        """Returns the chain of finished tasks that determined the total run
+             time: starting from the task that ended last, each step goes to
+             the dependency that ended last."""
+        finished = [x for x in self.tasks.values() if x.end is not None]
+
+        if not finished:
+            return []
+
+        task = max(finished, key=lambda x: x.end)
+        path = [task]
+
+        while True:
+            deps = [self.tasks[x] for x in task.deps
+                    if self.tasks[x].end is not None]
+            if not deps:
+                break
+
+            task = max(deps, key=lambda x: x.end)
+            path.append(task)
+
+        path.reverse()
+
+        return path
+
+
+def load_manifest(path):
+    """Reads a deploy manifest. YAML needs PyYAML; JSON always works."""
+    with open(path) as f:
+        content = f.read()
+
+    if path.endswith('.json') or yaml is None:
+        try:
+            return json.loads(content)
+        except ValueError as e:
+            if yaml is None and not path.endswith('.json'):
+                raise DeployError('PyYAML is required to read %s' % (path))
+            raise DeployError('Invalid manifest %s: %s' % (path, e))
+
+    return yaml.safe_load(content)
+
+
+def build_graph(manifest, verbose=False, stdout=None):
+    """Returns (TaskGraph, Drush) for a manifest:
+
+    target: /var/www/example.com   # Drupal root, or deployment root with
+    release: true                  #   release (see webappman.release)
+    keep_releases: 5
+    core:
+      version: '7.24'
+      clone: auto                  # optional, see Drush.init_dir()
+      cache: true
+    modules: [registry_rebuild, views, ctools]   # downloaded
+    enable: [views, ctools]        # enabled, then caches cleared once
+    libraries: [ckeditor, fancybox]
+    variables:                     # set in one batch after enabling
+      site_name: Example
+    settings:                      # see generate_settings_files()
+      default: {...}
+    shared_settings: true          # common settings in one shared include
+    assets:                        # see Drush.sync_assets()
+      - source: files.example.com:/srv/files
+        site: default
+
+    Once core is in place, module downloads, library installs, asset syncs
+      and writing settings files run concurrently; settings are rendered
+      while core downloads.
+    """
+    if 'target' not in manifest:
+        raise DeployError('The manifest has no target')
+
+    releases = None
+    target = manifest['target']
+
+    if manifest.get('release'):
+        releases = Releases(target, keep=manifest.get('keep_releases', 5))
+        build_dir = releases.new_release()
+    else:
+        build_dir = target
+
+    drush = Drush(build_dir, verbose=verbose, stdout=stdout)
+    graph = TaskGraph()
+    core = manifest.get('core', {})
+    cache = core.get('cache', True)
+    version = str(core.get('version', '7.25')).split('.')
+    minor = version[1] if version[1] == 'x' else int(version[1])
+    final = []
+
+    def init_core():
+        if not releases and isdir(build_dir) and os.listdir(build_dir):
+            rmdir_force(build_dir)
+
+        drush.init_dir(major_version=int(version[0]), minor_version=minor,
+                       cache=cache, clone=core.get('clone'))
+        drush.create_libraries_dir()
+
+    graph.add('core', init_core)
+
+    module_tasks = []
+    for module in manifest.get('modules', []):
+        name = 'dl:%s' % (module)
+        graph.add(name, lambda module=module: drush.dl(module, cache=cache),
+                  deps=['core'])
+        module_tasks.append(name)
+
+    library_tasks = []
+    for library in manifest.get('libraries', []):
+        name = 'lib:%s' % (library)
+        graph.add(name, lambda library=library: drush.install_lib(library),
+                  deps=['core'])
+        library_tasks.append(name)
+        final.append(name)
+
+    settings = manifest.get('settings')
+    shared_settings = manifest.get('shared_settings', False)
+    if settings:
+        render = graph.add('render-settings', lambda: list(
+            iter_settings_files(settings, shared_settings)))
+
+        def write():
+            return [x for x in write_rendered_settings_files(
+                render.result, build_dir) if x[2]]
+
+        graph.add('settings', write, deps=['core', 'render-settings'])
+        final.append('settings')
+
+    asset_deps = ['core']
+    if releases:
+        # Files live in the shared directory, so they are synchronised
+        #   through the link before the release goes live. Writing settings
+        #   creates the directories of the other sites.
+        graph.add('link-shared', lambda: releases.link_site_files(build_dir),
+                  deps=['core', 'settings'] if settings else ['core'])
+        asset_deps = ['link-shared']
+
+    for (i, asset) in enumerate(manifest.get('assets', [])):
+        name = 'assets:%s' % (asset.get('site', 'default'))
+        if name in graph.tasks:
+            name = '%s:%d' % (name, i)
+
+        graph.add(name, lambda asset=asset: drush.sync_assets(
+            asset['source'], domain=asset.get('site', 'default'),
+            incremental=asset.get('incremental', True)), deps=asset_deps)
+        final.append(name)
+
+    database_deps = ['core'] + module_tasks + (['settings'] if settings
+                                               else [])
+    enable = manifest.get('enable', [])
+    variables = manifest.get('variables', {})
+
+    def refresh_sites():
+        # The Drush was created before core and the settings files of the
+        #   other sites existed
+        drush.discover_sites(refresh=True)
+
+    if enable:
+        def enable_modules():
+            refresh_sites()
+
+            with drush.deferred():
+                drush.en(' '.join(enable))
+                drush.cc()
+
+        # Modules may need their libraries in place to be enabled
+        graph.add('enable', enable_modules,
+                  deps=database_deps + library_tasks)
+        final.append('enable')
+    else:
+        final.extend(module_tasks)
+
+    if variables:
+        def set_variables():
+            refresh_sites()
+
+            with drush.batch():
+                for (name, value) in sorted(variables.items()):
+                    drush.vset(name, value)
+
+        graph.add('variables', set_variables,
+                  deps=['enable'] if enable else database_deps)
+        final.append('variables')
+
+    if releases:
+        def activate():
+            releases.activate(build_dir)
+            releases.prune(background=True)
+
+        graph.add('activate', activate, deps=['core', 'link-shared'] + final)
+
+    return (graph, drush)
@@ -2,33 +2,52 @@
 """For Drupal site deployment and management"""
 
 from __future__ import print_function
+from base64 import b64encode
 from bs4 import BeautifulSoup as Soup
+from contextlib import closing, contextmanager
+from fnmatch import fnmatch
 try:
     from http.cookiejar import CookieJar
 except ImportError:
     from cookielib import CookieJar
-from os import remove as rm
-from os.path import isdir, join as path_join, realpath, basename
+from multiprocessing.pool import ThreadPool
+from os.path import basename, dirname, isdir, join as path_join, realpath
 from pipes import quote as shell_quote
-from sh import tar, unzip
 from shlex import split as shell_split
 from shutil import copy2 as copy_file, rmtree as rmdir_force
+import fcntl
+import hashlib
 import json
 import os
 import re
 import subprocess as sp
+import sys
+import tempfile
+import threading
+import time
+try:
+    from os import replace as replace_file
+except ImportError:
+    from os import rename as replace_file
 try:
     from urllib.parse import urlencode
-    from urllib.request import build_opener, HTTPCookieProcessor
+    from urllib.request import build_opener, HTTPCookieProcessor, urlopen
 except ImportError:
     from urllib import urlencode
-    from urllib2 import build_opener, HTTPCookieProcessor
+    from urllib2 import build_opener, HTTPCookieProcessor, urlopen
 
 from osext.filesystem import sync as dir_sync, isfile
 from osext.pushdcontext import pushd
 import httpext as http
 import langutil.php as php
 
+from webappman.archive import extract as extract_archive
+from webappman.assets import sync_tree
+from webappman.cache import ArtifactCache
+from webappman.clone import clone_tree, make_read_only
+from webappman.instrument import operation
+from webappman.inventory import ModuleIndex
+
 CKEDITOR_URI = 'http://download.cksource.com/CKEditor/CKEditor/' + \
     'CKEditor%203.6.6.1/ckeditor_3.6.6.1.tar.gz'
 FANCYBOX_URI = 'https://github.com/fancyapps/fancyBox/zipball/v2.1.5'
@@ -37,75 +56,144 @@ JQ_CYCLE_URI = 'http://malsup.github.com/jquery.cycle.all.js'
 PREDIS_URI = 'https://github.com/nrk/predis/zipball/v0.8.4'
 SIMPLEPIE_URI = 'http://simplepie.org/downloads/simplepie_1.3.1.compiled.php'
 
+# Pristine Drupal versions Drush.init_dir() clones new roots from
+DRUPAL_CORE_CACHE_DIR = path_join(os.path.expanduser('~'), '.cache',
+                                  'webappman', 'drupal-core')
+
+# Include holding the settings all sites share, see generate_settings_files()
+SHARED_SETTINGS_FILE = path_join('sites', 'settings.shared.php')
+
+# Cache types Drush.batch() can clear, and the PHP that does so
+_BATCH_CACHE_TYPES = {
+    'all': 'drupal_flush_all_caches();',
+    'block': "cache_clear_all(NULL, 'cache_block');",
+    'css-js': '_drupal_flush_css_js(); drupal_clear_css_cache(); '
+              'drupal_clear_js_cache();',
+    'menu': 'menu_rebuild();',
+    'module-list': 'system_rebuild_module_data();',
+    'registry': 'registry_rebuild();',
+    'theme-list': 'system_rebuild_theme_data();',
+    'theme-registry': 'drupal_theme_rebuild();',
+}
+_BATCH_REPORT_PREFIX = 'WAM-BATCH '
+# Operations are passed in as base64-encoded JSON so no value ever needs to
+#   be escaped as PHP source. One report line is printed per operation.
+_BATCH_SCRIPT = '''<?php
+$batch = json_decode(base64_decode('%(data)s'), TRUE);
+foreach ($batch['operations'] as $i => $op) {
+  $ok = TRUE;
+  $error = NULL;
+  try {
+    switch ($op[0]) {
+      case 'vset':
+        variable_set($op[1], $op[2]);
+        break;
+      case 'en':
+        $ok = module_enable($op[1]);
+        if (!$ok) {
+          $error = 'Missing dependencies for ' . implode(', ', $op[1]);
+        }
+        break;
+      case 'dis':
+        module_disable($op[1]);
+        break;
+      case 'cc':
+        switch ($op[1]) {
+%(cache_cases)s
+        }
+        break;
+    }
+  }
+  catch (Exception $e) {
+    $ok = FALSE;
+    $error = $e->getMessage();
+  }
+  print '%(prefix)s' . json_encode(array(
+    'index' => $i,
+    'ok' => $ok,
+    'error' => $error,
+  )) . "\\n";
+  if (!$ok && !$batch['ignore_errors']) {
+    exit(1);
+  }
+}
+'''
 
-def _install_ckeditor(stdout=None):
-    """Callback to install necessary library for the IMCE module"""
-    arg = 'xf'
+# Cache used by the library install callbacks. Replace it with a differently
+#   configured ArtifactCache (for example offline=True), or None to always
+#   download with httpext.
+artifact_cache = ArtifactCache()
 
-    if stdout:
-        arg += 'v'
 
-    http.dl(CKEDITOR_URI, 'ckeditor.tar.gz')
-    output = tar('xf', 'ckeditor.tar.gz')
+def _dl(uri, local_file):
+    if artifact_cache is None:
+        with operation('download', uri=uri) as record:
+            http.dl(uri, local_file)
+            record['bytes'] = os.path.getsize(local_file)
+        return
 
-    if stdout and output:
-        stdout.write(str(output).strip() + '\n')
+    artifact_cache.fetch(uri, local_file)
 
-    rm('ckeditor.tar.gz')
 
+def _open_uri(uri):
+    """Returns a file object streaming the contents of uri, from the artifact
+         cache when enabled."""
+    if artifact_cache is None:
+        return closing(urlopen(uri))
 
-def _install_jquery_colorpicker(stdout=None):
-    """Callback to install necessary library for the module"""
-    os.makedirs('./colorpicker')
-    http.dl(JQ_COLOR_PICKER_URI, './colorpicker/colorpicker.zip')
-    with pushd('./colorpicker'):
-        output = unzip('colorpicker.zip')
+    return artifact_cache.open(uri)
 
-        if stdout and output:
-            stdout.write(str(output).strip() + '\n')
 
-        rm('colorpicker.zip')
+def _install_archive(uri, format, target, strip_components=0, stdout=None):
+    with _open_uri(uri) as f:
+        paths = extract_archive(f, target, format,
+                                strip_components=strip_components)
 
+    if stdout and paths:
+        stdout.write('\n'.join(paths) + '\n')
 
-def _install_fancybox(stdout=None):
-    """Callback to install necessary library for the Fancybox module"""
-    http.dl(FANCYBOX_URI, 'fancybox.zip')
-    output = unzip('fancybox.zip')
 
-    if stdout and output:
-        stdout.write(str(output).strip() + '\n')
+def _install_ckeditor(stdout=None, path='.'):
+    """Callback to install necessary library for the IMCE module"""
+    _install_archive(CKEDITOR_URI, 'tar', path_join(path, 'ckeditor'),
+                     strip_components=1, stdout=stdout)
 
-    os.rename('fancyapps-fancyBox-18d1712', 'fancybox')
-    rm('fancybox.zip')
 
+def _install_jquery_colorpicker(stdout=None, path='.'):
+    """Callback to install necessary library for the module"""
+    _install_archive(JQ_COLOR_PICKER_URI, 'zip',
+                     path_join(path, 'colorpicker'), stdout=stdout)
 
-def _install_jquery_cycle(stdout=None):
-    """Callback to install necessary library for the Views Cycle module"""
-    os.makedirs('./jquery.cycle')
-    http.dl(JQ_CYCLE_URI, './jquery.cycle/jquery.cycle.all.js')
 
+def _install_fancybox(stdout=None, path='.'):
+    """Callback to install necessary library for the Fancybox module"""
+    _install_archive(FANCYBOX_URI, 'zip', path_join(path, 'fancybox'),
+                     strip_components=1, stdout=stdout)
 
-def _install_predis(stdout=None):
-    """Callback to install Predis for the Redis module"""
-    http.dl(PREDIS_URI, 'predis.zip')
-    output = unzip('predis.zip')
 
-    if stdout and output:
-        stdout.write(str(output).strip() + '\n')
+def _install_jquery_cycle(stdout=None, path='.'):
+    """Callback to install necessary library for the Views Cycle module"""
+    os.makedirs(path_join(path, 'jquery.cycle'))
+    _dl(JQ_CYCLE_URI, path_join(path, 'jquery.cycle', 'jquery.cycle.all.js'))
 
-    os.rename('nrk-predis-d02e2e1', 'predis')
-    rm('predis.zip')
+
+def _install_predis(stdout=None, path='.'):
+    """Callback to install Predis for the Redis module"""
+    _install_archive(PREDIS_URI, 'zip', path_join(path, 'predis'),
+                     strip_components=1, stdout=stdout)
 
 
-def _install_simplepie(stdout=None):
+def _install_simplepie(stdout=None, path='.'):
     """Callback to install necessary file for the Simplepie module"""
-    target = realpath(path_join(os.getcwd(), '..', 'modules', 'contrib',
+    target = realpath(path_join(path, '..', 'modules', 'contrib',
                                 'feeds', 'libraries',
                                 'simplepie.compiled.php'))
-    http.dl(SIMPLEPIE_URI, target)
+    _dl(SIMPLEPIE_URI, target)
 
 
-# All callbacks must have stdout=None as the signature
+# All callbacks must have stdout=None, path='.' as the signature. path is the
+#   libraries directory; callbacks must not depend on the current directory
+#   as several may run at the same time.
 _lib_hooks = {
     'ckeditor': _install_ckeditor,
     'colorpicker': _install_jquery_colorpicker,
@@ -124,15 +212,213 @@ class DrupalError(Exception):
     pass
 
 
+class LibraryResult(object):
+    """Outcome of installing one library with Drush.install_libs()"""
+    name = None
+    elapsed = None
+    error = None
+
+    def __init__(self, name, elapsed, error=None):
+        self.name = name
+        self.elapsed = elapsed
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<LibraryResult %s ok=%s elapsed=%.2fs>' % (
+            self.name, self.ok, self.elapsed)
+
+
+class LibraryError(DrushError):
+    """Raised by Drush.install_libs() when one or more libraries failed to
+         install. ``results`` holds every LibraryResult, ``failures`` only
+         the failed ones."""
+    def __init__(self, results):
+        self.results = results
+        self.failures = [x for x in results if not x.ok]
+
+        DrushError.__init__(self, 'Failed to install: %s' % (', '.join(
+            '%s (%s)' % (x.name, x.error) for x in self.failures)))
+
+
+class DrushMultiSiteError(DrushError):
+    """Raised by a parallel command() when one or more sites failed. The
+         ``results`` attribute holds the SiteResult of every site that ran,
+         ``failures`` only the ones with a non-zero exit code."""
+    def __init__(self, results):
+        self.results = results
+        self.failures = [x for x in results if not x.ok]
+
+        sites = ', '.join(x.site for x in self.failures)
+        DrushError.__init__(self, '%d of %d sites failed: %s' %
+                            (len(self.failures), len(results), sites))
+
+
+class SiteResult(object):
+    """Outcome of running a drush command against a single site"""
+    site = None
+    command_line = None
+    returncode = None
+    elapsed = None
+    stdout = None
+    stderr = None
+
+    def __init__(self, site, command_line, returncode, elapsed, stdout='',
+                 stderr=''):
+        self.site = site
+        self.command_line = command_line
+        self.returncode = returncode
+        self.elapsed = elapsed
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        return '<SiteResult %s returncode=%d elapsed=%.2fs>' % (
+            self.site, self.returncode, self.elapsed)
+
+
+class BatchResult(object):
+    """Outcome of one operation of a Drush.batch() on one site"""
+    site = None
+    operation = None
+    ok = False
+    error = None
+
+    def __init__(self, site, operation, ok, error=None):
+        self.site = site
+        self.operation = operation
+        self.ok = ok
+        self.error = error
+
+    def __repr__(self):
+        return '<BatchResult %s %s ok=%s>' % (self.site, self.operation[0],
+                                              self.ok)
+
+
+class DrushBatch(object):
+    """Operations collected by Drush.batch(). After the with block,
+         ``results`` is a list of BatchResult, ordered by site and then by
+         operation."""
+    ignore_errors = False
+    operations = None
+    results = None
+
+    def __init__(self, ignore_errors=False):
+        self.ignore_errors = ignore_errors
+        self.operations = []
+        self.results = []
+
+    def add(self, *operation):
+        self.operations.append(operation)
+
+    def script(self):
+        """Returns the PHP script that runs all operations."""
+        data = json.dumps({
+            'ignore_errors': self.ignore_errors,
+            'operations': self.operations,
+        })
+        cache_cases = []
+
+        for which in sorted(_BATCH_CACHE_TYPES.keys()):
+            cache_cases.append("          case '%s':\n            %s\n"
+                               "            break;" %
+                               (which, _BATCH_CACHE_TYPES[which]))
+
+        return _BATCH_SCRIPT % {
+            'data': b64encode(data.encode('utf-8')).decode('ascii'),
+            'cache_cases': '\n'.join(cache_cases),
+            'prefix': _BATCH_REPORT_PREFIX,
+        }
+
+
+class DrushQueue(object):
+    """Operations deferred by Drush.deferred(), collapsed into as few drush
+         commands as possible when flushed:
+
+    - rr and updb run once each, first
+    - consecutive en() calls become one en command, and so do dis() calls
+    - every cc() becomes one cache clear, run last: cc all unless all calls
+      cleared the same cache type
+
+    ``requested`` counts the calls made and ``executed`` the commands run.
+    """
+    ignore_errors = False
+    operations = None
+    requested = 0
+    executed = 0
+
+    def __init__(self, ignore_errors=False):
+        self.ignore_errors = ignore_errors
+        self.operations = []
+
+    def add(self, name, *args):
+        self.requested += 1
+        self.operations.append((name,) + args)
+
+    def commands(self):
+        """Returns the drush command strings the queued operations collapse
+             to."""
+        names = set(x[0] for x in self.operations)
+        ret = [x for x in ('rr', 'updb -y') if x.split()[0] in names]
+        groups = []
+
+        for operation in self.operations:
+            if operation[0] not in ('en', 'dis'):
+                continue
+
+            if groups and groups[-1][0] == operation[0]:
+                modules = groups[-1][1]
+            else:
+                modules = []
+                groups.append((operation[0], modules))
+
+            for module in operation[1]:
+                if module not in modules:
+                    modules.append(module)
+
+        for (name, modules) in groups:
+            ret.append('%s -y %s' % (name, ' '.join(shell_quote(x)
+                                                    for x in modules)))
+
+        cache_types = set(x[1] for x in self.operations if x[0] == 'cc')
+
+        if len(cache_types) == 1:
+            ret.append('cc %s' % (cache_types.pop()))
+        elif cache_types:
+            ret.append('cc all')
+
+        return ret
+
+
 class Drush:
     """Interface to Drush from Python"""
     _path = None
     _verbose = False
     _stdout = None
-    _uris = []
+    _stdout_lock = None
+    _max_workers = 1
+    _batch = None
+    _queue = None
+    _uris = None
+    _site_dirs = None
+    _site_aliases = None
+    _site_patterns = None
+    _shard = None
+    _query_ttl = 60
+    _query_cache = None
+    _query_lock = None
+    _module_index = None
     _cookie_processor = None
 
-    def __init__(self, path, verbose=False, stdout=None):
+    def __init__(self, path, verbose=False, stdout=None, max_workers=1,
+                 sites=None, shard=None, query_ttl=60):
         """
 
         Arguments:
@@ -140,26 +426,231 @@ class Drush:
                   init_dir() can be used to initialise
 
         Keyword Arguments:
-        verbose -- If verbose mode should be used with the drush command.
-        stdout  -- Where standard output should be written to. None for
-                    current terminal.
+        verbose     -- If verbose mode should be used with the drush command.
+        stdout      -- Where standard output should be written to. None for
+                        current terminal.
+        max_workers -- int, default number of sites command() runs at the
+                        same time. 1 keeps the serial behaviour.
+        sites       -- Sites that commands run against. See select_sites().
+        shard       -- This node's share of the sites. See select_sites().
+        query_ttl   -- float, seconds results of query methods like status()
+                        are cached for. 0 disables the cache.
         """
         self._path = realpath(path)
         self._verbose = verbose
         self._stdout = stdout
+        self._stdout_lock = threading.Lock()
+        self._max_workers = max_workers
+        self._query_ttl = query_ttl
+        self._query_cache = {}
+        self._query_lock = threading.Lock()
+        self._uris = []
+        self.discover_sites()
+        self.select_sites(sites, shard=shard)
+
+    def discover_sites(self, refresh=False):
+        """Returns the sorted names of the site directories in sites/, other
+             than all and default. Aliases from sites/sites.php are read at
+             the same time (see site_aliases()). The result is cached on the
+             instance; pass refresh=True to list the directory again, for
+             example after settings files of new sites were written. Found
+             sites are added to the sites commands run against.
+        """
+        if self._site_dirs is not None and not refresh:
+            return self._site_dirs
+
+        self._site_dirs = []
+        self._site_aliases = {}
+        sites_path = path_join(self._path, 'sites')
+
+        if not isdir(sites_path):
+            return self._site_dirs
+
+        self._site_dirs = sorted(x for x in os.listdir(sites_path)
+                                 if isdir(path_join(sites_path, x)) and
+                                 x not in ['all', 'default'])
+
+        for site_dir in self._site_dirs:
+            self.add_uri('http://%s' % (site_dir))
+
+        try:
+            with open(path_join(sites_path, 'sites.php')) as f:
+                sites_php = f.read()
+        except IOError:
+            sites_php = ''
+
+        for match in re.finditer(r'^\s*\$sites\[\s*([\'"])(.+?)\1\s*\]\s*=\s*'
+                                 r'([\'"])(.+?)\3\s*;', sites_php, re.M):
+            self._site_aliases.setdefault(match.group(4), []).append(
+                match.group(2))
+
+        return self._site_dirs
 
-        if isdir(self._path) and isdir(path_join(self._path, 'sites')):
-            with pushd(self._path):
-                site_dirs = [x
-                             for x in os.listdir('sites')
-                             if isdir(os.path.join('sites', x)) and
-                             x not in ['all', 'default']]
-                for item in site_dirs:
-                    self._uris.append('http://%s' % (item))
+    def site_aliases(self):
+        """Returns a dict of site directory to the list of aliases mapped to
+             it in sites/sites.php."""
+        self.discover_sites()
+        return self._site_aliases
 
-                self._uris.sort()
+    def select_sites(self, patterns=None, shard=None):
+        """Limits the sites commands run against. The default site is named
+             'default'; other sites are named by their URI without the
+             scheme (the directory name for discovered sites).
 
-    def command(self, string_as_is, ignore_errors=False, once=False):
+        Keyword Arguments:
+        patterns -- None for all sites, or a list of fnmatch patterns and
+                    compiled regular expressions. A site is selected if any
+                    of them matches its name or one of its sites.php aliases.
+        shard    -- None, or 'i/n' (or a tuple (i, n)) to keep only the sites
+                    whose stable hash modulo n is i, 0 <= i < n. Every node of
+                    a cluster running shard i/n for each i covers all sites
+                    exactly once.
+        """
+        if isinstance(patterns, str) or hasattr(patterns, 'search'):
+            patterns = [patterns]
+
+        if isinstance(shard, str):
+            try:
+                shard = tuple(int(x) for x in shard.split('/'))
+            except ValueError:
+                shard = ()
+
+        if shard is not None and (len(shard) != 2 or
+                                  not 0 <= shard[0] < shard[1]):
+            raise DrushError('Invalid shard, expected i/n with 0 <= i < n')
+
+        self._site_patterns = patterns
+        self._shard = shard
+
+    def _site_name(self, uri):
+        if uri is None:
+            return 'default'
+
+        return re.sub(r'^https?\://', '', uri).rstrip('/')
+
+    def _is_selected(self, name):
+        if self._site_patterns is not None:
+            names = [name] + self.site_aliases().get(name, [])
+            matched = False
+
+            for pattern in self._site_patterns:
+                if hasattr(pattern, 'search'):
+                    matched = any(pattern.search(x) for x in names)
+                else:
+                    matched = any(fnmatch(x, pattern) for x in names)
+
+                if matched:
+                    break
+
+            if not matched:
+                return False
+
+        if self._shard is not None:
+            digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+            return int(digest, 16) % self._shard[1] == self._shard[0]
+
+        return True
+
+    def sites(self):
+        """Returns the names of the selected sites, 'default' first."""
+        return [self._site_name(x) for x in self._site_uris()]
+
+    def _command_line(self, split, uri=None):
+        command_line = ['drush']
+
+        if uri:
+            command_line.append('--uri=%s' % (uri))
+
+        if not self._verbose:
+            command_line.append('-q')
+
+        command_line.extend(split)
+
+        return command_line
+
+    def _site_uris(self, once=False):
+        """Returns the URIs a command runs against, None being the default
+             site (no --uri argument). once always means just the default
+             site, whatever the selection."""
+        if once:
+            return [None]
+
+        ret = []
+
+        if self._is_selected('default'):
+            ret.append(None)
+
+        for uri in sorted(set(self._uris)):
+            if re.match(r'^https?\://default$', uri):
+                continue
+
+            if self._is_selected(self._site_name(uri)):
+                ret.append(uri)
+
+        return ret
+
+    def _run_site(self, split, uri=None):
+        """Runs a command against one site, capturing all output. Does not
+             depend on the current directory so it is safe to call from
+             worker threads."""
+        command_line = self._command_line(split, uri)
+        start = time.time()
+
+        with operation('drush', site=uri or 'default',
+                       command=' '.join(split)) as record:
+            proc = sp.Popen(command_line, cwd=self._path, stdout=sp.PIPE,
+                            stderr=sp.PIPE, universal_newlines=True)
+            stdout, stderr = proc.communicate()
+            record['exit_code'] = proc.returncode
+
+        return SiteResult(uri or 'default', command_line, proc.returncode,
+                          time.time() - start, stdout, stderr)
+
+    def _write_site_output(self, result):
+        """Writes a site's captured output as one block so output of sites
+             running at the same time never interleaves."""
+        lines = []
+
+        if self._verbose:
+            lines.append(' '.join(result.command_line) + '\n')
+
+        if result.stdout:
+            lines.append(result.stdout.rstrip('\n') + '\n')
+
+        if not lines:
+            return
+
+        out = self._stdout or sys.stdout
+        with self._stdout_lock:
+            out.write(''.join(lines))
+            out.flush()
+
+    def _command_parallel(self, split, ignore_errors, once, max_workers):
+        uris = self._site_uris(once=once)
+
+        # Like the serial mode, nothing to do when no site is selected
+        if not uris:
+            return []
+
+        def run(uri):
+            result = self._run_site(split, uri)
+            self._write_site_output(result)
+            return result
+
+        pool = ThreadPool(min(max_workers, len(uris)))
+        try:
+            results = pool.map(run, uris)
+        finally:
+            pool.close()
+            pool.join()
+
+        if not ignore_errors and not all(x.ok for x in results):
+            raise DrushMultiSiteError(results)
+
+        return results
+
+    def command(self, string_as_is, ignore_errors=False, once=False,
+                max_workers=None):
         """Runs a drush command string. If the class is not in verbose mode,
             -q argument will be added
            ignore_errors may want to be used for commands that exit with
@@ -168,135 +659,301 @@ class Drush:
 
         command('en -y module_name')
         command('views-revert my_nonexisting_view', ignore_errors=True)
-        """
-        with pushd(self._path):
-            split = shell_split(string_as_is)
-            command_line = ['drush']
-
-            if not self._verbose:
-                command_line.append('-q')
 
-            command_line.extend(split)
-            if self._verbose and self._stdout:
-                self._stdout.write(' '.join(command_line) + '\n')
+        With max_workers (or the max_workers given to the constructor)
+          greater than 1, the default site and all URIs are run in a worker
+          pool. Output of each site is captured and written in one block, all
+          sites run even if some fail, and a list of SiteResult is returned.
+          Failures are raised together as a DrushMultiSiteError unless
+          ignore_errors is True.
 
-            try:
-                sp.check_call(command_line, stdout=self._stdout)
-            except sp.CalledProcessError as e:
-                if not ignore_errors:
-                    raise e
+        command('cc all', max_workers=8)
 
-            if once:
-                return
+        Any command may change the sites, so cached query results are
+          dropped (see invalidate_queries()).
+        """
+        self.invalidate_queries()
 
-            for uri in set(self._uris):
-                if re.match(r'^https?\://default$', uri):
-                    continue
+        if max_workers is None:
+            max_workers = self._max_workers
 
-                command_line = ['drush', '--uri=%s' % (uri)]
+        if max_workers > 1:
+            return self._command_parallel(shell_split(string_as_is),
+                                          ignore_errors, once, max_workers)
 
-                if not self._verbose:
-                    command_line.append('-q')
+        split = shell_split(string_as_is)
 
-                command_line.extend(split)
+        for uri in self._site_uris(once=once):
+            command_line = self._command_line(split, uri)
 
-                if self._verbose and self._stdout:
-                    self._stdout.write(' '.join(command_line) + '\n')
+            if self._verbose and self._stdout:
+                self._stdout.write(' '.join(command_line) + '\n')
 
+            with operation('drush', site=uri or 'default',
+                           command=string_as_is) as record:
                 try:
-                    sp.check_call(command_line, stdout=self._stdout)
+                    sp.check_call(command_line, cwd=self._path,
+                                  stdout=self._stdout)
+                    record['exit_code'] = 0
                 except sp.CalledProcessError as e:
+                    record['exit_code'] = e.returncode
                     if not ignore_errors:
                         raise e
 
     def command_output(self, string_as_is, once=False):
         """Like command() but returns the output, in a list format:
              [(site_name, stripped_data)]"""
-        with pushd(self._path):
-            split = shell_split(string_as_is)
-            command_line = ['drush']
-            ret = []
+        split = shell_split(string_as_is)
+        ret = []
 
-            if not self._verbose:
-                command_line.append('-q')
+        for uri in self._site_uris(once=once):
+            command_line = self._command_line(split, uri)
 
-            command_line.extend(split)
             if self._verbose and self._stdout:
                 self._stdout.write(' '.join(command_line) + '\n')
 
-            ret.append(('default',
-                        sp.Popen(command_line, stdout=sp.PIPE).communicate()[0].strip(),))
+            with operation('drush', site=uri or 'default',
+                           command=string_as_is) as record:
+                proc = sp.Popen(command_line, cwd=self._path,
+                                stdout=sp.PIPE)
+                output = proc.communicate()[0].strip()
+                record['exit_code'] = proc.returncode
+            ret.append((uri or 'default', output,))
+
+        return ret
 
-            if once:
-                return ret
+    def invalidate_queries(self):
+        """Drops all cached results of query methods. Called by every method
+             that may change a site."""
+        with self._query_lock:
+            self._query_cache.clear()
 
-            for uri in set(self._uris):
-                if re.match(r'^https?\://default$', uri):
-                    continue
+    def _parse_json_output(self, stdout):
+        try:
+            return json.loads(stdout)
+        except ValueError:
+            pass
 
-                command_line = ['drush', '--uri=%s' % (uri)]
+        # PHP notices and drush warnings can precede the JSON document
+        match = re.search(r'^[\[{]', stdout, re.M)
+        if not match:
+            raise DrushError('No JSON in drush output: %s' % (stdout[:200]))
 
-                if not self._verbose:
-                    command_line.append('-q')
+        return json.loads(stdout[match.start():])
 
-                command_line.extend(split)
+    def query(self, string_as_is, once=False, refresh=False,
+              missing_ok=False):
+        """Runs a read-only drush command that supports --format=json against
+             each site and returns a dict of site name to the parsed output.
+             Results are cached per site for query_ttl seconds (see
+             __init__()); sites with a fresh result do not run drush, and so
+             do not bootstrap Drupal, again.
 
-                if self._verbose and self._stdout:
-                    self._stdout.write(' '.join(command_line) + '\n')
+        query('status')['default']['drupal-version']
 
-                ret.append((uri,
-                            sp.Popen(command_line, stdout=sp.PIPE).communicate()[0].strip(),))
+        Arguments:
+        string_as_is -- str, drush command without --format
 
+        Keyword Arguments:
+        once       -- bool, only query the default site
+        refresh    -- bool, ignore cached results
+        missing_ok -- bool, return None for sites where drush fails instead
+                      of raising DrushError (drush vget fails for unset
+                      variables)
+        """
+        split = shell_split(string_as_is) + ['--format=json']
+        uris = self._site_uris(once=once)
+        now = time.time()
+        ret = {}
+        stale = []
+
+        with self._query_lock:
+            for uri in uris:
+                cached = self._query_cache.get((uri, string_as_is))
+
+                if not refresh and cached and now - cached[0] < \
+                        self._query_ttl:
+                    ret[self._site_name(uri)] = cached[1]
+                else:
+                    stale.append(uri)
+
+        if not stale:
             return ret
 
+        if self._max_workers > 1 and len(stale) > 1:
+            pool = ThreadPool(min(self._max_workers, len(stale)))
+            try:
+                results = pool.map(lambda x: self._run_site(split, x), stale)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._run_site(split, x) for x in stale]
+
+        for (uri, result) in zip(stale, results):
+            if result.ok:
+                value = self._parse_json_output(result.stdout)
+            elif missing_ok:
+                value = None
+            else:
+                raise DrushError('%s failed on %s: %s' % (
+                    string_as_is, result.site, result.stderr.strip() or
+                    'status %d' % (result.returncode)))
+
+            with self._query_lock:
+                self._query_cache[(uri, string_as_is)] = (now, value)
+
+            ret[self._site_name(uri)] = value
+
+        return ret
+
+    def status(self, once=False, refresh=False):
+        """Returns drush status of each site as a dict of site name to a dict
+             (keys like ``'drupal-version'``, ``'bootstrap'``,
+             ``'db-status'``)."""
+        return self.query('status', once=once, refresh=refresh)
+
+    def pm_list(self, status=None, type=None, once=False, refresh=False):
+        """Returns the projects of each site as a dict of site name to a
+             dict of machine name to information (``'status'``,
+             ``'version'``, ``'type'``...).
+
+        Keyword Arguments:
+        status -- str, filter such as ``'enabled'`` or ``'disabled'``
+        type   -- str, ``'module'`` or ``'theme'``
+        """
+        command = 'pm-list'
+
+        if status:
+            command += ' --status=%s' % (shell_quote(status))
+        if type:
+            command += ' --type=%s' % (shell_quote(type))
+
+        return self.query(command, once=once, refresh=refresh)
+
+    def vget(self, variable_name, once=False, refresh=False):
+        """Returns the value of a variable on each site as a dict of site name
+             to value, None where the variable is not set."""
+        output = self.query('vget --exact %s' % (shell_quote(variable_name)),
+                            once=once, refresh=refresh, missing_ok=True)
+
+        for (site, value) in output.items():
+            if isinstance(value, dict) and variable_name in value:
+                output[site] = value[variable_name]
+
+        return output
+
     def add_uri(self, uri):
         if uri in self._uris:
             return
 
         self._uris.append(uri)
 
-    def init_dir(self, major_version=7, minor_version=25, cache=True):
+    def init_dir(self, major_version=7, minor_version=25, cache=True,
+                 clone=None, core_cache_dir=DRUPAL_CORE_CACHE_DIR):
         """Initialises a Drupal root with a version specified.
 
         Kwargs:
             ``major_version`` (int): major version of Drupal\n
             ``minor_version`` (int): minor version of Drupal\n
-            cache (bool): if Drush's cache should be used
+            cache (bool): if Drush's cache should be used\n
+            clone (str): ``None`` to download into place, or a mode of
+              webappman.clone.CLONE_MODES to clone the root from a pristine
+              copy of this version kept in ``core_cache_dir``. The pristine
+              copy is downloaded the first time it is needed. Development
+              (``'x'``) versions are never cached.\n
+            core_cache_dir (str): directory of pristine Drupal versions
+
+        With hard links, core files are shared with the pristine copy (and
+          every other root cloned from it) and are read-only; use
+          webappman.clone.unshare() before patching one in place. ``sites``
+          is always copied.
         """
-        with pushd(realpath(path_join(self._path, '..'))):
-            module_name = 'drupal-%d.%s' % (major_version, minor_version)
-            dir_name = module_name
+        if clone and minor_version != 'x':
+            core_path = self._core_build(major_version, minor_version, cache,
+                                         core_cache_dir)
+            clone_tree(core_path, self._path, mode=clone,
+                       copy_paths=('sites',))
+        else:
+            self._download_core(realpath(path_join(self._path, '..')),
+                                major_version, minor_version, cache,
+                                self._path)
+
+        os.makedirs(path_join(self._path, 'sites', 'all', 'modules',
+                              'contrib'))
+        os.makedirs(path_join(self._path, 'sites', 'all', 'themes',
+                              'contrib'))
+        os.makedirs(path_join(self._path, 'sites', 'default', 'files',
+                              'tmp'),
+                    504)  # 0770, or 0o770 in Python 3
+
+    def _download_core(self, parent_dir, major_version, minor_version, cache,
+                       target):
+        """Downloads Drupal with drush dl in parent_dir and renames the
+             result to target."""
+        module_name = 'drupal-%d.%s' % (major_version, minor_version)
+        dir_name = module_name
 
-            if minor_version == 'x':
-                dir_name += '-dev'
+        if minor_version == 'x':
+            dir_name += '-dev'
 
-            if isdir(dir_name):
-                rmdir_force(dir_name)
+        dir_name = path_join(parent_dir, dir_name)
 
-            command_line = ['drush', 'dl', '-y']
+        if isdir(dir_name):
+            rmdir_force(dir_name)
 
-            if cache:
-                command_line.append('--cache')
+        command_line = ['drush', 'dl', '-y']
 
-            if not self._verbose:
-                command_line.append('-q')
+        if cache:
+            command_line.append('--cache')
 
-            command_line.append(module_name)
+        if not self._verbose:
+            command_line.append('-q')
 
-            sp.check_call(command_line)
+        command_line.append(module_name)
 
-            if not isdir(dir_name):
-                raise Exception('Failed to download Drupal 7.x correctly')
+        with operation('drush', command='dl %s' % (module_name)):
+            sp.check_call(command_line, cwd=parent_dir)
 
-            os.rename(dir_name, self._path)
+        if not isdir(dir_name):
+            raise Exception('Failed to download Drupal 7.x correctly')
 
-            with pushd(self._path):
-                os.makedirs('./sites/all/modules/contrib')
-                os.makedirs('./sites/all/themes/contrib')
+        os.rename(dir_name, target)
 
-            os.makedirs(path_join(self._path, 'sites', 'default', 'files',
-                                  'tmp'),
-                        504)  # 0770, or 0o770 in Python 3
+    def _core_build(self, major_version, minor_version, cache,
+                    core_cache_dir):
+        """Returns the path of the pristine copy of a Drupal version,
+             downloading it if it is not in core_cache_dir yet."""
+        core_path = path_join(core_cache_dir, 'drupal-%d.%s' % (
+            major_version, minor_version))
+
+        if isdir(core_path):
+            return core_path
+
+        if not isdir(core_cache_dir):
+            try:
+                os.makedirs(core_cache_dir)
+            except OSError:
+                pass
+
+        # Only one process builds a version; the others wait for it
+        with open(core_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+            if isdir(core_path):
+                return core_path
+
+            build_dir = tempfile.mkdtemp(dir=core_cache_dir, prefix='.build-')
+            try:
+                target = path_join(build_dir, 'drupal')
+                self._download_core(build_dir, major_version, minor_version,
+                                    cache, target)
+                make_read_only(target)
+                os.rename(target, core_path)
+            finally:
+                rmdir_force(build_dir)
+
+        return core_path
 
     def create_libraries_dir(self):
         """Creates the sites/all/libraries directory. Root path must exist."""
@@ -307,34 +964,32 @@ class Drush:
 
         os.makedirs(path_join(self._path, 'sites', 'all', 'libraries'))
 
-    def _handle_dl(self, command_line, ignore_errors=False):
+    def _handle_dl(self, command_line, ignore_errors=False, cwd=None):
         try:
-            sp.check_call(command_line)
+            with operation('drush', command=' '.join(command_line[1:])):
+                sp.check_call(command_line, cwd=cwd)
         except sp.CalledProcessError as e:
             # Most of the time this is caused by a bad checksum
             if ignore_errors:
-                pass
+                return
 
             raise DrushError('Non-zero status %d. Run in verbose mode and'
                              'check output for [error] line' %
                              (e.returncode))
+        finally:
+            # Even a failed drush dl may have replaced some projects
+            self.invalidate_queries()
 
-    def dl(self, module_names, cache=True, ignore_errors=False):
-        """Downloads modules.
-
-        Arguments:
-        module_names -- str or list, a module name or a list of module names
-
-        Keyword Arguments:
-        cache         -- boolean, if Drush's cache should be used
-        ignore_errors -- boolean, ignore hash errors
+    @property
+    def module_index(self):
+        """webappman.inventory.ModuleIndex of this root, kept for the life of
+             the instance so unchanged projects are not read again."""
+        if self._module_index is None:
+            self._module_index = ModuleIndex(self._path)
 
-        Raises DrushError if an error occurs when downloading, unless
-          ignore_errors is True.
-        """
-        if type(module_names) is str:
-            module_names = shell_split(module_names)
+        return self._module_index
 
+    def _dl_command_line(self, module_names, cache):
         command_line = ['drush', 'dl', '-y']
 
         if cache:
@@ -345,19 +1000,102 @@ class Drush:
 
         command_line.extend(module_names)
 
+        return command_line
+
+    def dl(self, module_names, cache=True, ignore_errors=False,
+           skip_installed=True, batch_size=10, max_workers=4):
+        """Downloads modules.
+
+        Names are deduplicated and, with skip_installed, a name with a
+          version (views-7.x-3.8) is skipped when module_index shows that
+          version installed. Plain names are always downloaded, as drush dl
+          then updates the project to its current release. The rest is
+          downloaded by drush dl commands of up to batch_size projects,
+          max_workers at a time.
+
+        Arguments:
+        module_names -- str or list, a module name or a list of module names
+
+        Keyword Arguments:
+        cache          -- boolean, if Drush's cache should be used
+        ignore_errors  -- boolean, ignore hash errors
+        skip_installed -- boolean, skip version pinned names whose version
+                          is already installed
+        batch_size     -- int, projects per drush dl command
+        max_workers    -- int, drush dl commands run at the same time
+
+        Returns the list of names that were downloaded. Raises DrushError if
+          an error occurs when downloading, unless ignore_errors is True.
+        """
+        if type(module_names) is str:
+            module_names = shell_split(module_names)
+
         dir_exceptions = [
             'registry_rebuild',
         ]
+        names = []
+        elsewhere = []
+
+        for name in module_names:
+            if name.lower() in dir_exceptions:
+                # Not a Drupal project, installed as a Drush extension
+                if name not in elsewhere:
+                    elsewhere.append(name)
+            elif name not in names:
+                names.append(name)
+
+        if skip_installed and names:
+            projects = self.module_index.projects()
+            wanted = names
+            names = []
+
+            for name in wanted:
+                match = re.match(r'^(.+?)-(\d+\.x-.+)$', name)
+
+                # The index cannot tell whether an unpinned project is at
+                #   its current release
+                if match:
+                    installed = projects.get(match.group(1))
+                    if installed and installed.version == match.group(2):
+                        continue
+
+                names.append(name)
+
+        if elsewhere:
+            self._handle_dl(self._dl_command_line(elsewhere, cache),
+                            ignore_errors)
+
+        batches = [names[i:i + batch_size]
+                   for i in range(0, len(names), batch_size)]
+
+        def download(batch):
+            try:
+                self._handle_dl(self._dl_command_line(batch, cache),
+                                ignore_errors, cwd=self._path)
+            except DrushError as e:
+                return '%s: %s' % (' '.join(batch), e)
+
+        if len(batches) > 1 and max_workers > 1:
+            pool = ThreadPool(min(max_workers, len(batches)))
+            try:
+                errors = pool.map(download, batches)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            errors = [download(x) for x in batches]
 
-        if len(module_names) == 1 and \
-                module_names[0].lower() in dir_exceptions:
-            return self._handle_dl(command_line, ignore_errors)
+        errors = [x for x in errors if x]
+        if errors:
+            raise DrushError('; '.join(errors))
 
-        with pushd(self._path):
-            self._handle_dl(command_line, ignore_errors)
+        return elsewhere + names
 
     def rr(self):
         """Rebuild registry front-end method."""
+        if self._queue is not None:
+            return self._queue.add('rr')
+
         return self.command('rr')
 
     def cc(self, which='all'):
@@ -367,6 +1105,15 @@ class Drush:
         :type which: ``str``.
         :returns: ``int`` -- the return code.
         """
+        if self._batch is not None:
+            if which not in _BATCH_CACHE_TYPES:
+                raise DrushError('Cache type %s cannot be cleared in a batch'
+                                 % (which))
+            return self._batch.add('cc', which)
+
+        if self._queue is not None:
+            return self._queue.add('cc', which)
+
         return self.command('cc %s' % (which))
 
     def vset(self, variable_name, value):
@@ -378,6 +1125,12 @@ class Drush:
         variable_name -- str, variable name to set
         value         -- Any type that is JSON-encodable or str.
         """
+        if self._batch is not None:
+            return self._batch.add('vset', variable_name, value)
+
+        return self.command(self._vset_command(variable_name, value))
+
+    def _vset_command(self, variable_name, value):
         if type(value) is str:
             format = 'string'
         else:
@@ -386,30 +1139,233 @@ class Drush:
 
         args = (format, shell_quote(variable_name), shell_quote(value))
 
-        return self.command('vset --exact -y --format=%s %s %s' % args)
+        return 'vset --exact -y --format=%s %s %s' % args
 
-    def vset_many(self, dict_of_vars, mysql_connection):
+    def vset_many(self, dict_of_vars, mysql_connection, chunk_size=500,
+                  commit='once'):
         """Set many variables at once using a MySQL connection object and a
              dictionary of values. Use this instead of vset() when many values
              need to be set quickly.
 
+        Variables are written with one multi-row INSERT ... ON DUPLICATE KEY
+          UPDATE per chunk of chunk_size variables.
+
         Arguments:
         dict_of_vars     -- dict, dictionary of variables to values to set
         mysql_connection -- MySQLdb.connection, open connection to MySQL to
                             correct Drupal database
+
+        Keyword Arguments:
+        chunk_size -- int, number of variables per statement
+        commit     -- 'once' to commit at the end, 'chunk' to commit after
+                      every chunk, or None to leave transaction control to
+                      the caller
+
+        Returns a dict with the number of variables ``'inserted'``,
+          ``'updated'`` and ``'unchanged'``. The counts rely on MySQL's
+          affected rows, so they are only exact when the connection was not
+          opened with the CLIENT.FOUND_ROWS flag.
+        """
+        if commit not in ('once', 'chunk', None):
+            raise ValueError('commit must be \'once\', \'chunk\' or None')
+
+        items = list(dict_of_vars.items())
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        c = mysql_connection.cursor()
+
+        try:
+            for i in range(0, len(items), chunk_size):
+                chunk = items[i:i + chunk_size]
+                (inserted, updated) = self._upsert_variables(c, chunk)
+
+                counts['inserted'] += inserted
+                counts['updated'] += updated
+                counts['unchanged'] += len(chunk) - inserted - updated
+
+                if commit == 'chunk':
+                    mysql_connection.commit()
+        finally:
+            c.close()
+
+        if commit == 'once':
+            mysql_connection.commit()
+
+        self.invalidate_queries()
+
+        return counts
+
+    def _upsert_variables(self, cursor, items):
+        """Writes a list of (name, value) pairs with a single statement.
+             Returns (inserted, updated)."""
+        names = [x[0] for x in items]
+        placeholders = ', '.join(['%s'] * len(names))
+        cursor.execute('SELECT COUNT(*) FROM variable WHERE name IN (%s)' %
+                       (placeholders), args=names)
+        existing = int(cursor.fetchone()[0])
+
+        args = []
+        for (key, value) in items:
+            args.extend((key, php.serialize(value)))
+
+        with operation('mysql', statement='vset_many', rows=len(items)):
+            cursor.execute('INSERT INTO variable (name, value) VALUES %s '
+                           'ON DUPLICATE KEY UPDATE value = VALUES(value)' %
+                           (', '.join(['(%s, %s)'] * len(items))), args=args)
+
+        # MySQL counts 1 affected row per insert and 2 per changed update
+        inserted = len(items) - existing
+        updated = max(0, (cursor.rowcount - inserted) // 2)
+
+        return (inserted, updated)
+
+    def reconcile_variables(self, dict_of_vars, mysql_connection,
+                            delete_unmanaged=False, keep=(), dry_run=False,
+                            chunk_size=500, clear_cache=True):
+        """Makes the variable table match dict_of_vars, writing only what
+             differs. The whole table is read with one query and compared by
+             serialised value, so re-applying an unchanged configuration
+             writes nothing and does not invalidate Drupal's variable cache.
+
+        Arguments:
+        dict_of_vars     -- dict, dictionary of variables to values
+        mysql_connection -- MySQLdb.connection, open connection to MySQL to
+                            correct Drupal database
+
+        Keyword Arguments:
+        delete_unmanaged -- bool, delete variables not in dict_of_vars. Drupal
+                            core and modules keep state in this table, so use
+                            keep to protect what is not managed here.
+        keep             -- list of fnmatch patterns of variable names never
+                            to delete
+        dry_run          -- bool, only compute the difference
+        chunk_size       -- int, number of rows per statement
+        clear_cache      -- bool, clear the cached variables (the
+                            ``variables`` entry of cache_bootstrap, Drupal 7)
+                            when anything was written
+
+        Returns a dict: ``'added'``, ``'changed'`` and ``'removed'`` are
+          sorted lists of variable names, ``'unchanged'`` is a count.
         """
+        def as_bytes(value):
+            if isinstance(value, bytes):
+                return value
+            return value.encode('utf-8')
+
         c = mysql_connection.cursor()
 
-        for (key, value) in dict_of_vars.items():
-            value = php.serialize(value)
-            c.execute('INSERT INTO variable (name, value) VALUES '
-                      '(%s, %s) ON DUPLICATE KEY UPDATE value=%s',
-                      args=(key, value, value,))
+        try:
+            with operation('mysql', statement='reconcile_variables'):
+                c.execute('SELECT name, value FROM variable')
+            current = dict((name, as_bytes(value))
+                           for (name, value) in c.fetchall())
+
+            added = []
+            changed = []
+            for (key, value) in dict_of_vars.items():
+                if key not in current:
+                    added.append(key)
+                elif current[key] != as_bytes(php.serialize(value)):
+                    changed.append(key)
+
+            removed = []
+            if delete_unmanaged:
+                removed = [x for x in current
+                           if x not in dict_of_vars and
+                           not any(fnmatch(x, pattern) for pattern in keep)]
+
+            diff = {
+                'added': sorted(added),
+                'changed': sorted(changed),
+                'removed': sorted(removed),
+                'unchanged': len(dict_of_vars) - len(added) - len(changed),
+            }
+
+            if dry_run or not (added or changed or removed):
+                return diff
+
+            writes = [(x, dict_of_vars[x]) for x in diff['added'] +
+                      diff['changed']]
+            for i in range(0, len(writes), chunk_size):
+                self._upsert_variables(c, writes[i:i + chunk_size])
+
+            for i in range(0, len(removed), chunk_size):
+                chunk = diff['removed'][i:i + chunk_size]
+                c.execute('DELETE FROM variable WHERE name IN (%s)' %
+                          (', '.join(['%s'] * len(chunk))), args=chunk)
+
+            if clear_cache:
+                c.execute('DELETE FROM cache_bootstrap WHERE cid = %s',
+                          args=('variables',))
+
+            mysql_connection.commit()
+        finally:
+            c.close()
 
-        mysql_connection.commit()
+        self.invalidate_queries()
+
+        return diff
+
+    def vset_many_sites(self, dict_of_vars, mysql_connections, max_workers=4,
+                        **kwargs):
+        """Applies vset_many() with the same variables to several site
+             databases at the same time, one worker per connection.
+
+        Arguments:
+        dict_of_vars      -- dict, dictionary of variables to values to set
+        mysql_connections -- dict of site name to MySQLdb.connection, or a
+                             list of connections (named by their index).
+                             Every connection must be a separate connection
+                             as each one is used from its own thread.
+
+        Keyword Arguments:
+        max_workers -- int, number of databases written at once
+
+        Other keyword arguments are passed to vset_many().
+
+        Returns a list of (site, counts) in the order of mysql_connections.
+          If any site fails, DrupalError is raised after all sites are done,
+          with the exceptions in its ``errors`` attribute as (site,
+          exception).
+        """
+        if isinstance(mysql_connections, dict):
+            sites = sorted(mysql_connections.items())
+        else:
+            sites = list(enumerate(mysql_connections))
+
+        if not sites:
+            return []
+
+        def apply(site):
+            (name, connection) = site
+
+            try:
+                return (name, self.vset_many(dict_of_vars, connection,
+                                             **kwargs), None)
+            except Exception as e:
+                return (name, None, e)
+
+        pool = ThreadPool(min(max_workers, len(sites)))
+        try:
+            results = pool.map(apply, sites)
+        finally:
+            pool.close()
+            pool.join()
+
+        errors = [(name, e) for (name, _, e) in results if e is not None]
+
+        if errors:
+            error = DrupalError('Failed to set variables on %s' % (', '.join(
+                str(name) for (name, _) in errors)))
+            error.errors = errors
+            raise error
+
+        return [(name, counts) for (name, counts, _) in results]
 
     def updb(self):
         """Update database front-end method. Use with caution."""
+        if self._queue is not None:
+            return self._queue.add('updb')
+
         return self.command('updb -y')
 
     def en(self, module_name):
@@ -418,6 +1374,12 @@ class Drush:
         Arguments:
         module_name -- str, system module name
         """
+        if self._batch is not None:
+            return self._batch.add('en', shell_split(module_name))
+
+        if self._queue is not None:
+            return self._queue.add('en', shell_split(module_name))
+
         return self.command('en -y %s' % (module_name))
 
     def dis(self, module_name):
@@ -426,8 +1388,157 @@ class Drush:
         Arguments:
         module_name -- str, system module name
         """
+        if self._batch is not None:
+            return self._batch.add('dis', shell_split(module_name))
+
+        if self._queue is not None:
+            return self._queue.add('dis', shell_split(module_name))
+
         self.command('dis -y %s' % (module_name))
 
+    @contextmanager
+    def batch(self, ignore_errors=False, once=False):
+        """Collects vset(), en(), dis() and cc() calls made inside the with
+             block and, when the block exits without an exception, runs them
+             per site in one drush php-script process so Drupal is
+             bootstrapped once per site instead of once per operation.
+
+        Operations run in the order they were made. Unless ignore_errors is
+          True, the first failing operation stops the batch and a DrushError
+          is raised, like a failing command() would. Only the cache types in
+          _BATCH_CACHE_TYPES can be cleared, and en() does not download
+          missing modules like drush en does.
+
+        with drush.batch() as batch:
+            drush.vset('site_name', 'My site')
+            drush.en('views')
+            drush.cc()
+        batch.results  # [BatchResult, ...]
+
+        Keyword Arguments:
+        ignore_errors -- bool, keep going after a failed operation or site
+        once          -- bool, only run against the default site
+        """
+        if self._batch is not None:
+            raise DrushError('A batch is already in progress')
+
+        batch = self._batch = DrushBatch(ignore_errors=ignore_errors)
+
+        try:
+            yield batch
+        finally:
+            self._batch = None
+
+        if batch.operations:
+            self._run_batch(batch, once=once)
+
+    @contextmanager
+    def deferred(self, ignore_errors=False):
+        """Defers rr(), updb(), en(), dis() and cc() calls made inside the
+             with block. They are collapsed (see DrushQueue) and run when
+             the block exits without an exception, or earlier at barrier().
+             A deploy calling cc() after every step then clears the caches
+             of each site once instead of once per step.
+
+        Other commands, including command(), run immediately. Call barrier()
+          before one that depends on a deferred operation, like reverting a
+          view of a module being enabled.
+
+        with drush.deferred() as queue:
+            drush.en('views')
+            drush.cc('views')
+            drush.en('ctools')
+            drush.cc()
+        # ran en -y views ctools, then cc all
+        queue.requested, queue.executed  # 4, 2
+
+        Keyword Arguments:
+        ignore_errors -- bool, passed to command()
+        """
+        if self._queue is not None:
+            raise DrushError('Deferred mode is already active')
+
+        queue = self._queue = DrushQueue(ignore_errors=ignore_errors)
+
+        try:
+            yield queue
+            self.barrier()
+        finally:
+            self._queue = None
+
+    def barrier(self):
+        """Runs the operations deferred so far. Does nothing outside of
+             deferred mode."""
+        queue = self._queue
+
+        if queue is None:
+            return
+
+        commands = queue.commands()
+        queue.operations = []
+
+        for command in commands:
+            queue.executed += 1
+            self.command(command, ignore_errors=queue.ignore_errors)
+
+    def _run_batch(self, batch, once=False):
+        self.invalidate_queries()
+        fd, script_path = tempfile.mkstemp(suffix='.php')
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(batch.script())
+
+            for uri in self._site_uris(once=once):
+                result = self._run_site(['php-script', script_path], uri)
+                reports = {}
+                lines = []
+
+                for line in result.stdout.splitlines():
+                    if line.startswith(_BATCH_REPORT_PREFIX):
+                        report = json.loads(line[len(_BATCH_REPORT_PREFIX):])
+                        reports[report['index']] = report
+                    else:
+                        lines.append(line)
+
+                result.stdout = '\n'.join(lines)
+                self._write_site_output(result)
+
+                stopped = not all(x['ok'] for x in reports.values())
+
+                for (i, operation) in enumerate(batch.operations):
+                    if i in reports:
+                        batch.results.append(BatchResult(
+                            result.site, operation, reports[i]['ok'],
+                            reports[i]['error']))
+                    elif stopped:
+                        batch.results.append(BatchResult(
+                            result.site, operation, False,
+                            'Not run because of an earlier failure'))
+                    elif not result.ok:
+                        # Never reached, because of a failed bootstrap or a
+                        #   fatal error
+                        batch.results.append(BatchResult(
+                            result.site, operation, False,
+                            result.stderr.strip() or 'drush exited with '
+                            'status %d' % (result.returncode)))
+                    else:
+                        # drush succeeded without running the script to
+                        #   the end, so the operation may not have run
+                        batch.results.append(BatchResult(
+                            result.site, operation, False,
+                            'No report from the batch script'))
+
+                failed = [x for x in batch.results
+                          if x.site == result.site and not x.ok]
+
+                if failed and not batch.ignore_errors:
+                    raise DrushError('Batch failed on %s at %s: %s' % (
+                        result.site, failed[0].operation[0],
+                        failed[0].error))
+        finally:
+            os.remove(script_path)
+
     def install_lib(self, library_name, stdout=None):
         """Installs a library into sites/all/libraries (usually).
 
@@ -440,19 +1551,79 @@ class Drush:
         stdout -- None or file handle
         """
         self.create_libraries_dir()
+        self._install_lib(library_name, stdout=stdout)
+
+    def _install_lib(self, library_name, stdout=None):
+        libraries_dir = path_join(self._path, 'sites', 'all', 'libraries')
+        # library_name is also supposed to be the directory target
+        target = path_join(libraries_dir, library_name)
+
+        if isdir(target):
+            rmdir_force(target)
+
+        with operation('install_lib', library=library_name):
+            _lib_hooks[library_name](stdout=stdout, path=libraries_dir)
+
+    def install_libs(self, library_names, max_workers=4, stdout=None,
+                     ignore_errors=False):
+        """Installs several libraries at the same time. See install_lib().
+
+        Arguments:
+        library_names -- list of library names registered in _lib_hooks
+
+        Keyword Arguments:
+        max_workers   -- int, number of libraries to install at once
+        stdout        -- None or file handle
+        ignore_errors -- bool, return the results instead of raising
+                         LibraryError when a library fails
+
+        Returns a list of LibraryResult, in the order of library_names.
+        """
+        names = []
+        for name in library_names:
+            if name not in _lib_hooks:
+                raise DrushError('Unknown library %s' % (name))
+            if name not in names:
+                names.append(name)
+
+        if not names:
+            return []
+
+        self.create_libraries_dir()
+
+        def install(name):
+            start = time.time()
+            error = None
+
+            try:
+                self._install_lib(name, stdout=stdout)
+            except Exception as e:
+                error = e
+
+            return LibraryResult(name, time.time() - start, error)
+
+        pool = ThreadPool(min(max_workers, len(names)))
+        try:
+            results = pool.map(install, names)
+        finally:
+            pool.close()
+            pool.join()
+
+        if not ignore_errors and not all(x.ok for x in results):
+            raise LibraryError(results)
 
-        with pushd(path_join(self._path, 'sites', 'all', 'libraries')):
-            # library_name is also supposed to be the directory target
-            if isdir(library_name):
-                rmdir_force(library_name)
-            _lib_hooks[library_name](stdout=stdout)
+        return results
 
     def fix_registry_table(self,
                            connection,
                            search='sites/all/modules',
                            replace='sites/all/modules/contrib',
                            like='sites/all/modules/%',
-                           not_like='%/contrib%'):
+                           not_like='%/contrib%',
+                           batch_size=None,
+                           pause=0.1,
+                           dry_run=False,
+                           progress=None):
         """Not intended for general use, but called with default arguments this
              method fixes an older database that may have modules' registered
              files with paths at sites/all/modules instead of the more proper
@@ -462,10 +1633,26 @@ class Drush:
         connection -- MySQLdb connection object
 
         Keyword Arguments:
-        search  -- str, path to search for
-        replace -- str, replacement string
-        like    -- str, filter
+        search     -- str, path to search for
+        replace    -- str, replacement string
+        like       -- str, filter
+        batch_size -- int, update the table in batches of this many rows by
+                      primary key, with pause seconds between batches, so
+                      locks are held briefly. None for a single UPDATE.
+        dry_run    -- bool, only count the rows that would change
+        progress   -- callable, see batched_replace()
+
+        Returns the number of rows changed (or that would change) when
+          batch_size or dry_run is given.
         """
+        if batch_size or dry_run:
+            return batched_replace(connection, 'registry', 'filename',
+                                   ('name', 'type'), search, replace, like,
+                                   not_like=not_like,
+                                   batch_size=batch_size or 1000,
+                                   pause=pause, dry_run=dry_run,
+                                   progress=progress)
+
         c = connection.cursor()
 
         args = (
@@ -474,13 +1661,16 @@ class Drush:
             like,
             not_like,
         )
-        c.execute('UPDATE registry SET filename = REPLACE(filename, %s, %s)'
-                  'WHERE filename LIKE %s AND filename NOT LIKE %s', args=args)
-        connection.commit()
+        with operation('mysql', statement='fix_registry_table'):
+            c.execute('UPDATE registry SET filename = REPLACE(filename, %s, '
+                      '%s) WHERE filename LIKE %s AND filename NOT LIKE %s',
+                      args=args)
+            connection.commit()
 
         c.close()
 
-    def sync_assets(self, remote_path, domain='default', local_domain=None):
+    def sync_assets(self, remote_path, domain='default', local_domain=None,
+                    incremental=False, workers=4, full=False):
         """Sync assets from a remote or local directory. This is intended to
           sync sites/all/default/files or sites/all/somedomain.com/files
           directories.
@@ -489,6 +1679,15 @@ class Drush:
           remote_path  -- str, remote path in SSH format or a local path
           domain       -- directory in sites to write to
           local_domain -- ???
+          incremental  -- bool, only transfer files that are new or changed
+                          since the last incremental sync, according to a
+                          manifest kept per files directory, in shards
+                          transferred in parallel. See
+                          webappman.assets.sync_tree().
+          workers      -- int, number of parallel shards (incremental only)
+          full         -- bool, ignore the manifest once (incremental only)
+
+          Returns a list of webappman.assets.ShardResult when incremental.
         """
         if local_domain:
             domain_path = path_join(self._path, 'sites', local_domain, 'files')
@@ -499,8 +1698,13 @@ class Drush:
             os.makedirs(domain_path)
             os.makedirs(path_join(domain_path, 'tmp'))
 
-        with pushd(domain_path):
-            dir_sync(remote_path, domain_path)
+        if incremental:
+            return sync_tree(remote_path, domain_path, workers=workers,
+                             full=full)
+
+        with operation('sync', site=domain, source=remote_path):
+            with pushd(domain_path):
+                dir_sync(remote_path, domain_path)
 
     def install_favicon(self, favicon_path):
         """Installs favicon into the root and at /misc/favicon.ico
@@ -598,6 +1802,137 @@ class Drush:
         #self._get_session(add_headers=add_headers)
 
 
+def _key_range(key_columns, op, values):
+    """Returns (SQL, args) for the row comparison (key_columns) op (values),
+         op being '>' or '<=', written out column by column:
+
+    (a >= %s AND (a > %s OR (a = %s AND b > %s)))
+
+    MySQL before 5.7 does not use an index for row constructor comparisons
+      like (a, b) > (%s, %s), so these would scan (and lock) the table.
+    """
+    def expand(columns, values):
+        if len(columns) == 1:
+            return ('%s %s %%s' % (columns[0], op), [values[0]])
+
+        (sql, args) = expand(columns[1:], values[1:])
+
+        return ('(%s %s %%s OR (%s = %%s AND %s))' % (
+            columns[0], op[0], columns[0], sql), [values[0]] * 2 + args)
+
+    (sql, args) = expand(list(key_columns), list(values))
+
+    if len(key_columns) == 1:
+        return (sql, args)
+
+    # The bound on the first column alone gives the optimiser its range
+    return ('(%s %s= %%s AND %s)' % (key_columns[0], op[0], sql),
+            [values[0]] + args)
+
+
+def batched_replace(connection, table, column, key_columns, search, replace,
+                    like, not_like=None, batch_size=1000, pause=0.1,
+                    dry_run=False, progress=None):
+    """Runs UPDATE table SET column = REPLACE(column, search, replace) over the
+         rows matching like (and not matching not_like), walking the table in
+         primary key order batch_size rows at a time. Each batch is its own
+         short transaction, followed by pause seconds of sleep, so row locks
+         are held briefly and replicas can keep up.
+
+    table, column and key_columns are inserted into the SQL as they are and
+      must not come from untrusted input.
+
+    batched_replace(connection, 'system', 'filename', ('filename',),
+                    'sites/all/modules/', 'sites/all/modules/contrib/',
+                    'sites/all/modules/%', not_like='%/contrib/%')
+
+    Arguments:
+    connection  -- MySQLdb connection object
+    table       -- str, table name
+    column      -- str, column to rewrite
+    key_columns -- tuple of str, the primary key columns of table
+    search      -- str, string to search for
+    replace     -- str, replacement string
+    like        -- str, LIKE filter on column
+
+    Keyword Arguments:
+    not_like   -- str, NOT LIKE filter on column
+    batch_size -- int, number of rows (by primary key) per batch
+    pause      -- float, seconds to sleep between batches
+    dry_run    -- bool, only count the rows that would change
+    progress   -- callable, called after each batch with (batches,
+                  rows_scanned, rows_changed) so far
+
+    Returns the number of rows changed, or with dry_run, the number of rows
+      matching the filters.
+    """
+    keys = ', '.join(key_columns)
+    where = '%s LIKE %%s' % (column)
+    where_args = [like]
+
+    if not_like is not None:
+        where += ' AND %s NOT LIKE %%s' % (column)
+        where_args.append(not_like)
+
+    c = connection.cursor()
+
+    try:
+        if dry_run:
+            c.execute('SELECT COUNT(*) FROM %s WHERE %s' % (table, where),
+                      args=where_args)
+            return int(c.fetchone()[0])
+
+        last = None
+        batches = scanned = changed = 0
+
+        while True:
+            if last is None:
+                c.execute('SELECT %s FROM %s ORDER BY %s LIMIT %d' %
+                          (keys, table, keys, batch_size))
+            else:
+                (after, after_args) = _key_range(key_columns, '>', last)
+                c.execute('SELECT %s FROM %s WHERE %s ORDER BY %s LIMIT %d' %
+                          (keys, table, after, keys, batch_size),
+                          args=after_args)
+            rows = c.fetchall()
+
+            if not rows:
+                break
+
+            high = list(rows[-1])
+            (upto, upto_args) = _key_range(key_columns, '<=', high)
+            sql = 'UPDATE %s SET %s = REPLACE(%s, %%s, %%s) WHERE %s AND ' \
+                  '%s' % (table, column, column, upto, where)
+            args = [search, replace] + upto_args + where_args
+
+            if last is not None:
+                sql += ' AND %s' % (after)
+                args += after_args
+
+            with operation('mysql', statement='batched_replace',
+                           table=table) as record:
+                c.execute(sql, args=args)
+                connection.commit()
+                record['rows'] = c.rowcount
+
+            batches += 1
+            scanned += len(rows)
+            changed += c.rowcount
+            last = high
+
+            if progress:
+                progress(batches, scanned, changed)
+
+            if len(rows) < batch_size:
+                break
+
+            time.sleep(pause)
+    finally:
+        c.close()
+
+    return changed
+
+
 def is_production(info_file='/etc/node_type'):
     """Based on DRUPAL_ENV environment variable, determines if the server is in
          production mode.
@@ -626,14 +1961,23 @@ def is_production(info_file='/etc/node_type'):
     return False
 
 
-def generate_settings_files(data):
+def generate_settings_files(data, shared=False):
     """Generates settings.php files
 
+    With shared, the conf and ini_set entries and global variables that are
+      the same for every site are written once to sites/settings.shared.php
+      (SHARED_SETTINGS_FILE), which every settings.php requires before
+      setting its own values. Each site's file then only holds its database
+      and its overrides.
+
     Arguments:
     data -- Configuration hash. Each key in the hash is a domain. So there
               should be at least the 'default' key. From there are three
               hashes: databases, conf, ini_set.
 
+    Keyword Arguments:
+    shared -- bool, factor common settings into the shared include
+
     Example:
     data = {
         'default': {
@@ -662,28 +2006,243 @@ def generate_settings_files(data):
 
     Returns a list of tuples: (path (str), data (PHP code, str))
     """
+    return [[file_name, php_code]
+            for (file_name, php_code) in iter_settings_files(data, shared)]
+
+
+def _freeze(value):
+    """Returns a hashable copy of a settings value that keeps types and
+         dict order, both of which show in the generated PHP."""
+    if isinstance(value, dict):
+        return (dict, tuple((k, _freeze(v)) for (k, v) in value.items()))
+    if isinstance(value, (tuple, list, set)):
+        return (type(value), tuple(_freeze(x) for x in value))
+
+    return (type(value), value)
+
+
+def _generate_array(value, end=';', _arrays=None):
+    """php.generate_array() for a dict, with the output of each top-level
+         entry memoised in _arrays. Settings of many sites mostly repeat the
+         same entries, which are then only generated once."""
+    if _arrays is None:
+        _arrays = {}
+
+    keys = value['_order'] if '_order' in value else list(value.keys())
+    parts = ['array(']
+
+    for key in keys:
+        memo_key = (key, _freeze(value[key]))
+
+        if memo_key not in _arrays:
+            # The lines between array( and ); are the entry itself
+            _arrays[memo_key] = '\n'.join(php.generate_array(
+                {key: value[key]}).split('\n')[1:-1])
+
+        parts.append(_arrays[memo_key])
+
+    parts.append(')%s' % (end))
+
+    return '\n'.join(parts)
+
+
+def _subset(value, keys):
+    ret = dict((k, v) for (k, v) in value.items()
+               if k in keys and k != '_order')
+
+    if '_order' in value:
+        ret['_order'] = [x for x in value['_order'] if x in ret]
+
+    return ret
+
+
+def _split_shared_settings(data):
+    """Returns (shared, data) where shared holds the conf and ini_set
+         entries and global variables that are equal for every site, and
+         data the sites' settings without them. databases always stays with
+         the sites."""
+    sites = list(data.values())
+
+    def same(a, b):
+        if type(a) is not type(b) or a != b:
+            return False
+        if isinstance(a, (dict, tuple, list, set)):
+            # Equal containers can still differ in order or nested types
+            return _freeze(a) == _freeze(b)
+
+        return True
+
+    def common(values):
+        ret = set(k for k in values[0] if k != '_order')
+
+        for value in values[1:]:
+            ret = set(k for k in ret
+                      if k in value and same(value[k], values[0][k]))
+
+        return ret
+
+    common_conf = common([x.get('conf', {}) for x in sites])
+    common_ini = common([x.get('ini_set', {}) for x in sites])
+    common_globals = common([dict(
+        (k, v) for (k, v) in x.items()
+        if k not in ('databases', 'conf', 'ini_set')) for x in sites])
+
+    first = sites[0]
+    shared = dict((k, first[k]) for k in common_globals)
+    shared['conf'] = _subset(first.get('conf', {}), common_conf)
+    shared['ini_set'] = _subset(first.get('ini_set', {}), common_ini)
+
+    ret = {}
+    for (site_name, settings) in data.items():
+        site = dict((k, v) for (k, v) in settings.items()
+                    if k not in common_globals)
+        site['conf'] = _subset(settings.get('conf', {}), set(
+            settings.get('conf', {})) - common_conf)
+        site['ini_set'] = _subset(settings.get('ini_set', {}), set(
+            settings.get('ini_set', {})) - common_ini)
+        ret[site_name] = site
+
+    return (shared, ret)
+
+
+def _render_settings(settings, shared=False, _arrays=None):
+    parts = []
+
+    if shared:
+        parts.append("require DRUPAL_ROOT . '/%s';" % (
+            SHARED_SETTINGS_FILE))
+        parts.append('$databases = %s' % (_generate_array(
+            settings['databases'], _arrays=_arrays)))
+
+        # Site values win over the shared ones
+        if settings['conf']:
+            parts.append('$conf = %s' % (_generate_array(
+                settings['conf'], end=' + $conf;', _arrays=_arrays)))
+    else:
+        for key in ('databases', 'conf',):
+            parts.append('$%s = %s' % (key, _generate_array(
+                settings[key], _arrays=_arrays)))
+
+    for ini_name, ini_setting in settings['ini_set'].items():
+        parts.append('ini_set(%s, %s);' % (php.generate_scalar(ini_name),
+                                           php.generate_scalar(ini_setting)))
+
+    for key, value in settings.items():
+        if key in ('databases', 'conf', 'ini_set'):
+            continue
+
+        parts.append('$%s = %s;' % (key, php.generate_scalar(value)))
+
+    return '\n'.join(parts).strip()
+
+
+def _render_shared_settings(settings, _arrays=None):
+    parts = ['$conf = %s' % (_generate_array(settings['conf'],
+                                             _arrays=_arrays))]
+
+    for ini_name, ini_setting in settings['ini_set'].items():
+        parts.append('ini_set(%s, %s);' % (php.generate_scalar(ini_name),
+                                           php.generate_scalar(ini_setting)))
+
+    for key, value in settings.items():
+        if key in ('conf', 'ini_set'):
+            continue
+
+        parts.append('$%s = %s;' % (key, php.generate_scalar(value)))
+
+    return '\n'.join(parts)
+
+
+def iter_settings_files(data, shared=False):
+    """Like generate_settings_files() but yields (path, PHP code) one site at
+         a time. With shared, the shared include comes first."""
     if not 'default' in data:
         raise DrupalError('"default" key must exist')
 
-    ret = []
+    arrays = {}
+
+    if shared:
+        (shared_settings, data) = _split_shared_settings(data)
+        yield (SHARED_SETTINGS_FILE,
+               _render_shared_settings(shared_settings, _arrays=arrays))
 
     for site_name, settings in data.items():
-        php_code = ''
-        for key in ('databases', 'conf',):
-            php_code += '$%s = %s\n' % (key, php.generate_array(settings[key]))
+        yield (path_join('sites', site_name, 'settings.php'),
+               _render_settings(settings, shared=shared, _arrays=arrays))
 
-        for ini_name, ini_setting in settings['ini_set'].items():
-            php_code += 'ini_set(%s, %s);\n' % (
-                php.generate_scalar(ini_name),
-                php.generate_scalar(ini_setting))
 
-        for key, value in settings.items():
-            if key in ('databases', 'conf', 'ini_set'):
-                continue
+def _content_hash(content):
+    return hashlib.sha1(content).hexdigest()
 
-            php_code += '$%s = %s;\n' % (key, php.generate_scalar(value))
 
-        file_name = path_join('sites', site_name, 'settings.php')
-        ret.append([file_name, php_code.strip()])
+def write_file_if_changed(path, content, mode=0o644):
+    """Writes content (bytes) to path unless the file already has exactly
+         that content. The file is replaced atomically through a temporary
+         file in the same directory, keeping the mode of an existing file.
 
-    return ret
+    Returns True if the file was written.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if _content_hash(f.read()) == _content_hash(content):
+                return False
+        mode = os.stat(path).st_mode & 0o7777
+    except (IOError, OSError):
+        pass
+
+    directory = dirname(path)
+    if not isdir(directory):
+        os.makedirs(directory)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix='.%s-' % (basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp_path, mode)
+        replace_file(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    return True
+
+
+def write_settings_files(data, root, shared=False):
+    """Writes the settings.php files for data (see generate_settings_files())
+         under the Drupal root, skipping files whose content would not
+         change. Unchanged files are never touched, so PHP opcache entries of
+         those sites stay valid.
+
+    Arguments:
+    data -- Configuration hash, see generate_settings_files()
+    root -- str, Drupal root path
+
+    Keyword Arguments:
+    shared -- bool, also write the shared include, see
+              generate_settings_files()
+
+    Yields (site_name, path, changed) as each site is processed. site_name
+      is None for the shared include.
+    """
+    return write_rendered_settings_files(iter_settings_files(data, shared),
+                                         root)
+
+
+def write_rendered_settings_files(files, root):
+    """Like write_settings_files() for settings already rendered with
+         iter_settings_files() or generate_settings_files().
+
+    Arguments:
+    files -- iterable of (path relative to root, PHP code)
+    root  -- str, Drupal root path
+
+    Yields (site_name, path, changed) as each file is processed.
+    """
+    for (file_name, php_code) in files:
+        path = path_join(root, file_name)
+        content = ('<?php\n' + php_code + '\n').encode('utf-8')
+        site_name = None if file_name == SHARED_SETTINGS_FILE else \
+            basename(dirname(file_name))
+
+        yield (site_name, path, write_file_if_changed(path, content))
@@ -0,0 +1,221 @@
+#coding: utf-8
+"""Timing instrumentation of external operations (drush processes,
+downloads, extraction, MySQL statements, file synchronisation)"""
+
+from contextlib import contextmanager
+from os.path import dirname
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+try:
+    from os import replace as replace_file
+except ImportError:
+    from os import rename as replace_file
+
+_hooks = []
+_hooks_lock = threading.Lock()
+
+
+class Hook(object):
+    """Base class of instrumentation hooks. start() and finish() receive the
+         operation record, a dict with at least these keys:
+
+    operation -- str, operation name such as ``'drush'`` or ``'download'``
+    site      -- str or None, site URI
+    start     -- float, Unix time the operation started
+    duration  -- float, seconds (None until finish)
+    bytes     -- int or None, bytes transferred or written
+    exit_code -- int or None, exit code of a subprocess
+    error     -- str or None, the exception if the operation failed
+
+    Operations may add more keys (``uri``, ``command``, ``rows`` ...). Hooks
+      can be called from several threads at once.
+    """
+
+    def start(self, record):
+        pass
+
+    def finish(self, record):
+        pass
+
+
+def add_hook(hook):
+    """Registers a Hook to be called for every operation."""
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    with _hooks_lock:
+        _hooks.remove(hook)
+
+
+def _call_hooks(method, record):
+    for hook in list(_hooks):
+        try:
+            getattr(hook, method)(record)
+        except Exception:
+            logging.getLogger('webappman').exception(
+                'Instrumentation hook %r failed' % (hook))
+
+
+@contextmanager
+def operation(name, site=None, **fields):
+    """Context manager timing one operation. The yielded record can be
+         updated inside the block, for example with ``bytes`` or
+         ``exit_code``. Without hooks this costs almost nothing.
+
+    with operation('download', uri=uri) as record:
+        record['bytes'] = fetch(uri)
+    """
+    record = {
+        'operation': name,
+        'site': site,
+        'start': time.time(),
+        'duration': None,
+        'bytes': None,
+        'exit_code': None,
+        'error': None,
+    }
+    record.update(fields)
+
+    if not _hooks:
+        yield record
+        return
+
+    _call_hooks('start', record)
+
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = '%s: %s' % (e.__class__.__name__, e)
+        raise
+    finally:
+        record['duration'] = time.time() - record['start']
+        _call_hooks('finish', record)
+
+
+class JSONLinesSink(Hook):
+    """Writes every finished operation as a JSON object on its own line."""
+    _file = None
+    _close = False
+    _lock = None
+
+    def __init__(self, path_or_file):
+        """
+
+        Arguments:
+        path_or_file -- str, path of a file to append to, or an open text
+                        file object
+        """
+        if hasattr(path_or_file, 'write'):
+            self._file = path_or_file
+        else:
+            self._file = open(path_or_file, 'a')
+            self._close = True
+
+        self._lock = threading.Lock()
+
+    def finish(self, record):
+        line = json.dumps(record, default=str, sort_keys=True) + '\n'
+
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        if self._close:
+            self._file.close()
+
+
+class PrometheusTextfileSink(Hook):
+    """Aggregates operations into counters written in the Prometheus text
+         format, for the node exporter's textfile collector. The file is
+         replaced atomically at most every interval seconds, and by
+         flush().
+
+    Metrics (labels operation, status and, with per_site, site):
+    <prefix>_operations_total
+    <prefix>_operation_duration_seconds_total
+    <prefix>_operation_bytes_total
+    """
+    _path = None
+    _prefix = None
+    _per_site = False
+    _interval = None
+    _last_write = 0
+    _lock = None
+    _metrics = None
+
+    def __init__(self, path, prefix='webappman', per_site=False, interval=5):
+        """
+
+        Arguments:
+        path -- str, output file, which should end in .prom
+
+        Keyword Arguments:
+        prefix   -- str, metric name prefix
+        per_site -- bool, add a site label
+        interval -- float, minimum seconds between automatic writes
+        """
+        self._path = path
+        self._prefix = prefix
+        self._per_site = per_site
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def finish(self, record):
+        labels = [('operation', record['operation']),
+                  ('status', 'error' if record['error'] else 'ok')]
+
+        if self._per_site:
+            labels.append(('site', record['site'] or ''))
+
+        key = tuple(labels)
+
+        with self._lock:
+            values = self._metrics.setdefault(key, [0, 0.0, 0])
+            values[0] += 1
+            values[1] += record['duration'] or 0
+            values[2] += record['bytes'] or 0
+
+            if time.time() - self._last_write >= self._interval:
+                self._write()
+
+    def _write(self):
+        names = (
+            ('operations_total', 'Number of operations'),
+            ('operation_duration_seconds_total',
+             'Total seconds spent in operations'),
+            ('operation_bytes_total', 'Bytes transferred or written'),
+        )
+        lines = []
+
+        for (i, (name, help_text)) in enumerate(names):
+            metric = '%s_%s' % (self._prefix, name)
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s counter' % (metric))
+
+            for (key, values) in sorted(self._metrics.items()):
+                labels = ','.join('%s="%s"' % (k, v.replace('\\', '\\\\')
+                                               .replace('"', '\\"'))
+                                  for (k, v) in key)
+                lines.append('%s{%s} %s' % (metric, labels, values[i]))
+
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(self._path) or '.',
+                                        prefix='.prom-')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.chmod(tmp_path, 0o644)
+        replace_file(tmp_path, self._path)
+
+        self._last_write = time.time()
+
+    def flush(self):
+        """Writes the metrics file now."""
+        with self._lock:
+            self._write()
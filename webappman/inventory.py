@@ -0,0 +1,173 @@
+#coding: utf-8
+"""Index of the modules and themes installed in a Drupal root"""
+
+from os.path import basename, join as path_join
+import os
+import re
+import threading
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+# Where drush dl puts projects, relative to the Drupal root
+DEFAULT_SCAN_DIRS = (
+    ('module', path_join('sites', 'all', 'modules')),
+    ('theme', path_join('sites', 'all', 'themes')),
+)
+
+_INFO_LINE = re.compile(r'^\s*([\w.]+)\s*=\s*(.*?)\s*$')
+
+
+def parse_info(path):
+    """Returns the top-level keys of a Drupal 7 .info file as a dict of str.
+         Array keys (dependencies[] = ...) are skipped."""
+    ret = {}
+
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.decode('utf-8', 'replace')
+            match = _INFO_LINE.match(line)
+
+            if not match or line.lstrip().startswith(';'):
+                continue
+
+            value = match.group(2)
+            if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+                value = value[1:-1]
+
+            ret[match.group(1)] = value
+
+    return ret
+
+
+class Project(object):
+    """A project (a directory with one or more .info files) found by
+         ModuleIndex"""
+    name = None
+    version = None
+    type = None
+    path = None
+    modules = None
+
+    def __init__(self, name, version, type, path, modules):
+        self.name = name
+        self.version = version
+        self.type = type
+        self.path = path
+        self.modules = modules
+
+    def __repr__(self):
+        return '<Project %s %s>' % (self.name, self.version)
+
+
+class ModuleIndex(object):
+    """Lists the projects installed under a Drupal root by reading .info
+         files. A project directory is scanned again only when its
+         modification time changed (drush dl replaces the whole directory),
+         so refreshing only lists the top of each project directory.
+
+    index = ModuleIndex('/var/www/example.com')
+    index.get('views').version  # '7.x-3.8'
+    """
+    _root = None
+    _scan_dirs = None
+    _cache = None
+    _lock = None
+
+    def __init__(self, root, scan_dirs=DEFAULT_SCAN_DIRS):
+        """
+
+        Arguments:
+        root -- str, Drupal root
+
+        Keyword Arguments:
+        scan_dirs -- list of (type, path relative to root) to look in
+        """
+        self._root = root
+        self._scan_dirs = scan_dirs
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _scan_project(self, path, type):
+        infos = []
+        stack = [path]
+
+        while stack:
+            for entry in scandir(stack.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.info'):
+                    infos.append(entry.path)
+
+        modules = sorted(basename(x)[:-len('.info')] for x in infos)
+        name = basename(path)
+        version = None
+
+        for info_path in sorted(infos, key=len):
+            info = parse_info(info_path)
+
+            if 'project' in info or 'version' in info:
+                name = info.get('project', name)
+                version = info.get('version')
+                break
+
+        return Project(name, version, type, path, modules)
+
+    def _find_projects(self, path, type, seen):
+        """Walks path down to the directories holding .info files, reusing
+             cached projects whose directory did not change."""
+        try:
+            entries = list(scandir(path))
+        except OSError:
+            return []
+
+        if any(x.name.endswith('.info') and x.is_file() for x in entries):
+            mtime = os.stat(path).st_mtime
+            seen.add(path)
+            cached = self._cache.get(path)
+
+            if cached and cached[0] == mtime:
+                return [cached[1]]
+
+            project = self._scan_project(path, type)
+            self._cache[path] = (mtime, project)
+
+            return [project]
+
+        ret = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                ret.extend(self._find_projects(entry.path, type, seen))
+
+        return ret
+
+    def projects(self):
+        """Returns a dict of project name to Project."""
+        ret = {}
+        seen = set()
+
+        with self._lock:
+            for (type, rel_path) in self._scan_dirs:
+                for project in self._find_projects(
+                        path_join(self._root, rel_path), type, seen):
+                    ret.setdefault(project.name, project)
+
+            for path in [x for x in self._cache if x not in seen]:
+                del self._cache[path]
+
+        return ret
+
+    def get(self, name):
+        """Returns the Project named name, or None."""
+        return self.projects().get(name)
+
+    def modules(self):
+        """Returns a dict of module (or theme) machine name to Project."""
+        ret = {}
+
+        for project in self.projects().values():
+            for module in project.modules:
+                ret.setdefault(module, project)
+
+        return ret
@@ -0,0 +1,212 @@
+#coding: utf-8
+"""Timestamped releases switched by an atomic symbolic link"""
+
+from os.path import basename, isdir, islink, join as path_join, realpath
+from shutil import move, rmtree as rmdir_force
+import os
+import threading
+import time
+
+
+class ReleaseError(Exception):
+    pass
+
+
+class Releases(object):
+    """Manages releases of a web application under a deployment root:
+
+    root/releases/20141018120000/  one complete build per release
+    root/shared/                   files kept across releases, for example
+                                   sites/*/files
+    root/current                   symbolic link to the live release
+
+    The web server serves root/current. A new release is built next to the
+      live one and only becomes live when activate() swaps the link, which
+      is a single atomic rename.
+
+    releases = Releases('/var/www/example.com', keep=5)
+    path = releases.new_release()
+    # build into path ...
+    releases.link_site_files(path)  # sites/*/files
+    releases.activate(path)
+    releases.prune(background=True)
+    """
+    _root = None
+    _keep = 5
+
+    def __init__(self, root, keep=5):
+        """
+
+        Arguments:
+        root -- str, deployment root
+
+        Keyword Arguments:
+        keep -- int, number of releases prune() keeps, including the live
+                one
+        """
+        self._root = realpath(root)
+        self._keep = keep
+
+    @property
+    def releases_dir(self):
+        return path_join(self._root, 'releases')
+
+    @property
+    def shared_dir(self):
+        return path_join(self._root, 'shared')
+
+    @property
+    def current_link(self):
+        return path_join(self._root, 'current')
+
+    def list(self):
+        """Returns the release names, oldest first."""
+        if not isdir(self.releases_dir):
+            return []
+
+        return sorted(x for x in os.listdir(self.releases_dir)
+                      if not x.startswith('.'))
+
+    def current(self):
+        """Returns the name of the live release, or None."""
+        if not islink(self.current_link):
+            return None
+
+        return basename(os.readlink(self.current_link).rstrip('/'))
+
+    def new_release(self):
+        """Returns the path for a new release. The directory itself is not
+             created, so it can be the target of Drush.init_dir()."""
+        if not isdir(self.releases_dir):
+            os.makedirs(self.releases_dir)
+
+        name = time.strftime('%Y%m%d%H%M%S')
+        path = path_join(self.releases_dir, name)
+        i = 1
+
+        while os.path.lexists(path):
+            path = path_join(self.releases_dir, '%s.%d' % (name, i))
+            i += 1
+
+        return path
+
+    def link_shared(self, release_path, shared_paths):
+        """Replaces paths in a release by symbolic links to the same paths in
+             the shared directory. The first time a path is shared, the
+             release's copy becomes the shared one.
+
+        Arguments:
+        release_path -- str, release directory
+        shared_paths -- list of paths relative to the release
+        """
+        for rel_path in shared_paths:
+            shared = path_join(self.shared_dir, rel_path)
+            target = path_join(release_path, rel_path)
+            parent = os.path.dirname(shared)
+
+            if not isdir(parent):
+                os.makedirs(parent)
+
+            if not os.path.lexists(shared):
+                if os.path.lexists(target):
+                    move(target, shared)
+                else:
+                    os.makedirs(shared)
+            elif islink(target) or not isdir(target):
+                if os.path.lexists(target):
+                    os.remove(target)
+            else:
+                rmdir_force(target)
+
+            if not isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+
+            os.symlink(shared, target)
+
+    def link_site_files(self, release_path):
+        """Shares the files directory of every site directory of a Drupal
+             release (sites/<site>/files, except sites/all) with
+             link_shared(). Returns the paths shared."""
+        sites_path = path_join(release_path, 'sites')
+        shared_paths = []
+
+        if isdir(sites_path):
+            shared_paths = [path_join('sites', x, 'files')
+                            for x in sorted(os.listdir(sites_path))
+                            if x != 'all' and
+                            isdir(path_join(sites_path, x))]
+
+        self.link_shared(release_path, shared_paths)
+
+        return shared_paths
+
+    def activate(self, release_path):
+        """Makes a release live by atomically pointing current at it."""
+        name = basename(release_path.rstrip('/'))
+
+        if not isdir(path_join(self.releases_dir, name)):
+            raise ReleaseError('No release %s in %s' % (name,
+                                                        self.releases_dir))
+
+        tmp_link = path_join(self._root, '.current-%d' % (os.getpid()))
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+
+        # Relative, so the deployment root can be moved
+        os.symlink(path_join('releases', name), tmp_link)
+        os.rename(tmp_link, self.current_link)
+
+    def rollback(self, steps=1):
+        """Makes the release steps before the live one live again. Returns
+             its name."""
+        releases = self.list()
+        current = self.current()
+
+        if current not in releases:
+            raise ReleaseError('The live release is unknown')
+
+        index = releases.index(current) - steps
+        if index < 0:
+            raise ReleaseError('No release %d before %s' % (steps, current))
+
+        self.activate(path_join(self.releases_dir, releases[index]))
+
+        return releases[index]
+
+    def _prune(self):
+        releases = self.list()
+        current = self.current()
+
+        if current in releases:
+            # Never prune the live release or anything newer (rolled back)
+            candidates = releases[:releases.index(current)]
+            keep = max(self._keep - 1 - (len(releases) - len(candidates) - 1),
+                       0)
+        else:
+            candidates = releases
+            keep = self._keep
+
+        doomed = candidates[:max(len(candidates) - keep, 0)]
+
+        for name in doomed:
+            rmdir_force(path_join(self.releases_dir, name))
+
+        return doomed
+
+    def prune(self, background=False):
+        """Deletes the oldest releases so that keep remain, never deleting
+             the live release or releases newer than it.
+
+        Keyword Arguments:
+        background -- bool, delete in a thread and return the thread; the
+                      interpreter waits for it before exiting
+
+        Returns the deleted release names, or the thread.
+        """
+        if not background:
+            return self._prune()
+
+        thread = threading.Thread(target=self._prune)
+        thread.start()
+
+        return thread
@@ -0,0 +1,88 @@
+from shutil import rmtree
+import os
+import sys
+import tempfile
+import unittest
+
+# Stand-in for drush: logs and echoes its arguments. Arguments containing
+#   fail make it exit with status 3, sleep makes it wait in a child process
+#   whose PID is appended to the log file name plus .pid. php-script runs a
+#   batch script by reporting each operation as ok unless its arguments
+#   contain fail; URIs containing noreport make it report nothing.
+FAKE_DRUSH = '''#!%s
+import base64, json, os, re, subprocess, sys
+
+args = sys.argv[1:]
+line = ' '.join(args)
+log = os.environ['WAM_TEST_DRUSH_LOG']
+
+with open(log, 'a') as f:
+    f.write(line + '\\n')
+print('drush ' + line)
+sys.stdout.flush()
+
+if 'sleep' in line:
+    child = subprocess.Popen(['sleep', '30'])
+    with open(log + '.pid', 'a') as f:
+        f.write('%%d\\n' %% (child.pid))
+    child.wait()
+
+if 'php-script' in args:
+    if 'noreport' in line:
+        sys.exit(0)
+    with open(args[args.index('php-script') + 1]) as f:
+        data = re.search(r"base64_decode\\('([^']+)'\\)", f.read()).group(1)
+    batch = json.loads(base64.b64decode(data).decode('utf-8'))
+    for (i, operation) in enumerate(batch['operations']):
+        ok = 'fail' not in json.dumps(operation)
+        print('WAM-BATCH ' + json.dumps({
+            'index': i, 'ok': ok, 'error': None if ok else 'failed'}))
+        if not ok and not batch['ignore_errors']:
+            sys.exit(1)
+    sys.exit(0)
+
+if 'fail' in line:
+    sys.stderr.write('failed %%s\\n' %% (line))
+    sys.exit(3)
+''' % (sys.executable)
+
+
+class FakeDrushTestCase(unittest.TestCase):
+    """Puts FAKE_DRUSH first in PATH for each test. self.tmp_dir is removed
+         afterwards."""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.tmp_dir, 'bin')
+        os.makedirs(bin_dir)
+
+        drush = os.path.join(bin_dir, 'drush')
+        with open(drush, 'w') as f:
+            f.write(FAKE_DRUSH)
+        os.chmod(drush, 0o755)
+
+        self.drush_log = os.path.join(self.tmp_dir, 'drush.log')
+        self.old_environ = dict(os.environ)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['WAM_TEST_DRUSH_LOG'] = self.drush_log
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        rmtree(self.tmp_dir)
+
+    def drush_calls(self):
+        """Returns the argument strings drush was called with."""
+        try:
+            with open(self.drush_log) as f:
+                return f.read().splitlines()
+        except IOError:
+            return []
+
+    def drush_children(self):
+        """Returns the PIDs of the children started by sleeping drush
+             calls."""
+        try:
+            with open(self.drush_log + '.pid') as f:
+                return [int(x) for x in f.read().split()]
+        except IOError:
+            return []
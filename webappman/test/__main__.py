@@ -1,5 +1,16 @@
-from webappman.test import drupal
+from webappman.test import (archive, assets, cache, clone, dbsnapshot,
+                            deploy, drupal, instrument, inventory, release,
+                            wordpress)
+import sys
 import unittest
 
-suite = unittest.TestLoader().loadTestsFromModule(drupal)
+modules = [archive, assets, cache, clone, dbsnapshot, deploy, drupal,
+           instrument, inventory, release, wordpress]
+if sys.version_info >= (3, 5):
+    from webappman.test import asyncdrush
+    modules.append(asyncdrush)
+
+suite = unittest.TestSuite()
+for module in modules:
+    suite.addTests(unittest.TestLoader().loadTestsFromModule(module))
 unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,60 @@
+from io import BytesIO
+from shutil import rmtree
+from webappman import archive
+import os
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+
+def _tar(members):
+    buf = BytesIO()
+
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for (name, data) in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, BytesIO(data))
+
+    buf.seek(0)
+    return buf
+
+
+def _zip(members):
+    buf = BytesIO()
+
+    with zipfile.ZipFile(buf, 'w') as z:
+        for (name, data) in members:
+            z.writestr(name, data)
+
+    buf.seek(0)
+    return buf
+
+
+class TestExtract(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dest)
+
+    def test_tar_strip_components(self):
+        paths = archive.extract_tar(_tar([('top-1234/js/a.js', b'a')]),
+                                    self.dest, strip_components=1)
+
+        self.assertEqual(paths, [os.path.join(self.dest, 'js', 'a.js')])
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(f.read(), b'a')
+
+    def test_zip_strip_components(self):
+        archive.extract_zip(_zip([('top/', b''), ('top/b.php', b'b')]),
+                            self.dest, strip_components=1)
+
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, 'b.php')))
+
+    def test_path_traversal(self):
+        self.assertRaises(archive.ArchiveError, archive.extract_tar,
+                          _tar([('top/../../evil', b'x')]), self.dest)
+        self.assertRaises(archive.ArchiveError, archive.extract_zip,
+                          _zip([('/etc/evil', b'x')]), self.dest)
@@ -0,0 +1,104 @@
+from shutil import rmtree
+from webappman import assets
+import os
+import tempfile
+import unittest
+
+
+class TestManifest(unittest.TestCase):
+    def test_split_remote(self):
+        self.assertEqual(assets.split_remote('web1:/var/files'),
+                         ('web1', '/var/files'))
+        self.assertEqual(assets.split_remote('/var/files'),
+                         (None, '/var/files'))
+
+    def test_changed_entries(self):
+        manifest = {
+            'a.jpg': [10, 100, None],
+            'b.jpg': [20, 100, None],
+        }
+        listing = {
+            'a.jpg': (10, 100),
+            'b.jpg': (21, 200),
+            'c.jpg': (5, 300),
+        }
+        (changed, new_manifest) = assets.changed_entries(listing, manifest)
+
+        self.assertEqual(sorted(changed), [('b.jpg', 21), ('c.jpg', 5)])
+        self.assertEqual(new_manifest['b.jpg'], [21, 200, None])
+
+    def test_file_names_round_trip(self):
+        name = assets._fs_decode(b'caf\xe9.jpg')
+
+        self.assertEqual(assets._fs_encode(name), b'caf\xe9.jpg')
+        self.assertEqual(assets._fs_encode(b'a.jpg'), b'a.jpg')
+
+    def test_make_shards(self):
+        entries = [('a', 100), ('b', 60), ('c', 50), ('d', 10)]
+        shards = assets.make_shards(entries, 2)
+
+        self.assertEqual(sorted(sum(x[1] for x in shard) for shard in shards),
+                         [110, 110])
+        self.assertEqual(assets.make_shards([], 4), [])
+
+    def test_make_batches(self):
+        entries = [('b/2', 40), ('a/1', 40), ('c/3', 40), ('d/4', 500)]
+
+        self.assertEqual(assets.make_batches(entries, 100, 10),
+                         [[('a/1', 40), ('b/2', 40)], [('c/3', 40)],
+                          [('d/4', 500)]])
+        self.assertEqual(len(assets.make_batches(entries, 10000, 3)), 2)
+
+
+class TestSyncTreeBundled(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp_dir, 'source')
+
+        for i in range(30):
+            path = os.path.join(self.source, '2014', '%02d' % (i % 3),
+                                'thumb-%d.jpg' % (i))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(b'x' * (i + 1))
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_local(self):
+        dest = os.path.join(self.tmp_dir, 'dest')
+        manifest = os.path.join(self.tmp_dir, 'manifest.json')
+        results = assets.sync_tree_bundled(self.source, dest,
+                                           manifest_file=manifest,
+                                           batch_files=8)
+
+        self.assertEqual([x.method for x in results], ['tar'] * 4)
+        self.assertEqual(sum(x.files for x in results), 30)
+
+        path = os.path.join('2014', '02', 'thumb-29.jpg')
+        with open(os.path.join(dest, path), 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 30)
+        self.assertEqual(
+            int(os.stat(os.path.join(dest, path)).st_mtime),
+            int(os.stat(os.path.join(self.source, path)).st_mtime))
+
+        self.assertEqual(assets.sync_tree_bundled(
+            self.source, dest, manifest_file=manifest), [])
+
+    def test_dest_removed(self):
+        dest = os.path.join(self.tmp_dir, 'dest')
+        manifest = os.path.join(self.tmp_dir, 'manifest.json')
+        assets.sync_tree_bundled(self.source, dest, manifest_file=manifest)
+
+        os.remove(os.path.join(dest, '2014', '01', 'thumb-1.jpg'))
+        results = assets.sync_tree_bundled(self.source, dest,
+                                           manifest_file=manifest)
+        self.assertEqual(sum(x.files for x in results), 1)
+
+        rmtree(dest)
+        results = assets.sync_tree_bundled(self.source, dest,
+                                           manifest_file=manifest)
+        self.assertEqual(sum(x.files for x in results), 30)
+        self.assertTrue(os.path.isfile(os.path.join(dest, '2014', '01',
+                                                    'thumb-1.jpg')))
@@ -0,0 +1,82 @@
+from webappman import asyncdrush, drupal
+from webappman.test import FakeDrushTestCase
+import asyncio
+import io
+import os
+import time
+
+
+def is_running(pid):
+    try:
+        with open('/proc/%d/stat' % (pid)) as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class TestAsyncDrush(FakeDrushTestCase):
+    def setUp(self):
+        FakeDrushTestCase.setUp(self)
+        root = os.path.join(self.tmp_dir, 'root')
+
+        for name in ('all', 'default', 'a.example.com', 'b.example.com'):
+            os.makedirs(os.path.join(root, 'sites', name))
+
+        self.loop = asyncio.new_event_loop()
+        self.drush = asyncdrush.AsyncDrush(root, stdout=io.StringIO(),
+                                           max_workers=2)
+
+    def tearDown(self):
+        self.loop.close()
+        FakeDrushTestCase.tearDown(self)
+
+    def run_coroutine(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_fan_out(self):
+        results = self.run_coroutine(self.drush.cc())
+
+        self.assertEqual([x.site for x in results], [
+            'default', 'http://a.example.com', 'http://b.example.com'])
+        self.assertTrue(all(x.ok for x in results))
+        self.assertEqual(sorted(self.drush_calls()), [
+            '--uri=http://a.example.com -q cc all',
+            '--uri=http://b.example.com -q cc all',
+            '-q cc all'])
+
+        output = self.run_coroutine(self.drush.command_output('status',
+                                                              once=True))
+        self.assertEqual(output, [('default', b'drush -q status')])
+
+    def test_multi_site_error(self):
+        try:
+            self.run_coroutine(self.drush.vset('fail', 1))
+            self.fail('DrushMultiSiteError not raised')
+        except drupal.DrushMultiSiteError as e:
+            self.assertEqual(len(e.failures), 3)
+            self.assertEqual(e.failures[0].returncode, 3)
+
+        results = self.run_coroutine(self.drush.command('vset fail 1',
+                                                        ignore_errors=True))
+        self.assertEqual(len(results), 3)
+
+    def test_cancel_kills_process_group(self):
+        task = self.loop.create_task(self.drush.command('sleep', once=True))
+        deadline = time.time() + 10
+
+        while not self.drush_children() and time.time() < deadline:
+            self.run_coroutine(asyncio.sleep(0.05))
+
+        (child,) = self.drush_children()
+        self.assertTrue(is_running(child))
+
+        task.cancel()
+        self.assertRaises(asyncio.CancelledError, self.run_coroutine, task)
+
+        while is_running(child) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(is_running(child))
+
+    def test_batch_not_supported(self):
+        self.assertRaises(drupal.DrushError, self.drush.batch)
+        self.assertRaises(drupal.DrushError, self.drush.deferred)
@@ -0,0 +1,120 @@
+from shutil import rmtree
+from webappman import cache
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.uris = {}
+
+        for name in ('a', 'b', 'c'):
+            path = os.path.join(self.tmp_dir, name + '.txt')
+            with open(path, 'wb') as f:
+                f.write((name * 100).encode('ascii'))
+            self.uris[name] = 'file://' + path
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_fetch_serves_from_cache(self):
+        c = cache.ArtifactCache(self.cache_dir)
+        target = os.path.join(self.tmp_dir, 'out')
+
+        c.fetch(self.uris['a'], target)
+        os.remove(self.uris['a'][len('file://'):])
+        c.fetch(self.uris['a'], target)
+
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), b'a' * 100)
+
+    def test_offline_miss(self):
+        c = cache.ArtifactCache(self.cache_dir, offline=True)
+        self.assertRaises(cache.ArtifactCacheError, c.open, self.uris['a'])
+
+    def test_checksum_mismatch(self):
+        c = cache.ArtifactCache(self.cache_dir)
+        self.assertRaises(cache.ChecksumError, c.open, self.uris['a'],
+                          sha256='0' * 64)
+
+        digest = hashlib.sha256(b'a' * 100).hexdigest()
+        with c.open(self.uris['a'], sha256=digest) as f:
+            self.assertEqual(f.read(), b'a' * 100)
+
+    def test_lru_eviction(self):
+        c = cache.ArtifactCache(self.cache_dir, max_size=200)
+
+        for name in ('a', 'b'):
+            c.open(self.uris[name]).close()
+        c.open(self.uris['a']).close()  # b is now least recently used
+        c.open(self.uris['c']).close()
+
+        offline = cache.ArtifactCache(self.cache_dir, offline=True)
+        offline.open(self.uris['a']).close()
+        offline.open(self.uris['c']).close()
+        self.assertRaises(cache.ArtifactCacheError, offline.open,
+                          self.uris['b'])
+
+    def test_concurrent_misses_download_once(self):
+        c = cache.ArtifactCache(self.cache_dir)
+        download = c._download
+        downloads = []
+
+        def slow_download(uri):
+            downloads.append(uri)
+            time.sleep(0.05)
+            return download(uri)
+
+        c._download = slow_download
+        threads = [threading.Thread(target=lambda: c.open(
+            self.uris['a']).close()) for _ in range(4)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(downloads, [self.uris['a']])
+
+    def test_hit_hashes_once(self):
+        c = cache.ArtifactCache(self.cache_dir)
+        c.open(self.uris['a']).close()
+
+        hashed = []
+        stream_sha256 = cache._stream_sha256
+
+        def counting_sha256(f):
+            hashed.append(f.name)
+            return stream_sha256(f)
+
+        cache._stream_sha256 = counting_sha256
+        try:
+            for _ in range(3):
+                with c.open(self.uris['a']) as f:
+                    self.assertEqual(f.read(), b'a' * 100)
+            self.assertEqual(hashed, [])
+
+            # Another process starts out with nothing verified
+            other = cache.ArtifactCache(self.cache_dir)
+            for _ in range(3):
+                other.open(self.uris['a']).close()
+            self.assertEqual(len(hashed), 1)
+        finally:
+            cache._stream_sha256 = stream_sha256
+
+    def test_modified_blob_downloaded_again(self):
+        c = cache.ArtifactCache(self.cache_dir)
+        digest = hashlib.sha256(b'a' * 100).hexdigest()
+        c.open(self.uris['a']).close()
+
+        with open(c._blob_path(digest), 'wb') as f:
+            f.write(b'corrupt')
+
+        with c.open(self.uris['a']) as f:
+            self.assertEqual(f.read(), b'a' * 100)
@@ -0,0 +1,91 @@
+from shutil import rmtree
+from webappman import clone
+import os
+import tempfile
+import unittest
+
+
+class TestCloneTree(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'src')
+        os.makedirs(os.path.join(self.src, 'sites', 'default'))
+
+        for name in ('index.php', os.path.join('sites', 'default', 'a.php')):
+            with open(os.path.join(self.src, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_hardlink_copies_copy_paths(self):
+        dst = os.path.join(self.tmp_dir, 'dst')
+        mode = clone.clone_tree(self.src, dst, mode='hardlink',
+                                copy_paths=('sites',))
+
+        self.assertEqual(mode, 'hardlink')
+        self.assertEqual(os.stat(os.path.join(dst, 'index.php')).st_nlink, 2)
+        self.assertEqual(os.stat(os.path.join(dst, 'sites', 'default',
+                                              'a.php')).st_nlink, 1)
+
+    def test_unshare(self):
+        dst = os.path.join(self.tmp_dir, 'dst')
+        clone.clone_tree(self.src, dst, mode='hardlink')
+        path = os.path.join(dst, 'index.php')
+
+        self.assertTrue(clone.unshare(path))
+        with open(path, 'w') as f:
+            f.write('patched')
+
+        with open(os.path.join(self.src, 'index.php')) as f:
+            self.assertEqual(f.read(), 'index.php')
+        self.assertFalse(clone.unshare(path))
+
+    def test_existing_empty_dst(self):
+        dst = os.path.join(self.tmp_dir, 'dst')
+        check_call = clone.sp.check_call
+
+        def cp_without_reflink(command_line, **kwargs):
+            return check_call([x for x in command_line
+                               if x != '--reflink=always'], **kwargs)
+
+        for mode in ('reflink', 'hardlink', 'copy'):
+            os.makedirs(dst)
+            clone.sp.check_call = cp_without_reflink
+
+            try:
+                self.assertEqual(clone.clone_tree(self.src, dst, mode=mode),
+                                 mode)
+            finally:
+                clone.sp.check_call = check_call
+
+            self.assertEqual(sorted(os.listdir(dst)), ['index.php', 'sites'])
+            rmtree(dst)
+
+    def test_failure_keeps_existing_dst(self):
+        dst = os.path.join(self.tmp_dir, 'dst')
+        os.makedirs(dst)
+        check_call = clone.sp.check_call
+
+        def fail(command_line, **kwargs):
+            with open(os.path.join(dst, 'partial'), 'w'):
+                pass
+            raise OSError('no reflink')
+
+        clone.sp.check_call = fail
+        try:
+            self.assertRaises(clone.CloneError, clone.clone_tree, self.src,
+                              dst, mode='reflink')
+            self.assertEqual(clone.clone_tree(self.src, dst), 'hardlink')
+        finally:
+            clone.sp.check_call = check_call
+
+        self.assertEqual(sorted(os.listdir(dst)), ['index.php', 'sites'])
+
+    def test_non_empty_dst(self):
+        with open(os.path.join(self.tmp_dir, 'keep'), 'w'):
+            pass
+
+        self.assertRaises(clone.CloneError, clone.clone_tree, self.src,
+                          self.tmp_dir)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, 'keep')))
@@ -0,0 +1,127 @@
+from shutil import rmtree
+from webappman import dbsnapshot
+import gzip
+import os
+import tempfile
+import threading
+import unittest
+
+
+class FakeCursor(object):
+    def __init__(self, server):
+        self.server = server
+        self.rows = []
+
+    def execute(self, query, args=None):
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+
+        with self.server.lock:
+            self.server.executed.append(query)
+
+        if query.startswith('SELECT TABLE_NAME'):
+            self.rows = [(name, len(rows))
+                         for (name, (_, rows)) in self.server.tables.items()]
+        elif query.startswith('SHOW CREATE TABLE'):
+            name = query.split('`')[1]
+            self.rows = [(name, self.server.tables[name][0])]
+        elif query.startswith('SELECT * FROM'):
+            self.rows = list(self.server.tables[query.split('`')[1]][1])
+        else:
+            self.rows = []
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+    def fetchall(self):
+        (ret, self.rows) = (self.rows, [])
+        return ret
+
+    def fetchmany(self, size):
+        (ret, self.rows) = (self.rows[:size], self.rows[size:])
+        return ret
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, server):
+        self.server = server
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self.server)
+
+    def literal(self, value):
+        if value is None:
+            return b'NULL'
+        if isinstance(value, int):
+            return str(value).encode('utf-8')
+        return ("'%s'" % (value.replace("'", "\\'"))).encode('utf-8')
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeServer(object):
+    def __init__(self, tables=None):
+        self.tables = tables or {}
+        self.executed = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = FakeServer({
+            'node': ('CREATE TABLE `node` (nid int)',
+                     [(x, 'title %d' % (x)) for x in range(25)]),
+            'users': ('CREATE TABLE `users` (uid int)',
+                      [(0, None), (1, "admin's")]),
+            'cache_page': ('CREATE TABLE `cache_page` (cid int)', [(1,)]),
+            'search_index': ('CREATE TABLE `search_index` (a int)', [(1,)]),
+        })
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_snapshot_and_restore(self):
+        results = dbsnapshot.snapshot(
+            self.source.connect, self.tmp_dir, workers=3,
+            skip_tables=['search_*'], chunk_rows=4, statement_bytes=100,
+            cursor_class=None)
+
+        by_table = dict((x.table, x) for x in results)
+        self.assertEqual(sorted(by_table), ['cache_page', 'node', 'users'])
+        self.assertEqual(by_table['node'].rows, 25)
+        self.assertFalse(by_table['cache_page'].data)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.tmp_dir, 'cache_page.sql.gz')))
+
+        with gzip.open(os.path.join(self.tmp_dir, 'node.sql.gz')) as f:
+            lines = f.read().decode('utf-8').splitlines()
+        self.assertGreater(len(lines), 1)
+        self.assertTrue(lines[0].startswith(
+            "INSERT INTO `node` VALUES (0,'title 0'),"))
+
+        target = FakeServer()
+        dbsnapshot.restore(target.connect, self.tmp_dir, workers=2)
+
+        executed = target.executed
+        self.assertIn('CREATE TABLE `cache_page` (cid int)', executed)
+        self.assertIn("INSERT INTO `users` VALUES (0,NULL),(1,'admin\\'s')",
+                      executed)
+        self.assertEqual(len([x for x in executed
+                              if x.startswith('INSERT INTO `node`')]),
+                         len(lines))
+        self.assertFalse(any('search_index' in x for x in executed))
+
+    def test_restore_incomplete(self):
+        self.assertRaises(dbsnapshot.SnapshotError, dbsnapshot.restore,
+                          self.source.connect, self.tmp_dir)
@@ -0,0 +1,105 @@
+from webappman import deploy
+from webappman.test import FakeDrushTestCase
+import os
+import threading
+import time
+import unittest
+
+
+class TestTaskGraph(unittest.TestCase):
+    def test_dependencies_and_cap(self):
+        graph = deploy.TaskGraph()
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+        finished = []
+
+        def work(name):
+            def func():
+                with lock:
+                    state['running'] += 1
+                    state['peak'] = max(state['peak'], state['running'])
+                time.sleep(0.02)
+                with lock:
+                    state['running'] -= 1
+                    finished.append(name)
+            return func
+
+        graph.add('core', work('core'))
+        for name in ('a', 'b', 'c', 'd'):
+            graph.add(name, work(name), deps=['core'])
+        graph.add('enable', work('enable'), deps=['a', 'b', 'c', 'd'])
+
+        graph.run(max_workers=2)
+
+        self.assertEqual(finished[0], 'core')
+        self.assertEqual(finished[-1], 'enable')
+        self.assertEqual(state['peak'], 2)
+        self.assertEqual([x.name for x in graph.critical_path()][0], 'core')
+        self.assertEqual(graph.critical_path()[-1].name, 'enable')
+
+    def test_failure_skips_dependents(self):
+        graph = deploy.TaskGraph()
+
+        def fail():
+            raise ValueError('broken')
+
+        graph.add('core', fail)
+        graph.add('settings', lambda: None, deps=['core'])
+
+        self.assertRaises(deploy.DeployError, graph.run)
+        self.assertIsInstance(graph.tasks['core'].error, ValueError)
+        self.assertTrue(graph.tasks['settings'].skipped)
+
+    def test_cycle(self):
+        graph = deploy.TaskGraph()
+        graph.add('a', lambda: None, deps=['b'])
+        graph.add('b', lambda: None, deps=['a'])
+
+        self.assertRaises(deploy.DeployError, graph.order)
+
+
+class TestBuildGraph(unittest.TestCase):
+    def test_tasks(self):
+        (graph, _) = deploy.build_graph({
+            'target': '/nonexistent/site',
+            'modules': ['views'],
+            'enable': ['views'],
+            'libraries': ['ckeditor'],
+            'settings': {'default': {}},
+        })
+
+        self.assertEqual(sorted(graph.tasks), [
+            'core', 'dl:views', 'enable', 'lib:ckeditor', 'render-settings',
+            'settings'])
+        self.assertEqual(graph.tasks['render-settings'].deps, [])
+        self.assertEqual(sorted(graph.tasks['enable'].deps),
+                         ['core', 'dl:views', 'lib:ckeditor', 'settings'])
+
+    def test_database_tasks_wait_for_core(self):
+        (graph, _) = deploy.build_graph({
+            'target': '/nonexistent/site',
+            'enable': ['views'],
+            'variables': {'site_name': 'Example'},
+        })
+
+        self.assertEqual(graph.tasks['enable'].deps, ['core'])
+        self.assertEqual(graph.tasks['variables'].deps, ['enable'])
+
+
+class TestDeploySites(FakeDrushTestCase):
+    def test_settings_sites_get_variables(self):
+        target = os.path.join(self.tmp_dir, 'site')
+        site = {'databases': {}, 'conf': {}, 'ini_set': {}}
+        (graph, drush) = deploy.build_graph({
+            'target': target,
+            'settings': {'default': site, 'b.example.com': site},
+            'variables': {'site_name': 'Example'},
+        })
+        graph.tasks['core'].func = lambda: os.makedirs(target)
+
+        graph.run()
+
+        self.assertEqual(drush.sites(), ['default', 'b.example.com'])
+        self.assertEqual(len(graph.tasks['settings'].result), 2)
+        self.assertTrue(any('--uri=http://b.example.com' in x and
+                            'php-script' in x for x in self.drush_calls()))
@@ -1,6 +1,15 @@
+from base64 import b64decode
+from shutil import rmtree
 from webappman import drupal
+from webappman.test import FakeDrushTestCase
 from osext import filesystem as fs
+import io
+import json
 import os
+import re
+import sqlite3
+import tempfile
+import threading
 import unittest
 
 class TestFunctions(unittest.TestCase):
@@ -26,3 +35,636 @@ class TestFunctions(unittest.TestCase):
 
         self.assertTrue(drupal.is_production(info_file=info_file))
         os.remove(info_file)
+
+
+class TestDrushBatch(unittest.TestCase):
+    def test_script_embeds_operations(self):
+        batch = drupal.DrushBatch(ignore_errors=True)
+        batch.add('vset', 'site_name', "It's\\")
+        batch.add('en', ['views', 'ctools'])
+        batch.add('cc', 'all')
+
+        script = batch.script()
+        data = re.search(r"base64_decode\('([^']+)'\)", script).group(1)
+        data = json.loads(b64decode(data).decode('utf-8'))
+
+        self.assertTrue(script.startswith('<?php\n'))
+        self.assertTrue(data['ignore_errors'])
+        self.assertEqual(data['operations'], [
+            ['vset', 'site_name', "It's\\"],
+            ['en', ['views', 'ctools']],
+            ['cc', 'all'],
+        ])
+        self.assertIn('drupal_flush_all_caches();', script)
+
+
+class FakeCursor(object):
+    """Minimal MySQLdb cursor backed by a dict standing in for the variable
+         table."""
+    def __init__(self, table, log):
+        self.table = table
+        self.log = log
+        self.rowcount = 0
+        self._row = None
+        self._rows = []
+
+    def execute(self, query, args=None):
+        self.log.append(query)
+
+        if query.startswith('SELECT COUNT(*)'):
+            self._row = (len([x for x in args if x in self.table]),)
+        elif query.startswith('SELECT name, value'):
+            self._rows = sorted(self.table.items())
+        elif query.startswith('DELETE FROM variable'):
+            for name in args:
+                del self.table[name]
+        elif query.startswith('INSERT'):
+            self.rowcount = 0
+            for i in range(0, len(args), 2):
+                (name, value) = args[i:i + 2]
+                if name not in self.table:
+                    self.rowcount += 1
+                elif self.table[name] != value:
+                    self.rowcount += 2
+                self.table[name] = value
+
+    def fetchone(self):
+        return self._row
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, table=None):
+        self.table = table if table is not None else {}
+        self.log = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self.table, self.log)
+
+    def commit(self):
+        self.commits += 1
+
+
+class TestVsetMany(unittest.TestCase):
+    def test_chunked_upsert_counts(self):
+        from langutil import php
+
+        connection = FakeConnection({
+            'a': php.serialize(1),
+            'b': php.serialize(2),
+        })
+        drush = drupal.Drush('/nonexistent')
+        counts = drush.vset_many({'a': 1, 'b': 3, 'c': 4, 'd': 5, 'e': 6},
+                                 connection, chunk_size=2, commit='chunk')
+
+        self.assertEqual(counts, {'inserted': 3, 'updated': 1,
+                                  'unchanged': 1})
+        inserts = [x for x in connection.log if x.startswith('INSERT')]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(connection.commits, 3)
+
+
+class TestReconcileVariables(unittest.TestCase):
+    def setUp(self):
+        from langutil import php
+
+        self.connection = FakeConnection({
+            'site_name': php.serialize('Old'),
+            'cron_key': php.serialize('abc'),
+            'theme_default': php.serialize('bartik'),
+            'stale': php.serialize(1),
+        })
+        self.drush = drupal.Drush('/nonexistent')
+        self.desired = {
+            'site_name': 'New',
+            'theme_default': 'bartik',
+            'page_cache': 1,
+        }
+
+    def test_dry_run(self):
+        diff = self.drush.reconcile_variables(self.desired, self.connection,
+                                              delete_unmanaged=True,
+                                              keep=['cron_*'], dry_run=True)
+
+        self.assertEqual(diff, {
+            'added': ['page_cache'],
+            'changed': ['site_name'],
+            'removed': ['stale'],
+            'unchanged': 1,
+        })
+        self.assertEqual(self.connection.commits, 0)
+
+    def test_writes_only_changes(self):
+        self.drush.reconcile_variables(self.desired, self.connection)
+        log_length = len(self.connection.log)
+        diff = self.drush.reconcile_variables(self.desired, self.connection)
+
+        self.assertEqual(diff['unchanged'], 3)
+        self.assertEqual(len(self.connection.log), log_length + 1)
+        self.assertIn('stale', self.connection.table)
+
+
+class SQLiteCursor(object):
+    """MySQLdb style cursor (%s placeholders, args keyword) over sqlite3"""
+    def __init__(self, connection, log):
+        self._cursor = connection.cursor()
+        self.log = log
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def execute(self, query, args=None):
+        self.log.append(query)
+        self._cursor.execute(query.replace('%s', '?'), args or ())
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection(object):
+    def __init__(self):
+        self.connection = sqlite3.connect(':memory:')
+        self.log = []
+        self.commits = 0
+
+    def cursor(self):
+        return SQLiteCursor(self.connection, self.log)
+
+    def commit(self):
+        self.commits += 1
+        self.connection.commit()
+
+
+class TestBatchedReplace(unittest.TestCase):
+    def setUp(self):
+        self.connection = SQLiteConnection()
+        self.connection.connection.execute(
+            'CREATE TABLE registry (name TEXT, type TEXT, filename TEXT, '
+            'PRIMARY KEY (name, type))')
+
+        rows = []
+        for i in range(10):
+            for type in ('class', 'interface'):
+                rows.append(('name%02d' % (i), type,
+                             'sites/all/modules/m%d/x.inc' % (i)))
+        rows.append(('name99', 'class', 'sites/all/modules/contrib/y.inc'))
+        rows.append(('other', 'class', 'modules/system/z.inc'))
+        self.connection.connection.executemany(
+            'INSERT INTO registry VALUES (?, ?, ?)', rows)
+
+    def filenames(self):
+        return [x[0] for x in self.connection.connection.execute(
+            'SELECT filename FROM registry ORDER BY name, type')]
+
+    def replace(self, **kwargs):
+        return drupal.batched_replace(
+            self.connection, 'registry', 'filename', ('name', 'type'),
+            'sites/all/modules/', 'sites/all/modules/contrib/',
+            'sites/all/modules/%', not_like='%/contrib/%', pause=0, **kwargs)
+
+    def test_dry_run(self):
+        before = self.filenames()
+
+        self.assertEqual(self.replace(dry_run=True), 20)
+        self.assertEqual(self.filenames(), before)
+        self.assertEqual(self.connection.commits, 0)
+
+    def test_batches(self):
+        progress = []
+        changed = self.replace(batch_size=3,
+                               progress=lambda *x: progress.append(x))
+
+        self.assertEqual(changed, 20)
+        # 22 rows, 3 per batch: the last batch has 1 row
+        self.assertEqual(len(progress), 8)
+        self.assertEqual(progress[0], (1, 3, 3))
+        self.assertEqual(progress[-1], (8, 22, 20))
+        self.assertEqual(self.connection.commits, 8)
+
+        filenames = self.filenames()
+        self.assertEqual(len([x for x in filenames
+                              if x.startswith('sites/all/modules/contrib/')]),
+                         21)
+        self.assertIn('modules/system/z.inc', filenames)
+        self.assertFalse(any('contrib/contrib' in x for x in filenames))
+
+        # Key ranges are spelled out, never (name, type) > (...)
+        self.assertFalse(any('(name, type) >' in x or '(name, type) <' in x
+                             for x in self.connection.log))
+        self.assertEqual(self.replace(batch_size=3), 0)
+
+
+class TestInstallLibs(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_hooks = dict(drupal._lib_hooks)
+        started = threading.Event()
+
+        def first(stdout=None, path=None):
+            # Only returns if second runs at the same time
+            if not started.wait(5):
+                raise AssertionError('Libraries installed one at a time')
+            os.makedirs(os.path.join(path, 'first'))
+
+        def second(stdout=None, path=None):
+            started.set()
+            os.makedirs(os.path.join(path, 'second'))
+
+        def broken(stdout=None, path=None):
+            raise ValueError('bad archive')
+
+        drupal._lib_hooks.update({'first': first, 'second': second,
+                                  'broken': broken})
+        self.drush = drupal.Drush(self.root)
+        self.libraries_dir = os.path.join(self.root, 'sites', 'all',
+                                          'libraries')
+
+    def tearDown(self):
+        drupal._lib_hooks.clear()
+        drupal._lib_hooks.update(self.old_hooks)
+        rmtree(self.root)
+
+    def test_concurrent(self):
+        results = self.drush.install_libs(['first', 'second', 'first'])
+
+        self.assertEqual([x.name for x in results], ['first', 'second'])
+        self.assertTrue(all(x.ok for x in results))
+        self.assertEqual(sorted(os.listdir(self.libraries_dir)),
+                         ['first', 'second'])
+
+    def test_failure_report(self):
+        try:
+            self.drush.install_libs(['broken', 'first', 'second'])
+            self.fail('LibraryError not raised')
+        except drupal.LibraryError as e:
+            self.assertEqual([x.name for x in e.results],
+                             ['broken', 'first', 'second'])
+            self.assertEqual([x.name for x in e.failures], ['broken'])
+            self.assertIsInstance(e.failures[0].error, ValueError)
+            self.assertIn('broken (bad archive)', str(e))
+
+        self.assertTrue(os.path.isdir(os.path.join(self.libraries_dir,
+                                                   'second')))
+
+        results = self.drush.install_libs(['broken'], ignore_errors=True)
+        self.assertFalse(results[0].ok)
+
+    def test_unknown_library(self):
+        self.assertRaises(drupal.DrushError, self.drush.install_libs,
+                          ['second', 'nonexistent'])
+        self.assertFalse(os.path.exists(self.libraries_dir))
+
+
+class TestWriteSettingsFiles(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data = {
+            'default': {
+                'databases': {'default': {'default': {'database': 'd'}}},
+                'conf': {'page_cache': 1},
+                'ini_set': {'session.gc_divisor': 1},
+                'drupal_hash_salt': 'salt',
+            },
+        }
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def test_skips_unchanged(self):
+        path = os.path.join(self.root, 'sites', 'default', 'settings.php')
+
+        self.assertEqual(list(drupal.write_settings_files(self.data,
+                                                          self.root)),
+                         [('default', path, True)])
+        mtime = os.stat(path).st_mtime
+        self.assertEqual(list(drupal.write_settings_files(self.data,
+                                                          self.root)),
+                         [('default', path, False)])
+        self.assertEqual(os.stat(path).st_mtime, mtime)
+
+        with open(path) as f:
+            code = drupal.generate_settings_files(self.data)[0][1]
+            self.assertEqual(f.read(), '<?php\n' + code + '\n')
+
+    def test_shared(self):
+        self.data['example.com'] = {
+            'databases': {'default': {'default': {'database': 'e'}}},
+            'conf': {'page_cache': 1, 'site_name': 'Example'},
+            'ini_set': {'session.gc_divisor': 1},
+            'drupal_hash_salt': 'other salt',
+        }
+        files = dict(drupal.generate_settings_files(self.data, shared=True))
+        shared = files[drupal.SHARED_SETTINGS_FILE]
+        site = files[os.path.join('sites', 'example.com', 'settings.php')]
+
+        self.assertIn("'page_cache' => 1", shared)
+        self.assertIn("ini_set('session.gc_divisor', 1);", shared)
+        self.assertNotIn('salt', shared)
+        self.assertTrue(site.startswith('require DRUPAL_ROOT'))
+        self.assertIn("'site_name' => 'Example',\n) + $conf;", site)
+        self.assertNotIn('page_cache', site)
+        self.assertNotIn('ini_set', site)
+        self.assertIn("$drupal_hash_salt = 'other salt';", site)
+
+        written = list(drupal.write_settings_files(self.data, self.root,
+                                                   shared=True))
+        self.assertEqual(written[0][0], None)
+        self.assertEqual(len(written), 3)
+
+
+class TestSiteSelection(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+        for name in ('all', 'default', 'a.example.com', 'b.example.com',
+                     'intranet'):
+            os.makedirs(os.path.join(self.root, 'sites', name))
+
+        with open(os.path.join(self.root, 'sites', 'sites.php'), 'w') as f:
+            f.write("<?php\n$sites['8080.staff.example.org'] = 'intranet';\n")
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def test_discovery_is_per_instance(self):
+        drush = drupal.Drush(self.root)
+        drupal.Drush(self.root)
+
+        self.assertEqual(drush.sites(), ['default', 'a.example.com',
+                                         'b.example.com', 'intranet'])
+        self.assertEqual(drush.site_aliases(),
+                         {'intranet': ['8080.staff.example.org']})
+
+    def test_patterns(self):
+        drush = drupal.Drush(self.root, sites=['*.example.com',
+                                               re.compile(r'staff')])
+
+        self.assertEqual(drush.sites(), ['a.example.com', 'b.example.com',
+                                         'intranet'])
+
+    def test_shards_cover_all_sites_once(self):
+        sites = []
+
+        for i in range(3):
+            sites.extend(drupal.Drush(self.root, shard='%d/3' % i).sites())
+
+        self.assertEqual(sorted(sites),
+                         sorted(drupal.Drush(self.root).sites()))
+        self.assertRaises(drupal.DrushError, drupal.Drush, self.root,
+                          shard='3/3')
+
+    def test_nothing_selected(self):
+        drush = drupal.Drush(self.root, sites=['*.example.net'],
+                             max_workers=4)
+
+        self.assertEqual(drush.sites(), [])
+        self.assertEqual(drush.command('cc all'), [])
+
+
+class TestParallelCommand(FakeDrushTestCase):
+    def setUp(self):
+        FakeDrushTestCase.setUp(self)
+        self.root = os.path.join(self.tmp_dir, 'root')
+
+        for name in ('all', 'default', 'a.example.com', 'b.example.com',
+                     'z.example.com'):
+            os.makedirs(os.path.join(self.root, 'sites', name))
+
+        self.stdout = io.StringIO()
+        self.drush = drupal.Drush(self.root, verbose=True, stdout=self.stdout,
+                                  max_workers=4)
+
+    def test_all_sites_run(self):
+        results = self.drush.command('cc all')
+
+        self.assertEqual([x.site for x in results], [
+            'default', 'http://a.example.com', 'http://b.example.com',
+            'http://z.example.com'])
+        self.assertTrue(all(x.ok for x in results))
+        self.assertEqual(len(self.drush_calls()), 4)
+
+    def test_failures_collected(self):
+        try:
+            self.drush.command('vset fail 1')
+            self.fail('DrushMultiSiteError not raised')
+        except drupal.DrushMultiSiteError as e:
+            self.assertEqual(len(e.results), 4)
+            self.assertEqual(len(e.failures), 4)
+            self.assertEqual(e.failures[0].returncode, 3)
+            self.assertIn('failed', e.failures[0].stderr)
+
+        self.assertEqual(len(self.drush_calls()), 4)
+
+        results = self.drush.command('vset fail 1', ignore_errors=True)
+        self.assertFalse(any(x.ok for x in results))
+
+    def test_one_failing_site(self):
+        os.makedirs(os.path.join(self.root, 'sites', 'fail.example.com'))
+        self.drush.discover_sites(refresh=True)
+
+        try:
+            self.drush.command('cc all')
+            self.fail('DrushMultiSiteError not raised')
+        except drupal.DrushMultiSiteError as e:
+            self.assertEqual([x.site for x in e.failures],
+                             ['http://fail.example.com'])
+            self.assertEqual(len(e.results), 5)
+            self.assertEqual(len(self.drush_calls()), 5)
+
+    def test_output_not_interleaved(self):
+        self.drush.command('cc all')
+        lines = self.stdout.getvalue().splitlines()
+
+        # Each site writes its command line and the output as one block
+        self.assertEqual(len(lines), 8)
+        for i in range(0, 8, 2):
+            self.assertTrue(lines[i].startswith('drush '))
+            self.assertEqual(lines[i + 1], lines[i])
+
+    def test_once(self):
+        results = self.drush.command('status', once=True)
+
+        self.assertEqual([x.site for x in results], ['default'])
+        self.assertEqual(self.drush_calls(), ['status'])
+
+
+class TestRunBatch(FakeDrushTestCase):
+    def setUp(self):
+        FakeDrushTestCase.setUp(self)
+        self.root = os.path.join(self.tmp_dir, 'root')
+
+        for name in ('all', 'default', 'a.example.com'):
+            os.makedirs(os.path.join(self.root, 'sites', name))
+
+        self.stdout = io.StringIO()
+        self.drush = drupal.Drush(self.root, stdout=self.stdout)
+
+    def test_reports(self):
+        with self.drush.batch() as batch:
+            self.drush.vset('site_name', 'Example')
+            self.drush.cc()
+
+        self.assertEqual([(x.site, x.operation[0], x.ok, x.error)
+                          for x in batch.results], [
+            ('default', 'vset', True, None),
+            ('default', 'cc', True, None),
+            ('http://a.example.com', 'vset', True, None),
+            ('http://a.example.com', 'cc', True, None)])
+        self.assertEqual(len(self.drush_calls()), 2)
+        self.assertNotIn('WAM-BATCH', self.stdout.getvalue())
+
+    def test_stops_on_error(self):
+        try:
+            with self.drush.batch() as batch:
+                self.drush.vset('fail', 1)
+                self.drush.cc()
+            self.fail('DrushError not raised')
+        except drupal.DrushError as e:
+            self.assertIn('default at vset', str(e))
+
+        self.assertEqual([(x.site, x.ok, x.error) for x in batch.results], [
+            ('default', False, 'failed'),
+            ('default', False, 'Not run because of an earlier failure')])
+        self.assertEqual(len(self.drush_calls()), 1)
+
+    def test_ignore_errors(self):
+        with self.drush.batch(ignore_errors=True) as batch:
+            self.drush.vset('fail', 1)
+            self.drush.cc()
+
+        self.assertEqual([x.ok for x in batch.results],
+                         [False, True, False, True])
+        self.assertEqual(len(self.drush_calls()), 2)
+
+    def test_missing_reports(self):
+        os.makedirs(os.path.join(self.root, 'sites', 'noreport.example.com'))
+        self.drush.discover_sites(refresh=True)
+
+        try:
+            with self.drush.batch() as batch:
+                self.drush.vset('site_name', 'Example')
+                self.drush.cc()
+            self.fail('DrushError not raised')
+        except drupal.DrushError as e:
+            self.assertIn('noreport.example.com', str(e))
+
+        missing = [x for x in batch.results if not x.ok]
+        self.assertEqual([x.site for x in missing],
+                         ['http://noreport.example.com'] * 2)
+        self.assertEqual(missing[0].error, 'No report from the batch script')
+
+        with self.drush.batch(ignore_errors=True, once=True) as batch:
+            self.drush.vset('site_name', 'Example')
+        self.assertTrue(batch.results[0].ok)
+
+
+class TestDeferred(unittest.TestCase):
+    def setUp(self):
+        self.drush = drupal.Drush('/nonexistent')
+        self.commands = []
+        self.drush.command = lambda command, **kwargs: \
+            self.commands.append(command)
+
+    def test_collapse(self):
+        with self.drush.deferred() as queue:
+            self.drush.cc('views')
+            self.drush.en('views')
+            self.drush.rr()
+            self.drush.en('ctools views')
+            self.drush.cc('css-js')
+            self.drush.dis('overlay')
+            self.drush.updb()
+            self.drush.rr()
+            self.drush.cc()
+
+        self.assertEqual(self.commands, ['rr', 'updb -y', 'en -y views ctools',
+                                         'dis -y overlay', 'cc all'])
+        self.assertEqual((queue.requested, queue.executed), (9, 5))
+
+    def test_single_cache_type_and_barrier(self):
+        with self.drush.deferred():
+            self.drush.cc('css-js')
+            self.drush.cc('css-js')
+            self.drush.barrier()
+            self.assertEqual(self.commands, ['cc css-js'])
+            self.drush.en('views')
+
+        self.assertEqual(self.commands, ['cc css-js', 'en -y views'])
+
+    def test_exception_discards_queue(self):
+        def fail():
+            with self.drush.deferred():
+                self.drush.cc()
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.commands, [])
+        self.drush.cc()
+        self.assertEqual(self.commands, ['cc all'])
+
+
+class TestQueries(unittest.TestCase):
+    def setUp(self):
+        self.drush = drupal.Drush('/nonexistent')
+        self.calls = []
+
+        def run_site(split, uri=None):
+            self.calls.append(split)
+            if split[0] == 'status':
+                stdout = 'Notice: noise\n{"drupal-version": "7.24"}'
+            else:
+                stdout = '{"site_name": "Example"}'
+            return drupal.SiteResult(uri or 'default', split, 0, 0.1, stdout)
+
+        self.drush._run_site = run_site
+        self.drush.command = lambda *args, **kwargs: \
+            drupal.Drush.invalidate_queries(self.drush)
+
+    def test_cached_until_write(self):
+        for _ in range(3):
+            status = self.drush.status()
+
+        self.assertEqual(status, {'default': {'drupal-version': '7.24'}})
+        self.assertEqual(len(self.calls), 1)
+
+        self.assertEqual(self.drush.vget('site_name'),
+                         {'default': 'Example'})
+        self.assertEqual(self.calls[-1],
+                         ['vget', '--exact', 'site_name', '--format=json'])
+
+        self.drush.cc()
+        self.drush.status()
+        self.assertEqual(len(self.calls), 3)
+
+    def test_dl_invalidates(self):
+        check_call = drupal.sp.check_call
+        drupal.sp.check_call = lambda command_line, cwd=None: 0
+
+        try:
+            self.drush.status()
+            self.drush.dl('views', skip_installed=False)
+            self.drush.status()
+        finally:
+            drupal.sp.check_call = check_call
+
+        self.assertEqual(len(self.calls), 2)
+
+    def test_ttl(self):
+        self.drush._query_ttl = 0
+        self.drush.status()
+        self.drush.status()
+
+        self.assertEqual(len(self.calls), 2)
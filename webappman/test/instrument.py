@@ -0,0 +1,83 @@
+from shutil import rmtree
+from webappman import instrument
+import io
+import json
+import os
+import tempfile
+import unittest
+
+
+class Recorder(instrument.Hook):
+    def __init__(self):
+        self.finished = []
+
+    def finish(self, record):
+        self.finished.append(dict(record))
+
+
+class TestOperation(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.recorder = Recorder()
+        instrument.add_hook(self.recorder)
+
+    def tearDown(self):
+        instrument.remove_hook(self.recorder)
+        rmtree(self.tmp_dir)
+
+    def test_record(self):
+        with instrument.operation('download', uri='x') as record:
+            record['bytes'] = 10
+
+        (record,) = self.recorder.finished
+        self.assertEqual(record['operation'], 'download')
+        self.assertEqual(record['uri'], 'x')
+        self.assertEqual(record['bytes'], 10)
+        self.assertIsNone(record['error'])
+        self.assertGreaterEqual(record['duration'], 0)
+
+    def test_error(self):
+        def fail():
+            with instrument.operation('drush', site='a.com'):
+                raise ValueError('bad')
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.recorder.finished[0]['error'],
+                         'ValueError: bad')
+
+    def test_json_lines_sink(self):
+        f = io.StringIO()
+        sink = instrument.JSONLinesSink(f)
+        instrument.add_hook(sink)
+
+        try:
+            with instrument.operation('mysql', statement='vset_many'):
+                pass
+        finally:
+            instrument.remove_hook(sink)
+
+        data = json.loads(f.getvalue())
+        self.assertEqual(data['operation'], 'mysql')
+        self.assertEqual(data['statement'], 'vset_many')
+
+    def test_prometheus_sink(self):
+        path = os.path.join(self.tmp_dir, 'wam.prom')
+        sink = instrument.PrometheusTextfileSink(path, per_site=True,
+                                                 interval=3600)
+        instrument.add_hook(sink)
+
+        try:
+            for _ in range(2):
+                with instrument.operation('sync', site='a.com') as record:
+                    record['bytes'] = 5
+        finally:
+            instrument.remove_hook(sink)
+        sink.flush()
+
+        with open(path) as f:
+            text = f.read()
+
+        labels = 'operation="sync",status="ok",site="a.com"'
+        self.assertIn('webappman_operations_total{%s} 2' % (labels), text)
+        self.assertIn('webappman_operation_bytes_total{%s} 10' % (labels),
+                      text)
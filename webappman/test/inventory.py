@@ -0,0 +1,69 @@
+from shutil import rmtree
+from webappman import drupal, inventory
+import os
+import tempfile
+import unittest
+
+
+def write_info(path, lines):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+class TestModuleIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        contrib = os.path.join(self.root, 'sites', 'all', 'modules',
+                               'contrib')
+        write_info(os.path.join(contrib, 'views', 'views.info'), [
+            'name = Views',
+            'dependencies[] = ctools',
+            'version = "7.x-3.8"',
+            'project = "views"',
+        ])
+        write_info(os.path.join(contrib, 'views', 'views_ui.info'), [
+            'name = Views UI',
+            'version = "7.x-3.8"',
+            'project = "views"',
+        ])
+        write_info(os.path.join(self.root, 'sites', 'all', 'themes', 'zen',
+                                'zen.info'), ['name = Zen'])
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def test_projects(self):
+        index = inventory.ModuleIndex(self.root)
+        projects = index.projects()
+
+        self.assertEqual(sorted(projects), ['views', 'zen'])
+        self.assertEqual(projects['views'].version, '7.x-3.8')
+        self.assertEqual(projects['views'].modules, ['views', 'views_ui'])
+        self.assertEqual(projects['zen'].type, 'theme')
+        self.assertIsNone(projects['zen'].version)
+        self.assertIs(index.modules()['views_ui'], projects['views'])
+
+    def test_dl_skips_installed_and_batches(self):
+        drush = drupal.Drush(self.root)
+        command_lines = []
+        drush._handle_dl = lambda command_line, ignore_errors, cwd=None: \
+            command_lines.append(command_line)
+
+        downloaded = drush.dl(['views-7.x-3.8', 'views-7.x-3.9', 'ctools',
+                               'ctools', 'token'], batch_size=2)
+
+        self.assertEqual(downloaded, ['views-7.x-3.9', 'ctools', 'token'])
+        self.assertEqual(sorted(x[-2:] for x in command_lines),
+                         [['-q', 'token'], ['views-7.x-3.9', 'ctools']])
+
+    def test_dl_updates_unpinned(self):
+        drush = drupal.Drush(self.root)
+        command_lines = []
+        drush._handle_dl = lambda command_line, ignore_errors, cwd=None: \
+            command_lines.append(command_line)
+
+        self.assertEqual(drush.dl('views'), ['views'])
+        self.assertEqual(command_lines[0][-1], 'views')
@@ -0,0 +1,59 @@
+from shutil import rmtree
+from webappman import release
+import os
+import tempfile
+import unittest
+
+
+class TestReleases(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.releases = release.Releases(self.root, keep=2)
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def _build(self, content):
+        path = self.releases.new_release()
+        os.makedirs(os.path.join(path, 'sites', 'default', 'files'))
+
+        with open(os.path.join(path, 'index.php'), 'w') as f:
+            f.write(content)
+
+        self.releases.link_shared(path, ['sites/default/files'])
+        self.releases.activate(path)
+
+        return os.path.basename(path)
+
+    def test_activate_rollback_prune(self):
+        names = [self._build(x) for x in ('1', '2', '3')]
+        current = os.path.join(self.root, 'current')
+
+        with open(os.path.join(current, 'index.php')) as f:
+            self.assertEqual(f.read(), '3')
+        self.assertTrue(os.path.islink(os.path.join(current, 'sites',
+                                                    'default', 'files')))
+
+        self.assertEqual(self.releases.rollback(), names[1])
+        self.assertEqual(self.releases.current(), names[1])
+
+        # names[2] is newer than the live release so it is kept as well
+        self.assertEqual(self.releases.prune(), [names[0]])
+        self.assertEqual(self.releases.list(), names[1:])
+
+    def test_link_site_files(self):
+        path = self.releases.new_release()
+        for name in ('all', 'default', 'b.example.com'):
+            os.makedirs(os.path.join(path, 'sites', name))
+
+        self.assertEqual(self.releases.link_site_files(path), [
+            os.path.join('sites', 'b.example.com', 'files'),
+            os.path.join('sites', 'default', 'files')])
+
+        for name in ('b.example.com', 'default'):
+            self.assertTrue(os.path.islink(os.path.join(path, 'sites', name,
+                                                        'files')))
+            self.assertTrue(os.path.isdir(os.path.join(
+                self.root, 'shared', 'sites', name, 'files')))
+        self.assertFalse(os.path.lexists(os.path.join(path, 'sites', 'all',
+                                                      'files')))
@@ -0,0 +1,153 @@
+from shutil import rmtree
+from webappman import assets, wordpress
+from webappman.cache import ArtifactCache
+import os
+import tempfile
+import unittest
+import zipfile
+
+CONFIG = {'db_name': 'blog', 'db_user': 'blog', 'db_password': 'secret'}
+
+
+class TestGenerateWpConfig(unittest.TestCase):
+    def test_config(self):
+        content = wordpress.generate_wp_config(CONFIG, table_prefix='b1_')
+
+        self.assertTrue(content.startswith('<?php\n'))
+        self.assertIn("define('DB_NAME', 'blog');", content)
+        self.assertIn("define('DB_HOST', 'localhost');", content)
+        self.assertIn("$table_prefix = 'b1_';", content)
+
+    def test_missing_key(self):
+        self.assertRaises(wordpress.WordPressConfigurationError,
+                          wordpress.generate_wp_config, {'db_name': 'x'})
+
+
+class TestProvisionSites(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        archive = os.path.join(self.tmp_dir, 'wordpress-4.9.8.zip')
+
+        with zipfile.ZipFile(archive, 'w') as f:
+            f.writestr('wordpress/index.php', '<?php')
+            f.writestr('wordpress/wp-config-sample.php', '<?php')
+
+        self.old = (wordpress.WordPress.DL_FORMAT, wordpress.artifact_cache)
+        wordpress.WordPress.DL_FORMAT = 'file://%s/wordpress-%%s.zip' % (
+            self.tmp_dir)
+        wordpress.artifact_cache = ArtifactCache(
+            os.path.join(self.tmp_dir, 'cache'))
+
+    def tearDown(self):
+        (wordpress.WordPress.DL_FORMAT, wordpress.artifact_cache) = self.old
+        rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def test_provision(self):
+        results = wordpress.provision_sites(
+            [(self.path('blog%d' % i), CONFIG, 'b%d_' % i)
+             for i in range(5)], version='4.9.8', max_workers=3)
+
+        self.assertTrue(all(x.ok for x in results))
+
+        with open(os.path.join(self.path('blog3'), 'wp-config.php')) as f:
+            self.assertIn("$table_prefix = 'b3_';", f.read())
+        self.assertFalse(os.path.exists(os.path.join(
+            self.path('blog3'), 'wp-config-sample.php')))
+
+    def test_failure_and_all_or_nothing(self):
+        entries = [(self.path('good'), CONFIG), (self.path('bad'), {})]
+
+        try:
+            wordpress.provision_sites(entries, version='4.9.8',
+                                      all_or_nothing=True)
+            self.fail('WordPressFleetError not raised')
+        except wordpress.WordPressFleetError as e:
+            self.assertEqual([x.path for x in e.failures],
+                             [os.path.realpath(self.path('good')),
+                              os.path.realpath(self.path('bad'))])
+            self.assertTrue(e.results[0].rolled_back)
+            self.assertFalse(e.results[1].rolled_back)
+            self.assertIn('Rolled back', str(e.results[0].error))
+
+        self.assertFalse(os.path.exists(self.path('good')))
+        self.assertFalse(os.path.exists(self.path('bad')))
+
+    def test_all_or_nothing_ignore_errors(self):
+        entries = [(self.path('good'), CONFIG), (self.path('bad'), {})]
+        results = wordpress.provision_sites(entries, version='4.9.8',
+                                            all_or_nothing=True,
+                                            ignore_errors=True)
+
+        self.assertEqual([x.ok for x in results], [False, False])
+        self.assertEqual([x.rolled_back for x in results], [True, False])
+        self.assertFalse(os.path.exists(self.path('good')))
+
+    def test_duplicate_path(self):
+        entries = [(self.path('blog'), CONFIG), (self.path('blog'), CONFIG),
+                   (self.path('other'), CONFIG)]
+        results = wordpress.provision_sites(entries, version='4.9.8',
+                                            ignore_errors=True)
+
+        self.assertEqual([x.ok for x in results], [False, False, True])
+        self.assertFalse(any(x.rolled_back for x in results))
+        self.assertFalse(os.path.exists(self.path('blog')))
+
+    def test_failure_keeps_existing_directory(self):
+        def install(self, open_core, wp_config_php):
+            os.makedirs(os.path.join(self._path, 'someone-else'))
+            raise OSError('rename failed')
+
+        old = wordpress.WordPress._install
+        wordpress.WordPress._install = install
+
+        try:
+            (result,) = wordpress.provision_sites(
+                [(self.path('blog'), CONFIG)], version='4.9.8',
+                ignore_errors=True)
+        finally:
+            wordpress.WordPress._install = old
+
+        self.assertFalse(result.ok)
+        self.assertFalse(result.rolled_back)
+        self.assertTrue(os.path.isdir(os.path.join(self.path('blog'),
+                                                   'someone-else')))
+
+
+class TestSyncAssets(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp_dir, 'uploads')
+        os.makedirs(os.path.join(self.source, '2014'))
+
+        with open(os.path.join(self.source, '2014', 'a.jpg'), 'wb') as f:
+            f.write(b'jpg')
+
+        self.old_manifest_path = assets.manifest_path
+        manifest_dir = os.path.join(self.tmp_dir, 'manifests')
+        assets.manifest_path = lambda source, dest: \
+            self.old_manifest_path(source, dest, manifest_dir=manifest_dir)
+
+    def tearDown(self):
+        assets.manifest_path = self.old_manifest_path
+        rmtree(self.tmp_dir)
+
+    def test_reprovisioned_site(self):
+        path = os.path.join(self.tmp_dir, 'blog')
+        uploaded = os.path.join(path, 'wp-content', 'uploads', '2014',
+                                'a.jpg')
+        site = wordpress.WordPress(path)
+
+        self.assertEqual(sum(x.files for x in site.sync_assets(
+            self.source)), 1)
+        self.assertEqual(site.sync_assets(self.source), [])
+
+        rmtree(path)
+        os.makedirs(os.path.join(path, 'wp-content', 'uploads'))
+        site = wordpress.WordPress(path)
+
+        self.assertEqual(sum(x.files for x in site.sync_assets(
+            self.source)), 1)
+        self.assertTrue(os.path.isfile(uploaded))
@@ -1,15 +1,30 @@
 #coding: utf-8
 
-from os import remove as rm
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
 from os.path import basename, dirname, join as path_join, realpath, isdir
-from sh import unzip
+from shutil import copyfileobj, rmtree as rmdir_force
 import tempfile
+import time
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
 
-from osext.filesystem import rmdir_force, sync as dir_sync
+from osext.filesystem import sync as dir_sync
 import httpext as http
 import os
 import langutil.php as php
 
+from webappman.archive import extract_zip
+from webappman.assets import sync_tree, sync_tree_bundled
+from webappman.cache import ArtifactCache
+
+# Released WordPress archives never change, so pinned versions are kept in
+#   this cache (shared by all installs on the host). Set to None to always
+#   download.
+artifact_cache = ArtifactCache()
+
 
 class WordPressError(Exception):
     pass
@@ -19,6 +34,245 @@ class WordPressConfigurationError(WordPressError):
     pass
 
 
+_WP_CONFIG_DEFAULTS = {
+    'db_host': 'localhost',
+    'db_charset': 'utf8',
+    'db_collate': '',
+    'wplang': '',
+    'auth_key': ',Qi8F3A:ME>+!G*|a!>zbW!GWe,A9rHR@tL.4sFCE}LR0][j/995U'
+                '+4*3H:i]]DH',
+    'secure_auth_key': 'UjN_-SP+Whq/^taB31&lg$fj0-<XSgKy@UzK*B-k-4aiT9'
+                       '~m^s_vT[dE,5P;kx(E',
+    'logged_in_key': '2dfV^z4rJqrSEdQc.ec)KJC UZv$#)OhJKRY~Vj9+]M-]CIB'
+                     'L(RvGZ|[C!S|]MOv',
+    'nonce_key': '.Ue WG1NN/cKo^MC53$_U0!V>Mtdw-ar$rP8o+;rawQ)B$9LlAAL'
+                 '<@GLoXS_POaa',
+}
+_WP_CONFIG_KEYS = (
+    'db_name',
+    'db_user',
+    'db_password',
+    'db_host',
+    'db_collate',
+    'db_charset',
+    'auth_key',
+    'secure_auth_key',
+    'logged_in_key',
+    'nonce_key',
+    'wplang',
+)
+_WP_CONFIG_FOOTER = '''if (!defined('ABSPATH'))
+  define('ABSPATH', dirname(__FILE__) . '/');
+require_once(ABSPATH . 'wp-settings.php');
+'''
+
+
+def generate_wp_config(config, table_prefix='wp_', _scalars=None):
+    """Returns the contents of wp-config.php. See WordPress.init_dir() for
+         the configuration keys.
+
+    Raises WordPressConfigurationError if a required key is missing.
+    """
+    if _scalars is None:
+        _scalars = {}
+
+    def scalar(value):
+        # Memoised; a fleet shares most values (defaults, hosts, names)
+        key = (type(value), value)
+        if key not in _scalars:
+            _scalars[key] = php.generate_scalar(value)
+        return _scalars[key]
+
+    wp_config_php = ['<?php']
+
+    for key in _WP_CONFIG_KEYS:
+        if key in config:
+            value = config[key]
+        elif key in _WP_CONFIG_DEFAULTS:
+            value = _WP_CONFIG_DEFAULTS[key]
+        else:
+            raise WordPressConfigurationError('Configuration key %s is '
+                                              'required' % (key))
+
+        wp_config_php.append('define(%s, %s);' % (scalar(key.upper()),
+                                                  scalar(value)))
+
+    wp_config_php.append('$table_prefix = %s;' % (scalar(table_prefix)))
+
+    return '\n'.join(wp_config_php) + '\n' + _WP_CONFIG_FOOTER
+
+
+def _core_opener(version, cache, work_dir, shared=False):
+    """Returns a callable that opens the WordPress core archive as a binary
+         file object. Pinned versions come from artifact_cache. The latest
+         version is downloaded with httpext's cache into work_dir. Otherwise
+         the archive is streamed, unless shared is True (the callable will
+         be called many times) in which case it is downloaded into work_dir
+         once."""
+    if version == 'latest':
+        uri = WordPress.LATEST_URI
+    else:
+        uri = WordPress.DL_FORMAT % (version)
+
+    if version != 'latest' and cache and artifact_cache is not None:
+        # Fetched now so that failures happen before any site is touched
+        artifact_cache.open(uri).close()
+        return lambda: artifact_cache.open(uri)
+
+    if version == 'latest' and cache:
+        archive = path_join(work_dir, '_wp.zip')
+        http.dl(uri, archive, cache=cache)
+        return lambda: open(archive, 'rb')
+
+    if shared:
+        archive = path_join(work_dir, '_wp.zip')
+        with closing(urlopen(uri)) as src:
+            with open(archive, 'wb') as dst:
+                copyfileobj(src, dst)
+        return lambda: open(archive, 'rb')
+
+    return lambda: closing(urlopen(uri))
+
+
+class SiteResult(object):
+    """Outcome of provisioning one site with provision_sites()"""
+    path = None
+    elapsed = None
+    error = None
+    rolled_back = False
+
+    def __init__(self, path, elapsed, error=None):
+        self.path = path
+        self.elapsed = elapsed
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<SiteResult %s ok=%s %.2fs>' % (self.path, self.ok,
+                                               self.elapsed or 0)
+
+
+class WordPressFleetError(WordPressError):
+    """Raised by provision_sites() when sites failed. ``results`` holds the
+         SiteResult of every site, ``failures`` the failed ones."""
+    def __init__(self, results):
+        self.results = results
+        self.failures = [x for x in results if not x.ok]
+
+        WordPressError.__init__(self, '%d of %d sites failed: %s' % (
+            len(self.failures), len(results), '; '.join(
+                '%s (%s)' % (x.path, x.error) for x in self.failures)))
+
+
+def provision_sites(entries, version='latest', cache=True, max_workers=8,
+                    all_or_nothing=False, ignore_errors=False):
+    """Creates many WordPress installations. Core is downloaded once and
+         every wp-config.php is rendered before any directory is created,
+         so a configuration error fails its site without touching the disk.
+         Sites are then extracted by max_workers threads.
+
+    provision_sites([
+        ('/var/www/blog1', {'db_name': 'blog1', ...}, 'wp_'),
+        ('/var/www/blog2', {'db_name': 'blog2', ...}),
+    ])
+
+    Arguments:
+    entries -- list of (path, config) or (path, config, table_prefix). See
+               WordPress.init_dir() for config.
+
+    Keyword Arguments:
+    version        -- str, version number or 'latest'
+    cache          -- bool, see WordPress.init_dir()
+    max_workers    -- int, sites provisioned at the same time
+    all_or_nothing -- bool, if any site fails, also remove the sites that
+                      were created. They fail with rolled_back set.
+    ignore_errors  -- bool, return the results instead of raising
+
+    Returns a list of SiteResult in the order of entries. Entries sharing a
+      path all fail. A failed site never leaves a directory behind, and a
+      directory that already existed is never removed. Raises
+      WordPressFleetError if any site failed, unless ignore_errors is True.
+    """
+    scalars = {}
+    jobs = []
+    results = []
+    paths = [realpath(entry[0]) for entry in entries]
+
+    for entry in entries:
+        (path, config) = entry[:2]
+        table_prefix = entry[2] if len(entry) > 2 else 'wp_'
+        site = WordPress(path)
+        result = SiteResult(site._path, None)
+        results.append(result)
+
+        try:
+            if paths.count(site._path) > 1:
+                raise WordPressError('Directory %s is listed more than once'
+                                     % (site._path))
+            if site._is_initialized:
+                raise WordPressError('Directory %s already exists' %
+                                     (site._path))
+            jobs.append((site, result, generate_wp_config(
+                config, table_prefix, _scalars=scalars)))
+        except WordPressError as e:
+            result.error = e
+            result.elapsed = 0
+
+    work_dir = tempfile.mkdtemp(prefix='wam-wp-')
+
+    try:
+        if jobs:
+            try:
+                open_core = _core_opener(version, cache, work_dir,
+                                         shared=True)
+            except Exception as e:
+                for (_, result, _) in jobs:
+                    (result.error, result.elapsed) = (e, 0)
+                jobs = []
+
+        def provision(job):
+            (site, result, wp_config_php) = job
+            start = time.time()
+
+            try:
+                site._install(open_core, wp_config_php)
+            except Exception as e:
+                result.error = e
+                # _install() cleans up its staging directory. The target
+                #   is only this job's to remove if its rename happened.
+                if site._is_initialized and isdir(site._path):
+                    rmdir_force(site._path)
+                    result.rolled_back = True
+
+            result.elapsed = time.time() - start
+
+        if jobs:
+            pool = ThreadPool(max(1, min(max_workers, len(jobs))))
+            try:
+                pool.map(provision, jobs)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        rmdir_force(work_dir)
+
+    if all_or_nothing and not all(x.ok for x in results):
+        for (site, result, _) in jobs:
+            if result.ok and isdir(site._path):
+                rmdir_force(site._path)
+                result.error = WordPressError('Rolled back because other '
+                                              'sites failed')
+                result.rolled_back = True
+
+    if not ignore_errors and not all(x.ok for x in results):
+        raise WordPressFleetError(results)
+
+    return results
+
+
 class WordPress:
     """For installing and managing WordPress sites"""
     LATEST_URI = 'http://wordpress.org/latest.zip'
@@ -43,11 +297,14 @@ class WordPress:
     def _diff_list(self, a, b):
         return filter(lambda x: x not in a, b)
 
-    def init_dir(self, version='latest', config={}, table_prefix='wp_'):
+    def init_dir(self, version='latest', config={}, table_prefix='wp_',
+                 cache=True):
         """Initialises a new WordPress installation.
 
         Kwargs:
             version (str): Version number or ``'latest'``.
+            cache (bool): Use the artifact cache for a pinned version, or
+              httpext's cache for ``'latest'``.
             config (dict): Configuration. Must have keys ``'db_name'``,
                              ``'db_user'``, ``'db_password'`` at minimum.
             table_prefix (str): Table prefix.
@@ -69,80 +326,70 @@ class WordPress:
         if self._is_initialized:
             raise WordPressError('Directory %s already exists' % (self._path))
 
-        uri = self.LATEST_URI
-        cache = True
-
-        if version != 'latest':
-            uri = self.DL_FORMAT % (version)
-            cache = False
-
-        prev_listing = os.listdir('.')
-        dir_name = path_join(tempfile.gettempdir(), '__wp__')
-
-        http.dl(uri, '_wp.zip', cache=cache)
-        unzip(['-d', dir_name, '_wp.zip'])
-        rm('_wp.zip')
-
-        dir_name = path_join(dir_name, 'wordpress')
-        os.rename(dir_name, self._path)
-
-        defaults = {
-            'db_host': 'localhost',
-            'db_charset': 'utf8',
-            'db_collate': '',
-            'wplang': '',
-            'auth_key': ',Qi8F3A:ME>+!G*|a!>zbW!GWe,A9rHR@tL.4sFCE}LR0][j/995U'
-                        '+4*3H:i]]DH',
-            'secure_auth_key': 'UjN_-SP+Whq/^taB31&lg$fj0-<XSgKy@UzK*B-k-4aiT9'
-                               '~m^s_vT[dE,5P;kx(E',
-            'logged_in_key': '2dfV^z4rJqrSEdQc.ec)KJC UZv$#)OhJKRY~Vj9+]M-]CIB'
-                             'L(RvGZ|[C!S|]MOv',
-            'nonce_key': '.Ue WG1NN/cKo^MC53$_U0!V>Mtdw-ar$rP8o+;rawQ)B$9LlAAL'
-                         '<@GLoXS_POaa',
-        }
-        keys = [
-            'db_name',
-            'db_user',
-            'db_password',
-            'db_host',
-            'db_collate',
-            'db_charset',
-            'auth_key',
-            'secure_auth_key',
-            'logged_in_key',
-            'nonce_key',
-            'wplang',
-        ]
-
-        line_format = 'define(%s, %s);'
-        wp_config_php = ['<?php']
-
-        for key in keys:
-            if key in config:
-                value = config[key]
-            elif key in defaults:
-                value = defaults[key]
-            else:
-                raise WordPressConfigurationError('Configuration key %s is required' %
-                                           (key))
-
-            wp_config_php.append(line_format %
-                                 (php.generate_scalar(key.upper()),
-                                  php.generate_scalar(value)))
-
-        wp_config_php.append('$table_prefix = %s;' %
-                             (php.generate_scalar(table_prefix)))
-
-        lines = '\n'.join(wp_config_php) + '\n'
-        lines += '''if (!defined('ABSPATH'))
-  define('ABSPATH', dirname(__FILE__) . '/');
-require_once(ABSPATH . 'wp-settings.php');'''
-        lines += '\n'
+        wp_config_php = generate_wp_config(config, table_prefix)
+        staging_dir = tempfile.mkdtemp(dir=dirname(self._path),
+                                       prefix='.wp-')
+
+        try:
+            open_core = _core_opener(version, cache, staging_dir)
+            self._install(open_core, wp_config_php)
+        finally:
+            rmdir_force(staging_dir)
+
+    def _install(self, open_core, wp_config_php):
+        """Extracts core from the file object returned by open_core() and
+             writes wp-config.php."""
+        # Extract into a directory of its own next to the target, so
+        #   concurrent installs never share files and the final rename stays
+        #   on one file system
+        staging_dir = tempfile.mkdtemp(dir=dirname(self._path),
+                                       prefix='.wp-')
+        extract_dir = path_join(staging_dir, 'wordpress')
+
+        try:
+            with open_core() as f:
+                extract_zip(f, extract_dir, strip_components=1)
+
+            with open(path_join(extract_dir, 'wp-config.php'), 'wb') as f:
+                f.write(wp_config_php.encode('utf-8'))
+
+            sample = path_join(extract_dir, 'wp-config-sample.php')
+            if os.path.exists(sample):
+                os.remove(sample)
+
+            os.rename(extract_dir, self._path)
+            self._is_initialized = True
+        finally:
+            rmdir_force(staging_dir)
+
+    def sync_assets(self, remote_path, bundle=True, workers=4, full=False,
+                    small_file_size=256 * 1024):
+        """Synchronises wp-content/uploads from a local path or an SSH style
+             host:path. Only files that are new or changed since the last
+             sync are transferred; nothing is deleted.
+
+        Kwargs:
+            bundle (bool): Pack small files into tar streams (see
+              webappman.assets.sync_tree_bundled()) instead of handing every
+              file to rsync.
+            workers (int): Transfers run at the same time.
+            full (bool): Ignore the manifest of the previous sync once.
+              Implied when the uploads directory is missing or empty.
+            small_file_size (int): Files below this size are bundled.
+
+        Returns a list of webappman.assets.ShardResult.
+        """
+        uploads_path = path_join(self._path, 'wp-content', 'uploads')
 
-        with open(path_join(self._path, 'wp-config.php'), 'wb+') as f:
-            f.write(lines)
+        # A site provisioned again at the same path starts without uploads;
+        #   whatever the manifest says, everything has to be copied
+        if not isdir(uploads_path) or not os.listdir(uploads_path):
+            full = True
 
-        os.remove(path_join(self._path, 'wp-config-sample.php'))
+        if bundle:
+            return sync_tree_bundled(remote_path, uploads_path,
+                                     workers=workers, full=full,
+                                     small_file_size=small_file_size)
 
-    def sync_assets(self, remote_path):
-        raise Exception('Not implemented')
+        return sync_tree(remote_path, uploads_path, workers=workers,
+                         full=full)